@@ -0,0 +1,271 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+
+AGENT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lab_agent.py')
+REMOTE_DIR = '.lab_agent'  # 相对于远程用户主目录
+
+
+class AgentError(Exception):
+    """代理未运行或请求失败"""
+
+
+def format_size(size):
+    """按docker images的格式显示大小（十进制单位）"""
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if size < 1000 or unit == 'TB':
+            return f"{size:.3g}{unit}" if unit != 'B' else f"{int(size)}B"
+        size /= 1000
+
+
+def running_for(created):
+    """按docker ps的RunningFor格式显示创建至今的时间"""
+    seconds = max(int(time.time() - created), 0)
+    for unit, size in (('days', 86400), ('hours', 3600), ('minutes', 60)):
+        if seconds >= size * 2:
+            return f"{seconds // size} {unit} ago"
+    return f"{seconds} seconds ago"
+
+
+class _Pending:
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+
+class RemoteAgent:
+    """一台服务器上的常驻代理（lab_agent.py）
+
+    代理进程运行在池中连接的一个长期通道上（占用一个通道名额），请求和响应都是
+    一行JSON，多个请求可以同时在途，按id匹配。通道断开时代理进程随之退出。
+    """
+
+    def __init__(self, name, server_info, ssh_manager, on_event=None):
+        self.name = name
+        self.server_info = server_info
+        self.ssh_manager = ssh_manager
+        self.on_event = on_event
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._lease = None
+        self._channel = None
+        self._reader = None
+        self.info = None
+
+    @staticmethod
+    def _source():
+        with open(AGENT_FILE, 'rb') as f:
+            data = f.read()
+        return data, hashlib.sha256(data).hexdigest()[:12]
+
+    def _install(self, ssh, source, version):
+        """上传代理脚本（同一版本只上传一次），返回远程路径"""
+        remote_path = f"{REMOTE_DIR}/lab_agent-{version}.py"
+        command = (
+            f"test -f {remote_path} || "
+            f"{{ mkdir -p {REMOTE_DIR} && cat > {remote_path}.tmp && mv {remote_path}.tmp {remote_path}; }}"
+        )
+        stdin, stdout, stderr = ssh.exec_command(command)
+        stdin.write(source)
+        stdin.channel.shutdown_write()
+        if stdout.channel.recv_exit_status() != 0:
+            raise AgentError(f"上传代理失败：{stderr.read().decode().strip()}")
+        return remote_path
+
+    def start(self, timeout=15):
+        source, version = self._source()
+        self._lease = self.ssh_manager.acquire_channel(self.server_info, 'lab_agent', timeout=timeout)
+        try:
+            ssh = self._lease['ssh']
+            remote_path = self._install(ssh, source, version)
+            channel = ssh.get_transport().open_session(timeout=timeout)
+            channel.exec_command(f"exec python3 -u {remote_path}")
+            self._channel = channel
+            self._reader = threading.Thread(target=self._read_loop, daemon=True)
+            self._reader.start()
+            self.info = self.request('hello', timeout=timeout)
+            if self.on_event:
+                self.request('subscribe', timeout=timeout)
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def alive(self):
+        return self._channel is not None and not self._channel.closed and self._reader.is_alive()
+
+    def _read_loop(self):
+        try:
+            for line in self._channel.makefile('r'):
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if 'event' in message:
+                    if self.on_event:
+                        try:
+                            self.on_event(self.name, message)
+                        except Exception as e:
+                            print(f"处理代理事件失败：{str(e)}")
+                    continue
+                with self._pending_lock:
+                    pending = self._pending.pop(message.get('id'), None)
+                if pending:
+                    pending.response = message
+                    pending.event.set()
+        except Exception:
+            pass
+        finally:
+            # 通道断开：唤醒所有等待者
+            with self._pending_lock:
+                pending_list = list(self._pending.values())
+                self._pending.clear()
+            for pending in pending_list:
+                pending.event.set()
+
+    def send(self, op, **params):
+        """发送请求，返回等待对象，用于同时发出多个请求"""
+        if not self.alive:
+            raise AgentError(f"{self.name} 上的代理未运行")
+        request_id = next(self._ids)
+        pending = _Pending()
+        with self._pending_lock:
+            self._pending[request_id] = pending
+        line = json.dumps(dict(params, id=request_id, op=op)) + '\n'
+        try:
+            with self._send_lock:
+                self._channel.sendall(line.encode('utf-8'))
+        except Exception as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise AgentError(f"向 {self.name} 上的代理发送请求失败：{str(e)}")
+        return pending
+
+    def wait(self, pending, timeout=10):
+        if not pending.event.wait(timeout):
+            raise AgentError(f"{self.name} 上的代理 {timeout} 秒内未响应")
+        response = pending.response
+        if response is None:
+            raise AgentError(f"{self.name} 上的代理已断开")
+        if not response.get('ok'):
+            raise AgentError(response.get('error', '未知错误'))
+        return response['data']
+
+    def request(self, op, timeout=10, **params):
+        return self.wait(self.send(op, **params), timeout)
+
+    def close(self):
+        if self._channel is not None:
+            try:
+                self._channel.close()
+            except Exception:
+                pass
+            self._channel = None
+        if self._lease is not None:
+            self.ssh_manager.release_channel(self.server_info, self._lease)
+            self._lease = None
+
+
+class AgentManager:
+    """管理各服务器上的常驻代理：按需启动，断开后重启，启动失败的服务器一段时间内不再尝试
+
+    支持的查询：gpus（与nvidia-smi解析结果相同的字段）、containers、images、ports。
+    """
+
+    def __init__(self, ssh_manager, retry_interval=300):
+        self.ssh_manager = ssh_manager
+        self.retry_interval = retry_interval
+        self._agents = {}
+        self._failed = {}  # 服务器名 -> 上次启动失败的时间
+        self._lock = threading.Lock()
+        self._start_locks = {}
+        self._listeners = []
+
+    def subscribe(self, callback):
+        """callback(服务器名, 事件字典)；在订阅之后启动的代理会推送容器和GPU变化事件"""
+        self._listeners.append(callback)
+
+    def _dispatch(self, name, event):
+        for callback in list(self._listeners):
+            callback(name, event)
+
+    def get_agent(self, name, server_info):
+        """返回运行中的代理，无法启动时返回None"""
+        with self._lock:
+            agent = self._agents.get(name)
+            if agent and agent.alive:
+                return agent
+            if time.time() - self._failed.get(name, 0) < self.retry_interval:
+                return None
+            start_lock = self._start_locks.setdefault(name, threading.Lock())
+        with start_lock:
+            with self._lock:
+                agent = self._agents.get(name)
+                if agent and agent.alive:
+                    return agent
+            if agent:
+                agent.close()
+            agent = RemoteAgent(name, server_info, self.ssh_manager,
+                                on_event=self._dispatch if self._listeners else None)
+            try:
+                agent.start()
+            except Exception as e:
+                print(f"启动服务器 {name} 上的代理失败：{str(e)}")
+                with self._lock:
+                    self._agents.pop(name, None)
+                    self._failed[name] = time.time()
+                return None
+            with self._lock:
+                self._agents[name] = agent
+                self._failed.pop(name, None)
+            return agent
+
+    def query(self, name, server_info, op, timeout=10, **params):
+        agent = self.get_agent(name, server_info)
+        if agent is None:
+            raise AgentError(f"服务器 {name} 上的代理不可用")
+        return agent.request(op, timeout=timeout, **params)
+
+    def query_all(self, servers, ops, timeout=10):
+        """向多台服务器同时发出查询，返回 {服务器名: {op: 数据}}，只包含全部查询成功的服务器
+
+        只使用已在运行的代理，不在这里启动代理（启动见 start_all），避免拖慢调用方。
+        """
+        with self._lock:
+            agents = {name: self._agents.get(name) for name in servers}
+        sent = {}
+        for name, agent in agents.items():
+            if agent is None or not agent.alive:
+                continue
+            try:
+                sent[name] = {op: agent.send(op) for op in ops}
+            except AgentError:
+                continue
+        deadline = time.monotonic() + timeout
+        results = {}
+        for name, pendings in sent.items():
+            try:
+                results[name] = {
+                    op: agents[name].wait(pending, max(deadline - time.monotonic(), 0))
+                    for op, pending in pendings.items()
+                }
+            except AgentError as e:
+                print(f"查询服务器 {name} 上的代理失败：{str(e)}")
+        return results
+
+    def start_all(self, servers):
+        """在后台为所有服务器启动代理"""
+        for name, server_info in servers.items():
+            threading.Thread(target=self.get_agent, args=(name, server_info), daemon=True).start()
+
+    def close_all(self):
+        with self._lock:
+            agents = list(self._agents.values())
+            self._agents.clear()
+        for agent in agents:
+            agent.close()
@@ -0,0 +1,234 @@
+import json
+import os
+import threading
+import time
+from file_lock import FileLock
+
+class AllocationJournal:
+    """GPU分配和任务记录的追加式日志（JSONL）
+
+    每次状态修改追加一行：{"ts", "pid", "version", "event", "data"}，可用于审计和回放集群状态。
+    version为状态库的数据版本号：多个进程并发提交时写入日志的顺序可能与提交顺序不同，
+    回放和压缩按版本号排序后应用。
+
+    - 组提交：并发的写入者把记录放入待写队列，由其中一个线程一次写入并fsync，
+      其余线程等待同一次fsync完成，fsync次数远少于记录数
+    - 压缩：日志超过 compact_bytes 后回放为快照文件并截断日志；版本号不连续且缺口较新
+      （另一个进程的记录可能还未写入）时，缺口之后的记录留在日志中，下次压缩再处理
+    - 回放：快照 + 日志尾部 = 当前状态；最后一行不完整（写入中途崩溃）时忽略
+
+    所有事件都是幂等的（按键覆盖或删除），快照写入后、截断日志前崩溃时重复回放不会出错。
+    """
+
+    def __init__(self, journal_file, compact_bytes=1024 * 1024, gap_timeout=60):
+        self.journal_file = journal_file
+        self.snapshot_file = f"{journal_file}.snapshot"
+        self.compact_bytes = compact_bytes
+        self.gap_timeout = gap_timeout  # 版本缺口超过该时间（秒）仍未补上时视为丢失
+        self.lock = FileLock(journal_file)  # 跨进程：追加与压缩互斥
+        self.state_store = None
+        self._fd = os.open(journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._flushing = False
+        self.stats = {'entries': 0, 'fsyncs': 0, 'compactions': 0}
+
+    # ---- 写入 ----
+
+    def append(self, event, data, version=None):
+        """追加一条记录，返回时记录已落盘"""
+        entry = {
+            'line': json.dumps(
+                {'ts': time.time(), 'pid': os.getpid(), 'version': version, 'event': event, 'data': data},
+                ensure_ascii=False, separators=(',', ':')
+            ) + '\n',
+            'done': False,
+            'error': None
+        }
+        with self._cond:
+            self._pending.append(entry)
+            while not entry['done']:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                # 成为本批次的提交者：写入期间新到的记录进入下一批
+                self._flushing = True
+                batch, self._pending = self._pending, []
+                self._cond.release()
+                error = None
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    error = e
+                finally:
+                    self._cond.acquire()
+                    for item in batch:
+                        item['done'] = True
+                        item['error'] = error
+                    self._flushing = False
+                    self._cond.notify_all()
+        if entry['error'] is not None:
+            raise entry['error']
+
+    def _write_batch(self, batch):
+        data = ''.join(item['line'] for item in batch).encode('utf-8')
+        if not self.lock.acquire(timeout=10):
+            raise TimeoutError("获取分配日志锁超时")
+        try:
+            os.write(self._fd, data)
+            os.fsync(self._fd)
+            self.stats['entries'] += len(batch)
+            self.stats['fsyncs'] += 1
+            if os.fstat(self._fd).st_size >= self.compact_bytes:
+                self._compact_locked()
+        finally:
+            self.lock.release()
+
+    # ---- 回放与压缩 ----
+
+    @staticmethod
+    def _empty_state():
+        return {'gpu_usage': {}, 'tasks': {}}
+
+    def _read_snapshot(self):
+        """返回 (状态, 快照包含的最大版本号)"""
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            return snapshot['state'], snapshot.get('version') or 0
+        except FileNotFoundError:
+            return self._empty_state(), 0
+
+    def _read_records(self, base_version):
+        """日志中的记录（忽略快照已包含的版本），按版本号排序；没有版本号的旧记录按写入顺序排在最前"""
+        records = []
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # 写入中途崩溃留下的不完整记录
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                version = record.get('version')
+                if version is not None and version <= base_version:
+                    continue
+                record['line'] = line
+                records.append(record)
+        records.sort(key=lambda r: (r.get('version') is not None, r.get('version') or 0))
+        return records
+
+    @staticmethod
+    def apply(state, event, data):
+        """将一条事件应用到状态 {'gpu_usage': {服务器: {gpu: 用户}}, 'tasks': {容器: 任务}}"""
+        usage = state['gpu_usage']
+        tasks = state['tasks']
+        if event == 'allocate':
+            server = usage.setdefault(data['server'], {})
+            for gpu in data['gpus']:
+                server[gpu] = data['username']
+        elif event == 'release':
+            server = usage.get(data['server'], {})
+            for gpu in data['gpus']:
+                if data['username'] is None or server.get(gpu) == data['username']:
+                    server.pop(gpu, None)
+        elif event == 'add_task':
+            tasks[data['task']['container']] = dict(data['task'], username=data['username'])
+        elif event == 'remove_task':
+            task = data['task']
+            tasks.pop(task['container'], None)
+            server = usage.get(task['server'], {})
+            for gpu in task['gpus']:
+                if server.get(gpu) == data['username']:
+                    server.pop(gpu, None)
+        elif event == 'reset':
+            state['gpu_usage'] = data['gpu_usage']
+            state['tasks'] = data['tasks']
+
+    def _replay_locked(self):
+        state, base_version = self._read_snapshot()
+        for record in self._read_records(base_version):
+            self.apply(state, record['event'], record['data'])
+        return state
+
+    def replay(self):
+        """从快照和日志尾部重建当前状态"""
+        if not self.lock.acquire(timeout=10, shared=True):
+            raise TimeoutError("获取分配日志锁超时")
+        try:
+            return self._replay_locked()
+        finally:
+            self.lock.release()
+
+    def _compact_locked(self):
+        state, version = self._read_snapshot()
+        records = self._read_records(version)
+        now = time.time()
+        applied = 0
+        for record in records:
+            record_version = record.get('version')
+            if record_version is not None:
+                if record_version != version + 1 and now - record['ts'] < self.gap_timeout:
+                    break  # 缺少的记录可能还在其他进程中等待写入
+                version = record_version
+            self.apply(state, record['event'], record['data'])
+            applied += 1
+        kept = ''.join(record['line'] for record in records[applied:])
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'created_at': now, 'version': version, 'state': state}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.snapshot_file)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        # 原地截断而不是替换文件，其他进程持有的追加描述符仍然有效
+        os.ftruncate(self._fd, 0)
+        if kept:
+            os.write(self._fd, kept.encode('utf-8'))
+        os.fsync(self._fd)
+        self.stats['compactions'] += 1
+
+    def compact(self):
+        """立即将日志压缩为快照"""
+        if not self.lock.acquire(timeout=10):
+            raise TimeoutError("获取分配日志锁超时")
+        try:
+            self._compact_locked()
+        finally:
+            self.lock.release()
+
+    # ---- 与状态库对接 ----
+
+    def attach(self, state_store):
+        """开始记录状态库的修改；状态库为空而日志中有数据时先从日志恢复"""
+        _, tasks, usage = state_store.snapshot()
+        if not tasks and not any(usage.values()):
+            state = self.replay()
+            if state['tasks'] or any(state['gpu_usage'].values()):
+                state_store.load_state(state['gpu_usage'], [
+                    (task['username'], {k: v for k, v in task.items() if k != 'username'})
+                    for task in state['tasks'].values()
+                ])
+                print("已从分配日志恢复GPU分配和任务记录")
+        self.state_store = state_store
+        state_store.add_listener(self._on_state_change)
+
+    def _on_state_change(self, version, event, data):
+        if event == 'reset':
+            # 整体替换：记录替换后的完整状态
+            _, tasks, usage = self.state_store.snapshot()
+            data = {
+                'gpu_usage': usage,
+                'tasks': {task['container']: dict(task, username=username) for username, task in tasks}
+            }
+        self.append(event, data, version)
+
+    def close(self):
+        try:
+            os.close(self._fd)
+        except OSError:
+            pass
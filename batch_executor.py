@@ -0,0 +1,82 @@
+import shlex
+import uuid
+
+def build_script(commands, token, stop_on_error=False):
+    """把多条命令拼成一个远程sh脚本
+
+    每条命令在子shell中运行（cd、exit等不影响后续命令），前后在stdout和stderr上
+    各输出一行分隔标记，结束标记后附带退出码。标记前总是多输出一个换行，
+    解析时去掉，这样没有以换行结尾的输出也能原样还原。
+    """
+    lines = []
+    for i, command in enumerate(commands):
+        begin = f"__BATCH_{token}_BEGIN_{i}__"
+        end = f"__BATCH_{token}_END_{i}__"
+        lines.append(f"printf '%s\\n' '{begin}'; printf '%s\\n' '{begin}' >&2")
+        lines.append(f"(\n{command}\n) </dev/null")
+        lines.append("__rc=$?")
+        lines.append(f"printf '\\n%s %d\\n' '{end}' \"$__rc\"; printf '\\n%s\\n' '{end}' >&2")
+        if stop_on_error:
+            lines.append('[ "$__rc" -eq 0 ] || exit 0')
+    return '\n'.join(lines) + '\n'
+
+def batch_command(commands, stop_on_error=False):
+    """生成执行整个批次的命令，返回 (分隔标记token, 命令)；用 sh 执行，不依赖登录shell的类型"""
+    token = uuid.uuid4().hex[:12]
+    return token, f"sh -c {shlex.quote(build_script(commands, token, stop_on_error))}"
+
+def _extract(text, begin, end):
+    """返回 (两个标记之间的内容, 结束标记所在行的剩余部分)；标记不存在时返回 (None, None)"""
+    start = text.find(begin + '\n')
+    if start < 0:
+        return None, None
+    start += len(begin) + 1
+    stop = text.find('\n' + end, start)
+    if stop < 0:
+        return text[start:], None
+    rest_start = stop + 1 + len(end)
+    rest_end = text.find('\n', rest_start)
+    rest = text[rest_start:rest_end if rest_end >= 0 else len(text)]
+    return text[start:stop], rest
+
+def parse_output(commands, token, stdout, stderr):
+    """按分隔标记拆分批量脚本的输出"""
+    results = []
+    for i, command in enumerate(commands):
+        begin = f"__BATCH_{token}_BEGIN_{i}__"
+        end = f"__BATCH_{token}_END_{i}__"
+        out, rest = _extract(stdout, begin, end)
+        err, _ = _extract(stderr, begin, end)
+        exit_status = None
+        if rest is not None:
+            try:
+                exit_status = int(rest.strip())
+            except ValueError:
+                pass
+        results.append({
+            'command': command,
+            'stdout': out or '',
+            'stderr': err or '',
+            'exit_status': exit_status  # None表示命令未执行（前面的命令失败）或未执行完
+        })
+    return results
+
+def run_batch(ssh, commands, timeout=None, stop_on_error=False):
+    """在一次exec_command（一个通道、一次往返）中执行多条命令
+
+    Args:
+        ssh: SSH连接（paramiko.SSHClient或兼容对象）
+        commands: 命令列表
+        timeout: 整个批次的超时时间（秒）
+        stop_on_error: 为True时某条命令退出码非0后不再执行后续命令
+    Returns:
+        每条命令一个字典：command、stdout、stderr、exit_status
+    """
+    commands = list(commands)
+    if not commands:
+        return []
+    token, command = batch_command(commands, stop_on_error)
+    stdin, stdout, stderr = ssh.exec_command(command, timeout=timeout)
+    out = stdout.read().decode('utf-8', errors='replace')
+    err = stderr.read().decode('utf-8', errors='replace')
+    return parse_output(commands, token, out, err)
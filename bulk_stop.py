@@ -0,0 +1,129 @@
+import re
+import shlex
+from container_labels import name_filter
+
+
+def stop_command(names, grace=0):
+    """一台服务器上停止并删除一组容器的命令
+
+    grace为0时直接 docker rm -f；否则先 docker stop -t grace（各容器并行停止），再删除。
+    docker rm -f 对每个删除成功的容器输出一行容器名，失败的写入stderr。
+    """
+    quoted = ' '.join(shlex.quote(name) for name in names)
+    if grace:
+        return f"docker stop -t {int(grace)} {quoted} >/dev/null; docker rm -f {quoted}"
+    return f"docker rm -f {quoted}"
+
+
+def remaining_command(names):
+    """列出这些容器中仍然存在的（包括已停止的），每行一个容器名"""
+    return f"docker ps -a {name_filter(names)} --format '{{{{.Names}}}}'"
+
+
+def parse_stop_output(names, result):
+    """按fanout的结果确定每个容器是否已删除，返回 {容器名: 错误信息或None}"""
+    if result['status'] != 'ok':
+        return {name: result['error'] for name in names}
+    removed = set(line.strip() for line in result['stdout'].splitlines())
+    errors = [line.strip() for line in result['stderr'].splitlines() if line.strip()]
+    outcome = {}
+    for name in names:
+        if name in removed:
+            outcome[name] = None
+            continue
+        pattern = re.compile(r'(?<![\w.-])/?' + re.escape(name) + r'(?![\w.-])')
+        messages = [line for line in errors if pattern.search(line)]
+        outcome[name] = '; '.join(messages) or '容器未被删除'
+    return outcome
+
+
+class BulkStopper:
+    """批量停止并删除容器
+
+    每台服务器只执行一条命令处理该服务器上所有选中的容器，各服务器并发执行（ClusterFanout，
+    占用各服务器的Docker control通道）；删除成功的容器在一个状态事务中释放GPU、删除任务记录。
+    超过截止时间或执行出错的服务器上，docker rm 可能仍在执行或已经成功，再查询一次这些容器
+    是否还存在，已不存在的同样视为删除成功。
+
+    容器的主进程是 tail -f /dev/null，作为PID 1不处理SIGTERM，docker stop 总要等满宽限期，
+    因此默认 grace=0，直接 docker rm -f。
+    """
+
+    def __init__(self, fanout, gpu_manager, grace=0, deadline=60):
+        self.fanout = fanout
+        self.gpu_manager = gpu_manager
+        self.grace = grace
+        self.deadline = deadline
+
+    def stop(self, servers, tasks, operation='bulk_stop', on_result=None):
+        """停止tasks（任务列表中的项：server、name，可选owner、gpus），返回每个容器的结果
+
+        结果为 [{server, name, ok, error}]，顺序与tasks相同；on_result(结果) 在每个容器有结果时调用。
+        """
+        by_server = {}
+        outcomes = {}
+        for task in tasks:
+            if task['server'] in servers:
+                by_server.setdefault(task['server'], []).append(task)
+            else:
+                outcome = outcomes[(task['server'], task['name'])] = {
+                    'server': task['server'], 'name': task['name'], 'ok': False, 'error': '服务器不存在'
+                }
+                if on_result:
+                    on_result(outcome)
+        targets = {name: servers[name] for name in by_server}
+        commands = {
+            name: stop_command([task['name'] for task in server_tasks], self.grace)
+            for name, server_tasks in by_server.items()
+        }
+
+        unresolved = {}  # 服务器名 -> 超时或出错的结果，结果待再次查询后确定
+
+        def report(server_name, errors):
+            for name, error in errors.items():
+                outcome = outcomes[(server_name, name)] = {
+                    'server': server_name, 'name': name, 'ok': error is None, 'error': error
+                }
+                if on_result:
+                    on_result(outcome)
+
+        def handle(result):
+            server_name = result['server']
+            if result['status'] != 'ok':
+                unresolved[server_name] = result
+                return
+            names = [task['name'] for task in by_server[server_name]]
+            report(server_name, parse_stop_output(names, result))
+
+        if targets:
+            self.fanout.run(targets, commands, deadline=self.deadline + self.grace,
+                            operation=operation, on_result=handle, lane='control')
+        if unresolved:
+            self._recheck(unresolved, by_server, servers, operation, report)
+
+        stopped = [
+            (task['server'], task['name'], task.get('owner'), task.get('gpus'))
+            for task in tasks if outcomes[(task['server'], task['name'])]['ok']
+        ]
+        if stopped:
+            self.gpu_manager.release_stopped_containers(stopped)
+        return [outcomes[(task['server'], task['name'])] for task in tasks]
+
+    def _recheck(self, unresolved, by_server, servers, operation, report):
+        """再次查询超时或出错的服务器，已不存在的容器视为删除成功，查询失败时保留原来的错误"""
+        names = {server_name: [task['name'] for task in by_server[server_name]] for server_name in unresolved}
+        results = self.fanout.run(
+            {server_name: servers[server_name] for server_name in unresolved},
+            {server_name: remaining_command(server_names) for server_name, server_names in names.items()},
+            deadline=self.deadline, operation=f"{operation}_recheck", lane='query'
+        )
+        for server_name, server_names in names.items():
+            result = results[server_name]
+            original_error = unresolved[server_name]['error']
+            if result['status'] != 'ok' or result['exit_status'] != 0:
+                report(server_name, dict.fromkeys(server_names, original_error))
+                continue
+            present = set(line.strip() for line in result['stdout'].splitlines())
+            report(server_name, {
+                name: original_error if name in present else None for name in server_names
+            })
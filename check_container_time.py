@@ -1,5 +1,3 @@
-import yaml
-import paramiko
 import time
 import os
 from datetime import datetime, timedelta
@@ -7,25 +5,48 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from log_manager import LogManager
+from config_manager import ConfigManager
+from state_store import StateStore
+from index_manager import IndexManager
+from ssh_manager import SSHManager
+from ssh_broker import SOCKET_FILE as SSH_BROKER_SOCKET
+from allocation_journal import AllocationJournal
+from cluster_fanout import ClusterFanout
+from docker_api import DockerAPIManager
+from docker_manager import DockerManager
+from container_labels import PS_LABEL_FORMAT, labels_from_fields, parse_labels
+from health_manager import HealthManager
 
 class ContainerTimeChecker:
     def __init__(self):
+        # 获取脚本所在目录的绝对路径
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.config_manager = ConfigManager(os.path.join(script_dir, 'config.yaml'))
+        self.state_store = StateStore(os.path.join(script_dir, 'state.db'))
+        self.state_store.migrate_from_config(self.config_manager)
+        self.allocation_journal = AllocationJournal(os.path.join(script_dir, 'allocations.journal'))
+        self.allocation_journal.attach(self.state_store)
+        self.index_manager = IndexManager(self.config_manager, self.state_store)
         self.config = self.load_config()
-        self.ssh_connections = {}
+        self.ssh_manager = SSHManager()
+        # 本地SSH代理（ssh_broker.py）在运行时复用它持有的连接，否则直连
+        self.ssh_manager.use_broker(SSH_BROKER_SOCKET)
+        # 与main.py共享主机熔断状态，已知不可达的主机不再每次等待连接超时
+        self.health_manager = HealthManager(os.path.join(script_dir, 'host_health.json'))
+        self.ssh_manager.set_health_manager(self.health_manager)
+        self.docker_manager = DockerManager()
+        self.fanout = ClusterFanout(self.ssh_manager, docker_manager=self.docker_manager)
+        self.query_deadline = 30
+        self.docker_api = DockerAPIManager(self.ssh_manager)
 
     def load_config(self):
         """加载配置文件"""
         try:
-            # 获取脚本所在目录的绝对路径
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            config_path = os.path.join(script_dir, 'config.yaml')
-            
-            print(f"尝试加载配置文件：{config_path}")
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config = yaml.safe_load(f)
-                if config is None:
-                    raise ValueError("配置文件为空")
-                return config
+            print(f"尝试加载配置文件：{self.config_manager.config_file}")
+            config = self.config_manager.load_config()
+            if config is None:
+                raise ValueError("配置文件为空")
+            return config
         except Exception as e:
             print(f"加载配置文件失败：{str(e)}")
             return None
@@ -33,86 +54,100 @@ class ContainerTimeChecker:
     def connect_to_server(self, server_name):
         """连接到服务器"""
         try:
-            if server_name in self.ssh_connections:
-                return self.ssh_connections[server_name]
-
             server = self.config['servers'][server_name]
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(
-                hostname=server['host'],
-                port=server['port'],
-                username=server['username'],
-                password=server['password'],
-                timeout=10
-            )
-            self.ssh_connections[server_name] = ssh
+            ssh = self.ssh_manager.get_connection(server, 'check_container_time')
+            if ssh is None:
+                raise ConnectionError("无法建立SSH连接")
             return ssh
         except Exception as e:
             print(f"连接服务器 {server_name} 失败：{str(e)}")
             return None
 
+    def _append_container(self, container_info, server_name, container_id, name, status, running_hours,
+                          labels=None):
+        """确定容器所属用户，属于已配置用户时加入列表"""
+        # 所属用户和时间限制取自创建容器时附加的标签；没有标签的旧容器查任务记录
+        info = parse_labels(labels)
+        if info is not None:
+            user, time_limit = info['owner'], info['time_limit']
+        else:
+            user, _ = self.index_manager.get_task(name)
+            time_limit = None
+            if user is None:  # 不是用户创建的容器，跳过
+                return
+        
+        # 检查用户名是否在配置文件中
+        if user not in self.config['users']:
+            return
+        
+        container_info.append({
+            'server': server_name,
+            'container_id': container_id,
+            'name': name,
+            'user': user,
+            'status': status,
+            'running_hours': running_hours,
+            'time_limit': time_limit
+        })
+
+    @staticmethod
+    def _parse_running_for(running_for):
+        """解析docker ps的RunningFor文本（如 3 hours ago），返回小时数，无法解析时抛出ValueError"""
+        if 'hours' in running_for:
+            return float(running_for.split('hours')[0].strip())
+        elif 'minutes' in running_for:
+            return float(running_for.split('minutes')[0].strip()) / 60
+        return 0
+
     def get_container_info(self):
         """获取所有服务器上的容器信息"""
         container_info = []
-        for server_name in self.config['servers']:
-            ssh = self.connect_to_server(server_name)
-            if not ssh:
-                continue
+        servers = self.config['servers']
 
-            try:
-                # 使用不同的格式获取容器信息，包括启动时间
-                cmd = "docker ps --format '{{.ID}}\t{{.Names}}\t{{.Status}}\t{{.RunningFor}}'"
-                stdin, stdout, stderr = ssh.exec_command(cmd)
-                output = stdout.read().decode()
+        # 优先使用Docker Engine API：精确的启动时间（StartedAt），不需要解析文本
+        api_results = self.docker_api.query_all(
+            servers, 'list_containers_detailed', deadline=self.query_deadline
+        )
+        now = time.time()
+        for server_name, containers in api_results.items():
+            for container in containers:
+                started_at = container['started_at'] or container['created']
+                running_hours = (now - started_at) / 3600 if started_at else 0
+                self._append_container(container_info, server_name, container['container_id'],
+                                       container['name'], container['status'], running_hours,
+                                       container['labels'])
+
+        # Docker API不可用的服务器执行docker ps，所有服务器并发查询
+        remaining = {name: info for name, info in servers.items() if name not in api_results}
+        cmd = "docker ps --format '{{.ID}}\t{{.Names}}\t{{.Status}}\t{{.RunningFor}}\t" + PS_LABEL_FORMAT + "'"
+        results = self.fanout.run(remaining, cmd, deadline=self.query_deadline,
+                                  operation='check_container_time') if remaining else {}
+        for server_name in remaining:
+            result = results[server_name]
+            if result['status'] != 'ok':
+                print(f"获取服务器 {server_name} 的容器信息失败：{result['error']}")
+                continue
+            output = result['stdout']
 
-                for line in output.strip().split('\n'):
-                    if line and not line == '':
+            for line in output.strip().split('\n'):
+                if line and not line == '':
+                    try:
+                        fields = line.split('\t')
+                        container_id, name, status, running_for = fields[:4]
+                        labels = labels_from_fields(fields[4:])
+                        created_at = (parse_labels(labels) or {}).get('created_at')
                         try:
-                            container_id, name, status, running_for = line.split('\t')
-                            
-                            # 检查容器名称是否符合用户容器的命名规则
-                            name_parts = name.split('-')
-                            if len(name_parts) != 3:  # 不是用户创建的容器，跳过
-                                continue
-                            
-                            # 检查用户名是否在配置文件中
-                            user = name_parts[0]
-                            if user not in self.config['users']:
-                                continue
-                            
-                            # 解析运行时间
-                            running_hours = 0
-                            if 'hours' in running_for:
-                                hours = running_for.split('hours')[0].strip()
-                                try:
-                                    running_hours = float(hours)
-                                except ValueError:
-                                    print(f"解析容器 {name} 的运行时间失败")
-                                    continue
-                            elif 'minutes' in running_for:
-                                minutes = running_for.split('minutes')[0].strip()
-                                try:
-                                    running_hours = float(minutes) / 60
-                                except ValueError:
-                                    print(f"解析容器 {name} 的运行时间失败")
-                                    continue
-                                
-                            container_info.append({
-                                'server': server_name,
-                                'container_id': container_id,
-                                'name': name,
-                                'user': user,
-                                'status': status,
-                                'running_hours': running_hours
-                            })
-                            
-                        except Exception as e:
-                            print(f"处理容器信息失败：{str(e)}")
+                            # 有创建时间标签时直接计算，不解析RunningFor文本
+                            running_hours = ((now - created_at) / 3600 if created_at
+                                             else self._parse_running_for(running_for))
+                        except ValueError:
+                            print(f"解析容器 {name} 的运行时间失败")
                             continue
-                            
-            except Exception as e:
-                print(f"获取服务器 {server_name} 的容器信息失败：{str(e)}")
+                        self._append_container(container_info, server_name, container_id, name, status,
+                                               running_hours, labels)
+                    except Exception as e:
+                        print(f"处理容器信息失败：{str(e)}")
+                        continue
 
         return container_info
 
@@ -120,22 +155,21 @@ class ContainerTimeChecker:
         """停止指定的容器"""
         try:
             print(f"\n正在停止容器 {container_name}...")
+            server_info = self.config['servers'][server_name]
             stop_cmd = f"docker stop {container_name}"
-            stdin, stdout, stderr = ssh.exec_command(stop_cmd)
-            error = stderr.read().decode()
+            _, error = self.docker_manager.execute_command(ssh, server_info, stop_cmd)
             if error:
                 print(f"停止容器失败：{error}")
                 return False
 
             print("正在删除容器...")
             rm_cmd = f"docker rm {container_name}"
-            stdin, stdout, stderr = ssh.exec_command(rm_cmd)
-            error = stderr.read().decode()
+            _, error = self.docker_manager.execute_command(ssh, server_info, rm_cmd)
             if error:
                 print(f"删除容器失败：{error}")
                 return False
 
-            # 从配置文件中删除相关记录
+            # 删除相关任务记录
             self._remove_task_record(container_name)
             
             print(f"容器 {container_name} 已成功停止并删除")
@@ -145,35 +179,13 @@ class ContainerTimeChecker:
             return False
 
     def _remove_task_record(self, container_name):
-        """从配置文件中删除任务记录"""
+        """删除任务记录"""
         try:
-            if 'task_records' not in self.config:
-                return
-            
-            # 遍历所有用户的任务记录
-            for username, tasks in self.config['task_records'].items():
-                # 使用列表推导式过滤掉要删除的容器记录
-                self.config['task_records'][username] = [
-                    task for task in tasks 
-                    if task['container'] != container_name
-                ]
-            
-            # 保存更新后的配置
-            self._save_config()
+            # 按行删除记录，同时释放该任务占用的GPU
+            self.state_store.remove_task_record(container_name)
         except Exception as e:
             print(f"更新任务记录失败：{str(e)}")
 
-    def _save_config(self):
-        """保存配置到文件"""
-        try:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            config_path = os.path.join(script_dir, 'config.yaml')
-            
-            with open(config_path, 'w', encoding='utf-8') as f:
-                yaml.dump(self.config, f, allow_unicode=True)
-        except Exception as e:
-            print(f"保存配置文件失败：{str(e)}")
-
     def send_email(self, to_email, subject, body):
         """发送邮件"""
         try:
@@ -212,45 +224,26 @@ class ContainerTimeChecker:
     def clean_task_records(self):
         """清理不存在的容器记录"""
         try:
-            if 'task_records' not in self.config:
-                return
-            
-            # 获取所有正在运行的容器名称
-            running_containers = set()
+            # 获取各服务器上正在运行的容器名称；无法连接或查询失败的服务器不清理其记录
+            running_containers = {}
             for server_name in self.config['servers']:
                 ssh = self.connect_to_server(server_name)
                 if not ssh:
                     continue
                 
                 cmd = "docker ps --format '{{.Names}}'"
-                stdin, stdout, stderr = ssh.exec_command(cmd)
-                containers = stdout.read().decode().strip().split('\n')
-                running_containers.update(containers)
-            
-            # 清理每个用户的任务记录
-            cleaned = False
-            for username in list(self.config['task_records'].keys()):
-                if not self.config['task_records'][username]:
+                host = self.docker_manager.host_of(self.config['servers'][server_name])
+                with self.docker_manager.lane(host, cmd):
+                    stdin, stdout, stderr = ssh.exec_command(cmd)
+                    output = stdout.read().decode()
+                    exit_status = stdout.channel.recv_exit_status()
+                if exit_status != 0:
+                    print(f"获取服务器 {server_name} 的容器列表失败，跳过清理其任务记录")
                     continue
-                
-                # 过滤出仍在运行的容器记录
-                valid_tasks = [
-                    task for task in self.config['task_records'][username]
-                    if task['container'] in running_containers
-                ]
-                
-                # 如果有记录被清理
-                if len(valid_tasks) != len(self.config['task_records'][username]):
-                    cleaned = True
-                    if valid_tasks:
-                        self.config['task_records'][username] = valid_tasks
-                    else:
-                        # 如果用户没有有效记录，删除整个用户记录
-                        del self.config['task_records'][username]
+                running_containers[server_name] = set(output.split())
             
-            # 如果有记录被清理，保存配置文件
-            if cleaned:
-                self._save_config()
+            # 删除容器已不在运行的记录，并释放这些任务持有的GPU
+            if self.state_store.retain_task_records(running_containers):
                 print("已清理过期的任务记录")
             
         except Exception as e:
@@ -278,13 +271,14 @@ class ContainerTimeChecker:
                         print(f"跳过未知用户的容器：{container['name']}")
                         continue
                     
-                    # 获取用户组的时间限制
-                    user_group = self.config['users'][user].get('group', 'default')
-                    if user_group not in self.config['user_groups']:
-                        print(f"用户 {user} 的用户组 {user_group} 不存在，使用默认组")
-                        user_group = 'default'
-                    
-                    time_limit = self.config['user_groups'][user_group]['time_limit']
+                    # 时间限制取自容器标签（创建时用户组的限制），没有标签时使用用户组当前的时间限制
+                    time_limit = container.get('time_limit')
+                    if time_limit is None:
+                        user_group = self.config['users'][user].get('group', 'default')
+                        if user_group not in self.config['user_groups']:
+                            print(f"用户 {user} 的用户组 {user_group} 不存在，使用默认组")
+                            user_group = 'default'
+                        time_limit = self.config['user_groups'][user_group]['time_limit']
                     running_hours = container['running_hours']
                     
                     print(f"\n检查容器：{container['name']}")
@@ -309,11 +303,11 @@ class ContainerTimeChecker:
             print(f"检查容器运行时间失败：{str(e)}")
         finally:
             # 清理SSH连接
-            for ssh in self.ssh_connections.values():
-                try:
-                    ssh.close()
-                except:
-                    pass
+            for operation, stats in self.ssh_manager.get_operation_stats().items():
+                print(f"SSH连接复用（{operation}）：取用 {stats['checkouts']} 次，避免握手 {stats['handshakes_avoided']} 次")
+            self.fanout.close()
+            self.docker_api.close_all()
+            self.ssh_manager.close_all()
 
 def main():
     # 获取脚本所在目录
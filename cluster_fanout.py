@@ -0,0 +1,236 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from batch_executor import batch_command, parse_output
+from command_metrics import CommandMetrics
+
+class ClusterFanout:
+    """基于asyncio的集群命令分发
+
+    在所有（或指定的）服务器上执行同一条命令，结果按到达顺序返回，整个查询有统一的截止时间。
+    截止时间到达时仍未返回的服务器标记为超时，不会拖住调用方。
+
+    - 启用了本地SSH代理时，通过asyncio的Unix socket请求代理执行，不占用线程
+    - 直连时，命令输出通过 channel.fileno() 注册到事件循环读取；只有建立连接、
+      打开通道这些阻塞的paramiko调用放在一个大小固定的线程池中执行，
+      服务器数量再多也不会每台服务器占用一个线程
+    - 设置了docker_manager时，每台服务器上的命令先占用该服务器对应的Docker命令通道
+      （query/control/long，见docker_manager.py），与同一进程中的其他Docker操作共享并发上限
+    """
+
+    def __init__(self, ssh_manager, max_connect_workers=16, docker_manager=None):
+        self.ssh_manager = ssh_manager
+        self.docker_manager = docker_manager
+        self._executor = ThreadPoolExecutor(max_workers=max_connect_workers)
+
+    # ---- 单台服务器 ----
+
+    def _open_channel(self, server_info, command, operation, timeout):
+        """（在线程池中执行）占用通道名额，打开会话并启动命令"""
+        lease = self.ssh_manager.acquire_channel(server_info, operation, timeout=timeout)
+        try:
+            channel = lease['ssh'].get_transport().open_session(timeout=timeout)
+            channel.exec_command(command)
+        except Exception:
+            self.ssh_manager.release_channel(server_info, lease)
+            raise
+        return lease, channel
+
+    def _close_channel(self, server_info, lease, channel):
+        try:
+            channel.close()
+        except Exception:
+            pass
+        self.ssh_manager.release_channel(server_info, lease)
+
+    async def _read_channel(self, channel):
+        """在事件循环中读取通道输出，直到命令结束
+
+        channel.fileno() 的管道只在收到标准输出或EOF时变为可读，EOF之后一直保持可读：
+        收到EOF后立即取消注册并读完剩余输出，退出码在线程池中等待，不在事件循环中空转。
+        """
+        loop = asyncio.get_running_loop()
+        eof = loop.create_future()
+        out, err = [], []
+
+        def drain():
+            while channel.recv_ready():
+                out.append(channel.recv(65536))
+            while channel.recv_stderr_ready():
+                err.append(channel.recv_stderr(65536))
+
+        def on_readable():
+            try:
+                drain()
+                if (channel.eof_received or channel.closed) and not eof.done():
+                    eof.set_result(None)
+            except Exception as e:
+                if not eof.done():
+                    eof.set_exception(e)
+
+        fd = channel.fileno()
+        loop.add_reader(fd, on_readable)
+        try:
+            on_readable()  # 注册前可能已有数据
+            await eof
+        finally:
+            loop.remove_reader(fd)
+        drain()
+        if channel.exit_status_ready():
+            exit_status = channel.recv_exit_status()
+        elif channel.closed:
+            exit_status = -1
+        else:
+            # 退出码在EOF之后到达；通道关闭（包括截止时间到达后关闭）时recv_exit_status也会返回
+            exit_status = await loop.run_in_executor(None, channel.recv_exit_status)
+        return b''.join(out), b''.join(err), exit_status
+
+    async def _exec_direct(self, server_info, command, operation, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._executor, self._open_channel, server_info, command, operation, timeout
+        )
+        try:
+            lease, channel = await future
+        except asyncio.CancelledError:
+            # 截止时间已到，连接仍在线程池中建立：完成后归还通道名额，连接留在池中供下次使用
+            def cleanup(f):
+                if not f.cancelled() and f.exception() is None:
+                    self._close_channel(server_info, *f.result())
+            future.add_done_callback(cleanup)
+            raise
+        try:
+            return await self._read_channel(channel)
+        finally:
+            self._close_channel(server_info, lease, channel)
+
+    async def _acquire_lane(self, server_info, command, lane, timeout):
+        """占用Docker命令通道的名额；名额已满时在默认线程池中等待，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        host = self.docker_manager.host_of(server_info)
+        future = loop.run_in_executor(None, self.docker_manager.acquire, host, command, timeout, lane)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # 截止时间已到：等待中的线程拿到名额后立即归还
+            def cleanup(f):
+                if not f.cancelled() and f.exception() is None:
+                    self.docker_manager.release(f.result())
+            future.add_done_callback(cleanup)
+            raise
+
+    async def exec_one(self, name, server_info, command, operation=None, timeout=10, lane=None):
+        """在一台服务器上执行命令，返回结果字典（不抛出异常）
+
+        lane为Docker命令通道名（query/control/long），为None时按命令分类。
+        """
+        start = time.monotonic()
+        result = {'server': name, 'status': 'ok', 'stdout': '', 'stderr': '', 'exit_status': None, 'error': None}
+        lane_state = None
+        waiting_lane = self.docker_manager is not None
+        try:
+            if waiting_lane:
+                lane_state = await self._acquire_lane(server_info, command, lane, timeout)
+                waiting_lane = False
+            broker = self.ssh_manager.get_broker()
+            if broker:
+                try:
+                    out, err, exit_status = await broker.exec_command_async(
+                        server_info, command, timeout=timeout, operation=operation
+                    )
+                except ConnectionError:
+                    out, err, exit_status = await self._exec_direct(server_info, command, operation, timeout)
+            else:
+                out, err, exit_status = await self._exec_direct(server_info, command, operation, timeout)
+            result['stdout'] = out.decode('utf-8', errors='replace')
+            result['stderr'] = err.decode('utf-8', errors='replace')
+            result['exit_status'] = exit_status
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = str(e) or type(e).__name__
+            if not waiting_lane:  # 等待Docker命令通道超时与连接无关
+                self.ssh_manager.report_failure(server_info)
+        finally:
+            if lane_state is not None:
+                self.docker_manager.release(lane_state)
+        result['elapsed'] = time.monotonic() - start
+        CommandMetrics().record_command(
+            self.ssh_manager._key(server_info), command, result['elapsed'],
+            ok=result['status'] == 'ok' and result['exit_status'] == 0
+        )
+        return result
+
+    # ---- 多台服务器 ----
+
+    async def stream(self, servers, command, deadline=10, operation=None, lane=None):
+        """异步生成器：按完成顺序产出每台服务器的结果
+
+        servers为 {服务器名: 服务器信息}；deadline秒后仍未完成的服务器以 status='timeout' 产出。
+        command为 {服务器名: 命令} 时每台服务器执行各自的命令。
+        """
+        commands = command if isinstance(command, dict) else dict.fromkeys(servers, command)
+        tasks = {
+            asyncio.ensure_future(
+                self.exec_one(name, info, commands[name], operation, timeout=deadline, lane=lane)
+            ): name
+            for name, info in servers.items()
+        }
+        end = time.monotonic() + deadline
+        pending = set(tasks)
+        try:
+            while pending:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        for task in pending:
+            CommandMetrics().record_command(
+                self.ssh_manager._key(servers[tasks[task]]), commands[tasks[task]], deadline, ok=False
+            )
+            yield {
+                'server': tasks[task], 'status': 'timeout', 'stdout': '', 'stderr': '',
+                'exit_status': None, 'error': f"{deadline}秒内未响应", 'elapsed': deadline
+            }
+
+    async def _collect(self, servers, command, deadline, operation, on_result, lane):
+        results = {}
+        async for result in self.stream(servers, command, deadline, operation, lane):
+            results[result['server']] = result
+            if on_result:
+                on_result(result)
+        return results
+
+    def run(self, servers, command, deadline=10, operation=None, on_result=None, lane=None):
+        """同步接口：在所有服务器上执行命令，返回 {服务器名: 结果}
+
+        on_result(result) 在每个结果到达时调用，可用于逐条显示。
+        command可以是 {服务器名: 命令}，每台服务器执行不同的命令（如各自要停止的容器）。
+        lane指定Docker命令通道（默认按命令分类）。
+        """
+        return asyncio.run(self._collect(servers, command, deadline, operation, on_result, lane))
+
+    def run_batch(self, servers, commands, deadline=10, operation=None, on_result=None, lane=None):
+        """在所有服务器上执行一组命令（每台服务器一次往返），结果中 'results' 为每条命令的结果列表"""
+        token, command = batch_command(commands)
+
+        def handle(result):
+            result['results'] = (
+                parse_output(commands, token, result['stdout'], result['stderr'])
+                if result['status'] == 'ok' else None
+            )
+            if on_result:
+                on_result(result)
+
+        return self.run(servers, command, deadline, operation, on_result=handle, lane=lane)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
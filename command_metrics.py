@@ -0,0 +1,276 @@
+import json
+import os
+import re
+import shlex
+import threading
+import time
+from collections import deque
+
+# 直方图桶的上界（毫秒），最后一个桶为无穷大
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, float('inf')]
+
+COMMAND_TYPES = [
+    ('nvidia-smi', re.compile(r'^\s*nvidia-smi\b')),
+    ('docker ps', re.compile(r'^\s*docker\s+ps\b')),
+    ('docker run', re.compile(r'^\s*docker\s+run\b')),
+    ('docker pull', re.compile(r'^\s*docker\s+pull\b')),
+    ('docker images', re.compile(r'^\s*docker\s+images\b')),
+    ('docker stop/rm', re.compile(r'^\s*docker\s+(stop|rm|kill)\b')),
+    ('docker login', re.compile(r'^\s*docker\s+login\b')),
+    ('docker', re.compile(r'^\s*docker\b')),
+]
+
+_BATCH_PART = re.compile(r'\(\n(.*?)\n\) </dev/null', re.S)
+_SECRET = re.compile(r'(\s(?:-p|--password)(?:\s+|=))(\S+)')
+# echo 密码 | docker login ... --password-stdin 形式中管道前的密码
+_PIPED_SECRET = re.compile(r'((?:^|[;&|(]\s*)(?:echo|printf)\s+)(.*?)(\s*\|\s*(?:sudo\s+)?docker\s+login\b)', re.S)
+
+
+def _batch_parts(command):
+    """batch_executor生成的批量脚本中的各条命令，不是批量脚本时返回None"""
+    if '__BATCH_' not in command or not command.startswith('sh -c '):
+        return None
+    try:
+        script = shlex.split(command)[2]
+    except (ValueError, IndexError):
+        return None
+    return _BATCH_PART.findall(script)
+
+
+def _classify_one(command):
+    # 管道命令按第一段能识别的命令分类（如 echo 密码 | docker login、docker ps | grep）
+    for segment in command.split('|'):
+        for name, pattern in COMMAND_TYPES:
+            if pattern.search(segment):
+                return name
+    return 'other'
+
+
+def classify(command):
+    """命令类型：nvidia-smi、docker ps、docker run、docker pull等；批量脚本为 batch(类型+类型)"""
+    parts = _batch_parts(command)
+    if parts is not None:
+        return 'batch(' + '+'.join(_classify_one(part) for part in parts) + ')'
+    return _classify_one(command)
+
+
+def describe(command, limit=200):
+    """用于日志的命令文本：批量脚本只保留各条命令，隐藏密码（-p/--password参数和通过管道传给docker login的），过长时截断"""
+    parts = _batch_parts(command)
+    text = '; '.join(parts) if parts is not None else command
+    text = _SECRET.sub(r'\1***', ' '.join(text.split()))
+    text = _PIPED_SECRET.sub(r'\1***\3', text)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.errors = 0
+        self.slow = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms, ok, slow):
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        if not ok:
+            self.errors += 1
+        if slow:
+            self.slow += 1
+
+    def percentile(self, p):
+        """按桶估计分位数（返回桶上界，最后一个桶返回最大值）"""
+        if not self.count:
+            return 0.0
+        target = self.count * p
+        seen = 0
+        for bound, n in zip(BUCKETS_MS, self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'slow': self.slow,
+            'avg_ms': self.total / self.count if self.count else 0.0,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'buckets': {('inf' if bound == float('inf') else str(bound)): n
+                        for bound, n in zip(BUCKETS_MS, self.counts) if n}
+        }
+
+
+class CommandMetrics:
+    """远程命令延迟统计（进程内单例）
+
+    按主机和命令类型分别记录延迟直方图，超过 slow_threshold 秒的命令写入慢命令日志。
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._histograms = {}  # (主机, 命令类型) -> _Histogram
+                    instance._slow_log = deque(maxlen=100)
+                    instance.slow_threshold = 2.0
+                    instance.log_manager = None
+                    instance.started_at = time.time()
+                    cls._instance = instance
+        return cls._instance
+
+    def set_log_manager(self, log_manager):
+        self.log_manager = log_manager
+
+    def record(self, host, command_type, seconds, command=None, ok=True):
+        ms = seconds * 1000
+        slow = seconds >= self.slow_threshold
+        with self._lock:
+            histogram = self._histograms.get((host, command_type))
+            if histogram is None:
+                histogram = self._histograms[(host, command_type)] = _Histogram()
+            histogram.add(ms, ok, slow)
+            if slow:
+                entry = {
+                    'time': time.time(), 'host': host, 'type': command_type,
+                    'seconds': round(seconds, 3), 'ok': ok,
+                    'command': describe(command) if command else None
+                }
+                self._slow_log.append(entry)
+        if slow and self.log_manager:
+            self.log_manager.log_info(
+                f"慢命令 {host} [{command_type}] {seconds:.2f}秒"
+                f"{'' if ok else '（失败）'}：{entry['command'] or ''}"
+            )
+
+    def record_command(self, host, command, seconds, ok=True):
+        self.record(host, classify(command), seconds, command, ok)
+
+    def snapshot(self):
+        """可序列化为JSON的统计快照"""
+        with self._lock:
+            histograms = [
+                dict(histogram.to_dict(), host=host, type=command_type)
+                for (host, command_type), histogram in sorted(self._histograms.items())
+            ]
+            slow_log = list(self._slow_log)
+        return {
+            'since': self.started_at,
+            'generated_at': time.time(),
+            'slow_threshold': self.slow_threshold,
+            'histograms': histograms,
+            'slow_commands': slow_log
+        }
+
+    def dump(self, path):
+        """把统计快照写入JSON文件"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+
+class _TimedCall:
+    """一次exec_command的计时：输出读完或查询退出码时结束（只记录一次）"""
+
+    def __init__(self, host, command):
+        self.host = host
+        self.command = command
+        self.start = time.perf_counter()
+        self.done = False
+
+    def finish(self, exit_status=None):
+        if self.done:
+            return
+        self.done = True
+        CommandMetrics().record_command(
+            self.host, self.command, time.perf_counter() - self.start,
+            ok=exit_status is None or exit_status == 0
+        )
+
+
+class _TimedChannel:
+    def __init__(self, channel, call):
+        self._channel = channel
+        self._call = call
+
+    def recv_exit_status(self):
+        status = self._channel.recv_exit_status()
+        self._call.finish(status)
+        return status
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+
+class _TimedStream:
+    def __init__(self, stream, call):
+        self._stream = stream
+        self._call = call
+        self.channel = _TimedChannel(stream.channel, call)
+
+    def _finish(self):
+        channel = self._stream.channel
+        self._call.finish(channel.recv_exit_status() if channel.exit_status_ready() else None)
+
+    def read(self, size=None):
+        data = self._stream.read() if size is None or size < 0 else self._stream.read(size)
+        if size is None or size < 0 or not data:
+            self._finish()
+        return data
+
+    def readlines(self):
+        lines = self._stream.readlines()
+        self._finish()
+        return lines
+
+    def readline(self):
+        line = self._stream.readline()
+        if not line:
+            self._finish()
+        return line
+
+    def __iter__(self):
+        for line in self._stream:
+            yield line
+        self._finish()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class InstrumentedConnection:
+    """给SSH连接（paramiko.SSHClient或兼容对象）的exec_command计时，其余方法原样转发
+
+    计时到调用方读完stdout/stderr或查询退出码为止；只启动不读取输出的命令不计入统计。
+    """
+
+    def __init__(self, ssh, host):
+        self._ssh = ssh
+        self.host = host  # host:port
+
+    def exec_command(self, command, *args, **kwargs):
+        call = _TimedCall(self.host, command)
+        try:
+            stdin, stdout, stderr = self._ssh.exec_command(command, *args, **kwargs)
+        except Exception:
+            call.finish(-1)
+            raise
+        return stdin, _TimedStream(stdout, call), _TimedStream(stderr, call)
+
+    def __getattr__(self, name):
+        return getattr(self._ssh, name)
@@ -1,29 +1,328 @@
+import os
+import copy
+import hashlib
+import marshal
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
 import yaml
 from file_lock import FileLock
 
+# 优先使用libyaml的C实现，未安装时退回纯Python实现
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
 class ConfigManager:
-    def __init__(self, config_file):
+    def __init__(self, config_file, backup_count=3):
         self.config_file = config_file
+        self.backup_count = backup_count  # 保留的历史版本数量（config.yaml.bak1 为最近一次）
         self.lock = FileLock(config_file)
-        
+        # 已解析配置的内存快照，文件的 (mtime, size, inode) 变化时才重新解析。
+        # 快照优先保存为marshal字节，返回副本时反序列化比deepcopy快得多
+        self._cache = None
+        self._cache_payload = None
+        self._cache_key = None
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # 二进制快照：YAML内容哈希 + marshal序列化的配置，冷启动的进程可跳过YAML解析
+        self.snapshot_file = f"{config_file}.snapshot"
+        self.snapshot_hits = 0
+
+    def _file_key(self):
+        """获取配置文件的标识（mtime/size/inode），文件不存在时返回None"""
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _get_cached(self, key):
+        """命中缓存时返回配置副本，否则返回None"""
+        with self._cache_lock:
+            if key is not None and key == self._cache_key:
+                self.cache_hits += 1
+                return self._copy_cache()
+        return None
+
+    def _copy_cache(self):
+        """返回内存快照的独立副本（调用方需持有_cache_lock）"""
+        if self._cache_payload is not None:
+            return marshal.loads(self._cache_payload)
+        return copy.deepcopy(self._cache)
+
+    def _update_cache(self, config, key, payload=None):
+        """更新内存快照"""
+        if payload is None:
+            try:
+                payload = marshal.dumps(config)
+            except ValueError:
+                # 含有marshal不支持的类型（如日期）时退回deepcopy
+                payload = None
+        with self._cache_lock:
+            self._cache_payload = payload
+            self._cache = copy.deepcopy(config) if payload is None else None
+            self._cache_key = key
+
+    def invalidate_cache(self):
+        """丢弃内存快照，下次加载时强制重新解析"""
+        with self._cache_lock:
+            self._cache = None
+            self._cache_payload = None
+            self._cache_key = None
+
+    def get_version(self):
+        """获取配置文件当前的版本标识 (mtime, size, inode)，用于判断配置是否变化"""
+        return self._file_key()
+
+    def get_cache_stats(self):
+        """获取缓存命中统计"""
+        with self._cache_lock:
+            total = self.cache_hits + self.cache_misses
+            return {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'snapshot_hits': self.snapshot_hits,
+                'hit_rate': self.cache_hits / total if total else 0.0
+            }
+
+    @contextmanager
+    def _locked(self, shared=False):
+        """持有配置文件锁：读者使用共享锁，写者使用排它锁"""
+        if not self.lock.acquire(shared=shared):
+            raise TimeoutError(f"获取配置文件锁超时：{self.config_file}")
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def get_lock_stats(self):
+        """获取配置文件锁的等待/持有时间统计"""
+        return self.lock.get_stats()
+
+    def _read_config(self):
+        """在已持有文件锁的前提下读取配置（优先使用快照）"""
+        key = self._file_key()
+        config = self._get_cached(key)
+        if config is not None:
+            return config
+        payload = None
+        try:
+            config, payload = self._load_current()
+        except Exception as e:
+            # 当前文件损坏时退回到最近一个可用的历史版本
+            config = self._load_latest_backup(e)
+        with self._cache_lock:
+            self.cache_misses += 1
+        self._update_cache(config, key, payload)
+        return config
+
+    @staticmethod
+    def _parse_yaml(data, path):
+        """解析YAML内容，内容为空时视为损坏"""
+        config = yaml.load(data, Loader=YamlLoader)
+        if config is None:
+            raise ValueError(f"配置文件为空：{path}")
+        return config
+
+    def _parse_file(self, path):
+        with open(path, 'rb') as f:
+            return self._parse_yaml(f.read(), path)
+
+    def _load_current(self):
+        """加载当前配置文件，返回 (配置, marshal字节)
+
+        内容哈希与二进制快照一致时直接反序列化快照，跳过YAML解析。
+        """
+        with open(self.config_file, 'rb') as f:
+            data = f.read()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        payload = self._read_snapshot(digest)
+        if payload is not None:
+            try:
+                config = marshal.loads(payload)
+                with self._cache_lock:
+                    self.snapshot_hits += 1
+                return config, payload
+            except Exception:
+                pass
+        config = self._parse_yaml(data, self.config_file)
+        return config, self._write_snapshot(digest, config)
+
+    def _read_snapshot(self, digest):
+        """读取与内容哈希匹配的快照字节，不匹配时返回None"""
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                if f.read(len(digest)) != digest:
+                    return None
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_snapshot(self, digest, config):
+        """写入快照并返回marshal字节；快照只是缓存，失败时忽略"""
+        try:
+            payload = marshal.dumps(config)
+        except ValueError:
+            # 配置中含有marshal不支持的类型（如日期），不使用快照
+            return None
+        tmp_path = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(digest)
+                f.write(payload)
+            os.replace(tmp_path, self.snapshot_file)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return payload
+
+    def _backup_path(self, generation):
+        return f"{self.config_file}.bak{generation}"
+
+    def _load_latest_backup(self, error):
+        """按从新到旧的顺序加载第一个可解析的历史版本"""
+        for generation in range(1, self.backup_count + 1):
+            path = self._backup_path(generation)
+            if not os.path.exists(path):
+                continue
+            try:
+                config = self._parse_file(path)
+            except Exception:
+                continue
+            print(f"配置文件无法解析（{str(error)}），已使用备份 {path}")
+            return config
+        raise error
+
+    def _rotate_backups(self):
+        """轮转历史版本：bak1 -> bak2 -> ...，当前文件成为新的bak1"""
+        try:
+            if self.backup_count <= 0 or os.path.getsize(self.config_file) == 0:
+                return
+        except OSError:
+            return
+        for generation in range(self.backup_count - 1, 0, -1):
+            src = self._backup_path(generation)
+            if os.path.exists(src):
+                os.replace(src, self._backup_path(generation + 1))
+        latest = self._backup_path(1)
+        try:
+            os.remove(latest)
+        except FileNotFoundError:
+            pass
+        try:
+            # 当前文件随后会被rename替换，硬链接即可保留旧版本而无需复制
+            os.link(self.config_file, latest)
+        except OSError:
+            shutil.copy2(self.config_file, latest)
+
+    def _fsync_dir(self, path):
+        """同步目录项，确保rename在崩溃后仍然可见"""
+        try:
+            dir_fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    def _write_config(self, config, backup=True):
+        """在已持有文件锁的前提下写入配置
+
+        写临时文件并fsync，然后原子rename替换，读者只会看到旧文件或完整的新文件。
+        """
+        data = yaml.dump(config, Dumper=YamlDumper, allow_unicode=True)
+        if config is None or not data.strip():
+            raise ValueError("拒绝写入空配置")
+
+        config_dir = os.path.dirname(os.path.abspath(self.config_file))
+        fd, tmp_path = tempfile.mkstemp(prefix='.config.', suffix='.tmp', dir=config_dir)
+        try:
+            # 保留原文件的权限位（mkstemp默认创建0600文件）
+            try:
+                os.chmod(tmp_path, os.stat(self.config_file).st_mode & 0o777)
+            except OSError:
+                pass
+            encoded = data.encode('utf-8')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(encoded)
+                f.flush()
+                os.fsync(f.fileno())
+            if backup:
+                self._rotate_backups()
+            os.replace(tmp_path, self.config_file)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._fsync_dir(config_dir)
+        payload = self._write_snapshot(hashlib.blake2b(encoded, digest_size=16).digest(), config)
+        self._update_cache(config, self._file_key(), payload)
+
+    def restore_backup(self, generation=1):
+        """用指定的历史版本覆盖当前配置"""
+        try:
+            with self._locked():
+                config = self._parse_file(self._backup_path(generation))
+                # 不轮转：避免把损坏的当前文件挤进历史版本
+                self._write_config(config, backup=False)
+            print(f"已从 {self._backup_path(generation)} 恢复配置")
+            return True
+        except Exception as e:
+            print(f"恢复配置失败：{str(e)}")
+            return False
+
     def load_config(self):
         """线程安全的配置加载"""
         try:
-            with self.lock:
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    config = yaml.safe_load(f)
+            # 文件未变化时直接返回快照副本，无需加锁和解析YAML
+            config = self._get_cached(self._file_key())
+            if config is not None:
                 return config
+
+            # 共享锁：多个CLI会话可以同时读取
+            with self._locked(shared=True):
+                return self._read_config()
         except Exception as e:
             print(f"加载配置失败：{str(e)}")
             return None
-            
+
     def save_config(self, config):
         """线程安全的配置保存"""
         try:
-            with self.lock:
-                with open(self.config_file, 'w', encoding='utf-8') as f:
-                    yaml.dump(config, f, allow_unicode=True)
+            with self._locked():
+                self._write_config(config)
                 return True
         except Exception as e:
             print(f"保存配置失败：{str(e)}")
-            return False 
\ No newline at end of file
+            return False
+
+    @contextmanager
+    def transaction(self):
+        """读-改-写事务
+
+        在同一次排它锁内完成读取、修改和原子写入，避免其他进程的并发修改被覆盖。
+        用法::
+
+            with config_manager.transaction() as config:
+                config['users'][name] = {...}
+
+        代码块抛出异常时不写入；配置未被修改时也不写入。
+        """
+        with self._locked():
+            config = self._read_config()
+            yield config
+            with self._cache_lock:
+                unchanged = self._cache_key is not None and config == self._copy_cache()
+            if not unchanged:
+                self._write_config(config)
@@ -0,0 +1,222 @@
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+from contextlib import nullcontext
+
+# inotify 事件掩码（见 <sys/inotify.h>）
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class _Inotify:
+    """通过ctypes调用libc的inotify接口，监视配置文件所在目录"""
+
+    def __init__(self, directory, filename):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self.filename = os.fsencode(filename)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1失败")
+        # 配置通过rename原子替换，因此监视目录而不是文件本身
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MODIFY
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch失败")
+
+    def read_events(self):
+        """非阻塞读取事件，返回是否有与配置文件相关的事件"""
+        matched = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return matched
+            if not data:
+                return matched
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                # 事件队列溢出时无法确定丢失了哪些事件，按配置已变化处理
+                if name == self.filename or mask & IN_Q_OVERFLOW:
+                    matched = True
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class ConfigWatcher:
+    """配置变化通知
+
+    优先使用inotify，不可用时退回到比较文件的 (mtime, size, inode)。
+    检测到变化后重新加载配置，计算发生变化的顶层段，并通知订阅了这些段的回调：
+    callback(changed_sections, config)。
+
+    check() 是非阻塞的，可在每次读取配置前调用以保证看到最新数据；
+    start() 启动后台线程，在配置变化时主动推送。
+    """
+
+    def __init__(self, config_manager, poll_interval=1.0, use_inotify=True):
+        self.config_manager = config_manager
+        self.poll_interval = poll_interval
+        self._lock = threading.RLock()
+        self._subscribers = []
+        self._config = config_manager.load_config() or {}
+        self._version = config_manager.get_version()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.events_published = 0
+
+        self._inotify = None
+        if use_inotify:
+            path = os.path.abspath(config_manager.config_file)
+            try:
+                self._inotify = _Inotify(os.path.dirname(path), os.path.basename(path))
+            except (OSError, AttributeError):
+                self._inotify = None
+
+    @property
+    def mode(self):
+        return 'inotify' if self._inotify else 'polling'
+
+    def subscribe(self, callback, sections=None):
+        """订阅配置变化；sections为None时订阅所有段"""
+        with self._lock:
+            self._subscribers.append((callback, set(sections) if sections else None))
+
+    def check(self):
+        """检查配置是否变化，变化时分发事件并返回变化的段集合"""
+        with self._lock:
+            if self._inotify:
+                if not self._inotify.read_events():
+                    return set()
+            else:
+                version = self.config_manager.get_version()
+                if version == self._version:
+                    return set()
+
+            config = self.config_manager.load_config()
+            if config is None:
+                return set()
+            self._version = self.config_manager.get_version()
+
+            old = self._config
+            changed = {
+                section for section in set(old) | set(config)
+                if old.get(section) != config.get(section)
+            }
+            self._config = config
+            if not changed:
+                return set()
+
+            self.events_published += 1
+            subscribers = list(self._subscribers)
+
+        for callback, sections in subscribers:
+            if sections is None or sections & changed:
+                try:
+                    callback(changed, config)
+                except Exception as e:
+                    print(f"处理配置变化通知失败：{str(e)}")
+        return changed
+
+    def start(self):
+        """启动后台监视线程"""
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._watch_loop)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """停止后台监视线程"""
+        if self._thread:
+            self._stop_event.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+    def _watch_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                if self._inotify:
+                    # 阻塞等待inotify事件，定期醒来检查停止标志
+                    select.select([self._inotify.fd], [], [], self.poll_interval)
+                else:
+                    self._stop_event.wait(self.poll_interval)
+                self.check()
+            except Exception as e:
+                print(f"配置监视出错：{str(e)}")
+                self._stop_event.wait(self.poll_interval)
+
+
+def apply_sections(target, changed, config, sections=None):
+    """将config中发生变化的段复制到target（sections为None时复制所有变化的段）"""
+    for section in changed:
+        if sections is not None and section not in sections:
+            continue
+        if section in config:
+            target[section] = config[section]
+        else:
+            target.pop(section, None)
+
+
+class ConfigSubscriber:
+    """订阅配置变化的管理器共用的方法
+
+    子类定义 WATCHED_SECTIONS，并在__init__中设置 config、config_manager 和 config_watcher。
+    """
+    WATCHED_SECTIONS = ()
+
+    def set_config_manager(self, config_manager):
+        """设置配置管理器实例"""
+        self.config_manager = config_manager
+
+    def set_config_watcher(self, config_watcher):
+        """设置配置监视器，只在 WATCHED_SECTIONS 中的段变化时刷新"""
+        self.config_watcher = config_watcher
+        config_watcher.subscribe(self._on_config_change, self.WATCHED_SECTIONS)
+
+    def _on_config_change(self, changed, config):
+        apply_sections(self.config, changed, config, self.WATCHED_SECTIONS)
+
+    def _refresh(self):
+        """获取最新配置：有监视器时仅在配置变化后刷新相关段，否则整体重新加载"""
+        if self.config_watcher:
+            self.config_watcher.check()
+        elif self.config_manager:
+            self.config = self.config_manager.load_config()
+
+    def _transaction(self):
+        """获取配置事务；未设置配置管理器时直接修改内存中的配置"""
+        if self.config_manager:
+            return self.config_manager.transaction()
+        return nullcontext(self.config)
+
+    def _reload(self):
+        """事务提交后刷新内存中的配置"""
+        self._refresh()
+        return True
@@ -0,0 +1,314 @@
+import json
+import queue
+import threading
+import time
+
+from docker_api import parse_timestamp
+
+EVENT_ACTIONS = ('start', 'die', 'destroy', 'rename')
+EVENTS_CMD = (
+    "docker events --filter type=container "
+    + ' '.join(f"--filter event={action}" for action in EVENT_ACTIONS)
+    + " --format '{{json .}}'"
+)
+BOOTSTRAP_CMD = "docker ps -aq --no-trunc | xargs -r docker inspect"
+SINCE_CMD = "date +%s.%N"
+
+
+def human_duration(seconds):
+    """按docker ps的Status格式显示时长（如 Up 3 hours 中的 3 hours）"""
+    seconds = max(int(seconds), 0)
+    if seconds < 1:
+        return 'Less than a second'
+    if seconds == 1:
+        return '1 second'
+    if seconds < 60:
+        return f"{seconds} seconds"
+    minutes = seconds // 60
+    if minutes == 1:
+        return 'About a minute'
+    if minutes < 60:
+        return f"{minutes} minutes"
+    hours = round(seconds / 3600)
+    if hours == 1:
+        return 'About an hour'
+    if hours < 48:
+        return f"{hours} hours"
+    if hours < 24 * 7 * 2:
+        return f"{hours // 24} days"
+    if hours < 24 * 30 * 2:
+        return f"{hours // 24 // 7} weeks"
+    if hours < 24 * 365 * 2:
+        return f"{hours // 24 // 30} months"
+    return f"{hours // 24 // 365} years"
+
+
+def _from_inspect(item):
+    """docker inspect 的一项转换为清单中的容器记录"""
+    state = item.get('State') or {}
+    config = item.get('Config') or {}
+    return {
+        'container_id': item['Id'][:12],
+        'name': item.get('Name', '').lstrip('/'),
+        'image': config.get('Image'),
+        'state': state.get('Status'),
+        'created': parse_timestamp(item.get('Created')),
+        'started_at': parse_timestamp(state.get('StartedAt')),
+        'finished_at': parse_timestamp(state.get('FinishedAt')),
+        'labels': config.get('Labels') or {}
+    }
+
+
+class _ServerInventory:
+    """一台服务器的容器表：启动时用docker inspect建立一次，之后只按docker events增量更新
+
+    事件流在建立快照之前订阅，快照期间到达的事件先缓存，快照完成后按顺序重放；
+    订阅使用 --since（建立快照之前的服务器时间），守护进程完成订阅之前发生的事件也会补发。
+    各事件的处理是幂等的，因此快照和事件重叠时结果不变。通道断开后重新建立快照。
+    """
+
+    def __init__(self, name, server_info, ssh_manager, on_event=None, retry_interval=30):
+        self.name = name
+        self.server_info = server_info
+        self.ssh_manager = ssh_manager
+        self.on_event = on_event
+        self.retry_interval = retry_interval
+        self._containers = {}  # 容器ID（12位） -> 容器记录
+        self._lock = threading.Lock()
+        self._ready = False
+        self._closed = False
+        self._lease = None
+        self._channel = None
+        self.events_applied = 0
+        self.bootstraps = 0
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"inventory-{name}")
+
+    def start(self):
+        self._thread.start()
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def containers(self, all=False):
+        """容器记录的副本；all为False时只返回运行中的容器（与docker ps相同），status按当前时间生成"""
+        now = time.time()
+        with self._lock:
+            items = [dict(c) for c in self._containers.values() if all or c['state'] == 'running']
+        for container in items:
+            if container['state'] == 'running':
+                container['status'] = f"Up {human_duration(now - (container['started_at'] or now))}"
+            else:
+                container['status'] = container['state']
+        items.sort(key=lambda c: c['created'] or 0, reverse=True)
+        return items
+
+    def discard(self, container_name):
+        """容器已删除时立即从表中移除（之后到达的destroy事件不再有影响）"""
+        with self._lock:
+            for container_id, container in list(self._containers.items()):
+                if container['name'] == container_name:
+                    del self._containers[container_id]
+
+    def _run(self):
+        while not self._closed:
+            try:
+                self._follow()
+            except Exception as e:
+                self.last_error = str(e)
+            finally:
+                self._ready = False
+                self._release()
+            if not self._closed:
+                time.sleep(self.retry_interval)
+
+    def _follow(self):
+        lease = self.ssh_manager.acquire_channel(self.server_info, 'container_inventory', timeout=15)
+        with self._lock:
+            self._lease = lease
+        ssh = lease['ssh']
+        # 服务器当前时间（而不是本机时间）作为事件起点：exec_command返回时守护进程未必已完成订阅
+        stdin, stdout, stderr = ssh.exec_command(SINCE_CMD)
+        since = stdout.read().decode().strip()
+        if stdout.channel.recv_exit_status() != 0 or not since:
+            raise RuntimeError(f"获取服务器时间失败：{stderr.read().decode().strip()}")
+        channel = ssh.get_transport().open_session(timeout=15)
+        channel.exec_command(f"{EVENTS_CMD} --since {since}")
+        with self._lock:
+            self._channel = channel
+        # 读取线程把事件行放入队列：建立快照期间到达的事件留在队列中，快照完成后按顺序处理
+        lines = queue.Queue()
+
+        def read_events():
+            try:
+                for line in channel.makefile('r'):
+                    lines.put(line)
+            except Exception:
+                pass
+            finally:
+                lines.put(None)
+
+        threading.Thread(target=read_events, daemon=True).start()
+        stdin, stdout, stderr = ssh.exec_command(BOOTSTRAP_CMD)
+        output = stdout.read().decode()
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError(f"获取容器列表失败：{stderr.read().decode().strip()}")
+        snapshot = {}
+        for item in (json.loads(output) if output.strip() else []):
+            container = _from_inspect(item)
+            snapshot[container['container_id']] = container
+        with self._lock:
+            self._containers = snapshot
+        self.bootstraps += 1
+        self._ready = True
+
+        while True:
+            line = lines.get()
+            if line is None:
+                raise RuntimeError('docker events 通道已断开')
+            self._apply_line(line)
+
+    def _apply_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return
+        self.apply(event)
+
+    def apply(self, event):
+        """按一个docker events事件更新容器表"""
+        action = event.get('Action') or event.get('status')
+        container_id = (event.get('id') or '')[:12]
+        attributes = (event.get('Actor') or {}).get('Attributes') or {}
+        event_time = event.get('time') or time.time()
+        with self._lock:
+            container = self._containers.get(container_id)
+            if action == 'start':
+                if container is None:
+                    container = self._containers[container_id] = {
+                        'container_id': container_id,
+                        'name': attributes.get('name', ''),
+                        'image': attributes.get('image'),
+                        'created': event_time,
+                        'finished_at': None,
+                        'labels': {k: v for k, v in attributes.items() if k not in ('name', 'image')}
+                    }
+                container['state'] = 'running'
+                container['started_at'] = event_time
+            elif action == 'die':
+                if container is not None:
+                    container['state'] = 'exited'
+                    container['finished_at'] = event_time
+            elif action == 'destroy':
+                self._containers.pop(container_id, None)
+            elif action == 'rename':
+                if container is not None and attributes.get('name'):
+                    container['name'] = attributes['name']
+            else:
+                return
+        self.events_applied += 1
+        if self.on_event:
+            try:
+                self.on_event(self.name, {
+                    'event': 'container', 'action': action, 'container_id': container_id,
+                    'name': attributes.get('name'), 'time': event_time
+                })
+            except Exception as e:
+                print(f"处理容器事件失败：{str(e)}")
+
+    def _release(self):
+        """关闭事件通道并归还租约；_run 的清理和 close() 可能同时调用，每个租约只归还一次"""
+        with self._lock:
+            channel, self._channel = self._channel, None
+            lease, self._lease = self._lease, None
+        if channel is not None:
+            try:
+                channel.close()
+            except Exception:
+                pass
+        if lease is not None:
+            self.ssh_manager.release_channel(self.server_info, lease)
+
+    def close(self):
+        self._closed = True
+        self._ready = False
+        self._release()
+
+
+class ContainerInventory:
+    """各服务器的容器清单，由docker events流实时更新
+
+    每台服务器占用一个长期通道运行 docker events；清单就绪的服务器，任务列表直接读内存，
+    不再执行docker ps。尚未就绪或事件流断开的服务器返回None，由调用方走原有查询。
+    """
+
+    def __init__(self, ssh_manager, retry_interval=30):
+        self.ssh_manager = ssh_manager
+        self.retry_interval = retry_interval
+        self._servers = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def subscribe(self, callback):
+        """callback(服务器名, 事件字典)，事件格式与常驻代理的容器事件相同"""
+        self._listeners.append(callback)
+
+    def _dispatch(self, name, event):
+        for callback in list(self._listeners):
+            callback(name, event)
+
+    def start_all(self, servers):
+        """在后台为每台服务器建立清单并订阅事件（已在跟踪的服务器不重复启动）"""
+        with self._lock:
+            for name, server_info in servers.items():
+                if name in self._servers:
+                    continue
+                inventory = self._servers[name] = _ServerInventory(
+                    name, server_info, self.ssh_manager, self._dispatch, self.retry_interval
+                )
+                inventory.start()
+
+    def containers(self, name, all=False):
+        """服务器上的容器列表（格式同Docker API的list_containers，另有started_at），清单未就绪时返回None"""
+        with self._lock:
+            inventory = self._servers.get(name)
+        if inventory is None or not inventory.ready:
+            return None
+        return inventory.containers(all)
+
+    def list_containers(self, servers, all=False):
+        """{服务器名: 容器列表}，只包含清单已就绪的服务器"""
+        result = {}
+        for name in servers:
+            containers = self.containers(name, all)
+            if containers is not None:
+                result[name] = containers
+        return result
+
+    def discard(self, name, container_name):
+        with self._lock:
+            inventory = self._servers.get(name)
+        if inventory is not None:
+            inventory.discard(container_name)
+
+    def get_stats(self):
+        with self._lock:
+            servers = dict(self._servers)
+        return {
+            name: {
+                'ready': inventory.ready, 'bootstraps': inventory.bootstraps,
+                'events': inventory.events_applied, 'last_error': inventory.last_error
+            }
+            for name, inventory in servers.items()
+        }
+
+    def close_all(self):
+        with self._lock:
+            servers = list(self._servers.values())
+            self._servers.clear()
+        for inventory in servers:
+            inventory.close()
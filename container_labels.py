@@ -0,0 +1,78 @@
+import re
+import shlex
+
+# 创建容器时附加的标签：容器的所属用户、用户组、GPU、创建时间和时间限制只从标签即可恢复
+OWNER = 'lab.owner'
+GROUP = 'lab.group'
+GPUS = 'lab.gpus'
+CREATED_AT = 'lab.created_at'
+TIME_LIMIT = 'lab.time_limit'
+LABELS = (OWNER, GROUP, GPUS, CREATED_AT, TIME_LIMIT)
+
+# docker ps --format 中依次输出各标签的值（制表符分隔），与 LABELS 的顺序相同
+PS_LABEL_FORMAT = '\t'.join('{{.Label "%s"}}' % key for key in LABELS)
+
+
+def build_labels(owner, group, gpus, created_at, time_limit):
+    """容器标签字典；gpus为GPU编号列表，created_at为epoch秒，time_limit为小时数"""
+    return {
+        OWNER: owner,
+        GROUP: group,
+        GPUS: ','.join(str(gpu) for gpu in gpus),
+        CREATED_AT: str(int(created_at)),
+        TIME_LIMIT: str(time_limit)
+    }
+
+
+def label_args(labels):
+    """docker run 的 --label 参数"""
+    return ' '.join(f"--label {shlex.quote(f'{key}={value}')}" for key, value in labels.items())
+
+
+def owner_filter(username):
+    """docker ps 的过滤参数：只列出属于该用户的容器（在Docker守护进程端过滤）"""
+    return f"--filter {shlex.quote(f'label={OWNER}={username}')}"
+
+
+def name_filter(names):
+    """docker ps 的过滤参数：按容器名精确匹配（多个名字之间为“或”）
+
+    用于列出没有标签的旧容器（按任务记录中的容器名），与 owner_filter 的结果合并。
+    """
+    return ' '.join(f"--filter {shlex.quote(f'name=^/{re.escape(name)}$')}" for name in names)
+
+
+def api_owner_filters(username, names=()):
+    """Docker Engine API /containers/json 的filters参数列表，与 owner_filter、name_filter 相同，结果取并集"""
+    filters = [{'label': [f"{OWNER}={username}"]}]
+    if names:
+        filters.append({'name': [f"^/{re.escape(name)}$" for name in names]})
+    return filters
+
+
+def labels_from_fields(fields):
+    """按 PS_LABEL_FORMAT 输出的各字段还原标签字典（省略空值）"""
+    return {key: value for key, value in zip(LABELS, fields) if value}
+
+
+def parse_labels(labels):
+    """从标签中恢复任务信息 {owner, group, gpus, created_at, time_limit}；不是本系统创建的容器返回None"""
+    labels = labels or {}
+    owner = labels.get(OWNER)
+    if not owner:
+        return None
+    try:
+        created_at = int(labels[CREATED_AT]) if labels.get(CREATED_AT) else None
+    except ValueError:
+        created_at = None
+    try:
+        time_limit = float(labels[TIME_LIMIT]) if labels.get(TIME_LIMIT) else None
+    except ValueError:
+        time_limit = None
+    return {
+        'owner': owner,
+        'group': labels.get(GROUP),
+        'gpus': [gpu for gpu in labels.get(GPUS, '').split(',') if gpu],
+        'created_at': created_at,
+        'time_limit': time_limit
+    }
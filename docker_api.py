@@ -0,0 +1,323 @@
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from urllib.parse import quote, urlencode
+
+DIAL_STDIO_CMD = 'docker system dial-stdio'
+
+
+class DockerAPIError(Exception):
+    """Docker Engine API请求失败"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_timestamp(value):
+    """解析Docker的RFC3339时间（纳秒精度，如 2024-05-01T08:00:00.123456789Z），返回epoch秒；未设置时返回None"""
+    if not value or value.startswith('0001-01-01'):
+        return None
+    value = value.replace('Z', '+00:00')
+    if '.' in value:
+        head, rest = value.split('.', 1)
+        digits = len(rest) - len(rest.lstrip('0123456789'))
+        value = f"{head}.{rest[:min(digits, 6)]}{rest[digits:]}"
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def normalize_container(item):
+    """容器列表（/containers/json）中的一项转换为统一格式"""
+    return {
+        'container_id': item['Id'][:12],
+        'name': item['Names'][0].lstrip('/') if item.get('Names') else '',
+        'image': item.get('Image'),
+        'state': item.get('State'),
+        'status': item.get('Status'),
+        'created': item.get('Created'),
+        'labels': item.get('Labels') or {}
+    }
+
+
+class _DialStdioSocket:
+    """在SSH会话通道上运行 docker system dial-stdio，提供http.client需要的socket接口
+
+    通道占用连接池的一个通道名额，关闭时归还。
+    """
+
+    def __init__(self, ssh_manager, server_info, timeout):
+        self._ssh_manager = ssh_manager
+        self._server_info = server_info
+        self._lease = ssh_manager.acquire_channel(server_info, 'docker_api', timeout=timeout)
+        try:
+            self._channel = self._lease['ssh'].get_transport().open_session(timeout=timeout)
+            self._channel.settimeout(timeout)
+            self._channel.exec_command(DIAL_STDIO_CMD)
+        except Exception:
+            ssh_manager.release_channel(server_info, self._lease)
+            raise
+
+    def sendall(self, data):
+        self._channel.sendall(data)
+
+    def makefile(self, mode='rb', bufsize=-1):
+        return self._channel.makefile(mode, bufsize)
+
+    def settimeout(self, timeout):
+        self._channel.settimeout(timeout)
+
+    def close(self):
+        if self._lease is None:
+            return
+        try:
+            self._channel.close()
+        except Exception:
+            pass
+        self._ssh_manager.release_channel(self._server_info, self._lease)
+        self._lease = None
+
+
+class _DockerHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, ssh_manager, server_info, timeout):
+        super().__init__('docker', timeout=timeout)
+        self._ssh_manager = ssh_manager
+        self._server_info = server_info
+
+    def connect(self):
+        self.sock = _DialStdioSocket(self._ssh_manager, self._server_info, self.timeout)
+
+
+class DockerAPI:
+    """一台服务器的Docker Engine API客户端
+
+    通过SSH通道上的 docker system dial-stdio 连接服务器的 /var/run/docker.sock，
+    HTTP/1.1 keep-alive，同一条通道上依次发送多个请求；返回Docker的原始JSON
+    （精确的StartedAt、标签、DeviceRequests、以字节为单位的大小）。
+    通道空闲 idle_timeout 秒后关闭，通道名额归还连接池，下次请求时重新建立。
+    API版本在第一次请求时通过 /version 协商：取 API_VERSION 和服务器支持的最高版本中较低的一个
+    （dial-stdio需要Docker 18.09，即API 1.39）。
+    """
+
+    API_VERSION = '1.40'  # 使用的最高版本
+
+    def __init__(self, ssh_manager, server_info, timeout=30, idle_timeout=30):
+        self._conn = _DockerHTTPConnection(ssh_manager, server_info, timeout)
+        self._lock = threading.Lock()
+        self.idle_timeout = idle_timeout
+        self._last_used = 0
+        self._idle_timer = None
+        self.api_version = None
+        self.requests = 0
+        self.connects = 0
+
+    def _send_locked(self, method, url, payload=None, headers=None):
+        for attempt in range(2):
+            try:
+                if self._conn.sock is None:
+                    self.connects += 1
+                self._conn.request(method, url, body=payload, headers=headers or {})
+                response = self._conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError, EOFError) as e:
+                # keep-alive通道已断开：重新建立通道后重试一次
+                self._conn.close()
+                if attempt:
+                    raise DockerAPIError(f"Docker API请求失败：{str(e)}")
+        self.requests += 1
+        return response, data
+
+    @staticmethod
+    def _version_key(version):
+        return tuple(int(part) for part in version.split('.'))
+
+    def _negotiate_locked(self):
+        response, data = self._send_locked('GET', '/version')
+        server_version = self.API_VERSION
+        if response.status < 400:
+            try:
+                server_version = json.loads(data).get('ApiVersion') or self.API_VERSION
+            except ValueError:
+                pass
+        return min(self.API_VERSION, server_version, key=self._version_key)
+
+    def request(self, method, path, params=None, body=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        with self._lock:
+            if self.api_version is None:
+                self.api_version = self._negotiate_locked()
+            url = f"/v{self.api_version}{path}"
+            if params:
+                url += '?' + urlencode(params)
+            response, data = self._send_locked(method, url, payload, headers)
+            self._last_used = time.monotonic()
+            if self._idle_timer is None and self.idle_timeout:
+                self._start_idle_timer_locked(self.idle_timeout)
+        if response.status >= 400:
+            try:
+                message = json.loads(data).get('message', data.decode('utf-8', 'replace'))
+            except ValueError:
+                message = data.decode('utf-8', 'replace')
+            raise DockerAPIError(f"{method} {path} 返回 {response.status}：{message}", response.status)
+        return json.loads(data) if data else None
+
+    def containers(self, all=False, filters=None):
+        params = {'all': '1' if all else '0'}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        return self.request('GET', '/containers/json', params)
+
+    def inspect_container(self, container):
+        return self.request('GET', f"/containers/{quote(container, safe='')}/json")
+
+    def images(self):
+        return self.request('GET', '/images/json')
+
+    def _start_idle_timer_locked(self, delay):
+        self._idle_timer = threading.Timer(delay, self._close_if_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _close_if_idle(self):
+        """空闲超时后关闭keep-alive通道；期间有新请求时按最后一次请求的时间重新计时"""
+        with self._lock:
+            if self._idle_timer is None:
+                return
+            remaining = self._last_used + self.idle_timeout - time.monotonic()
+            if remaining > 0:
+                self._start_idle_timer_locked(remaining)
+                return
+            self._idle_timer = None
+            self._conn.close()
+
+    def close(self):
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            self._conn.close()
+
+
+class DockerAPIManager:
+    """按服务器缓存DockerAPI客户端（连续请求复用keep-alive通道，空闲后归还）；服务器不支持时一段时间内不再尝试"""
+
+    def __init__(self, ssh_manager, retry_interval=300, max_workers=16, idle_timeout=30):
+        self.ssh_manager = ssh_manager
+        self.retry_interval = retry_interval
+        self.idle_timeout = idle_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='docker-api')
+        self._clients = {}
+        self._failed = {}  # 服务器名 -> 上次失败时间
+        self._lock = threading.Lock()
+
+    def available(self, name):
+        """服务器的Docker API是否可以使用
+
+        启用本地SSH代理时不使用：dial-stdio需要本进程直连的通道，短生命周期的进程
+        （cron运行的检查脚本）会为此与每台服务器各自握手，改为经代理执行docker命令。
+        """
+        if self.ssh_manager.get_broker():
+            return False
+        with self._lock:
+            return time.time() - self._failed.get(name, 0) >= self.retry_interval
+
+    def client(self, name, server_info):
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                client = self._clients[name] = DockerAPI(self.ssh_manager, server_info, idle_timeout=self.idle_timeout)
+            return client
+
+    def call(self, name, server_info, func):
+        """func(DockerAPI) 的结果；失败时记录该服务器暂不可用并抛出DockerAPIError"""
+        if not self.available(name):
+            raise DockerAPIError(f"服务器 {name} 的Docker API暂不可用")
+        try:
+            return func(self.client(name, server_info))
+        except DockerAPIError as e:
+            if e.status is None:
+                with self._lock:
+                    self._failed[name] = time.time()
+                    client = self._clients.pop(name, None)
+                if client:
+                    client.close()
+            raise
+        except Exception as e:
+            with self._lock:
+                self._failed[name] = time.time()
+                client = self._clients.pop(name, None)
+            if client:
+                client.close()
+            raise DockerAPIError(f"连接服务器 {name} 的Docker API失败：{str(e)}")
+
+    def list_containers(self, name, server_info, all=False, filters=None):
+        """统一格式的容器列表；filters为列表时依次查询，结果按容器ID合并"""
+        if not isinstance(filters, list):
+            filters = [filters]
+
+        def fetch(api):
+            result = {}
+            for item_filters in filters:
+                for item in api.containers(all, item_filters):
+                    result.setdefault(item['Id'], item)
+            return list(result.values())
+        return [normalize_container(item) for item in self.call(name, server_info, fetch)]
+
+    def list_containers_detailed(self, name, server_info, all=False, filters=None):
+        """容器列表，附带inspect得到的精确启动时间（started_at，epoch秒）和GPU设备请求"""
+        def fetch(api):
+            result = []
+            for item in api.containers(all, filters):
+                container = normalize_container(item)
+                detail = api.inspect_container(item['Id'])
+                container['started_at'] = parse_timestamp(detail['State'].get('StartedAt'))
+                container['device_requests'] = (detail.get('HostConfig') or {}).get('DeviceRequests') or []
+                result.append(container)
+            return result
+        return self.call(name, server_info, fetch)
+
+    def list_images(self, name, server_info):
+        """[{name, size(字节), created}]，每个标签一项"""
+        return [
+            {'name': tag, 'size': item.get('Size', 0), 'created': item.get('Created')}
+            for item in self.call(name, server_info, lambda api: api.images())
+            for tag in (item.get('RepoTags') or [])
+            if tag != '<none>:<none>'
+        ]
+
+    def query_all(self, servers, method, deadline=10, **kwargs):
+        """在多台服务器上并发调用 method（如 'list_containers'），返回 {服务器名: 结果}
+
+        只包含deadline秒内成功返回的服务器；Docker API暂不可用的服务器直接跳过。
+        """
+        futures = {
+            self._executor.submit(getattr(self, method), name, server_info, **kwargs): name
+            for name, server_info in servers.items() if self.available(name)
+        }
+        if not futures:
+            return {}
+        done, _ = wait(futures, timeout=deadline)
+        results = {}
+        for future in done:
+            if future.exception() is None:
+                results[futures[future]] = future.result()
+        return results
+
+    def get_stats(self):
+        with self._lock:
+            return {name: {'requests': c.requests, 'connects': c.connects} for name, c in self._clients.items()}
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+        self._executor.shutdown(wait=False)
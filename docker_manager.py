@@ -1,20 +1,126 @@
 from threading import Lock
+from contextlib import contextmanager
+import re
+import threading
+import time
+
+# 按命令类型划分的通道：耗时长的镜像操作、容器启停等控制操作、只读查询
+LONG_COMMANDS = {'pull', 'push', 'commit', 'build', 'save', 'load', 'export', 'import'}
+QUERY_COMMANDS = {'ps', 'inspect', 'images', 'info', 'version', 'stats', 'logs', 'top', 'port', 'events'}
+_DOCKER_SUBCOMMAND = re.compile(r'^\s*(?:sudo\s+)?docker\s+(?:container\s+|image\s+)?([a-z]+)')
 
 class DockerManager:
+    """按服务器限制Docker命令的并发
+
+    每台服务器分为三个通道，各自有并发上限：long（pull/push/commit等）、control
+    （run/stop/rm等）、query（ps/inspect等）。一台服务器上的慢操作只占用该服务器
+    对应通道的名额，不影响其他服务器，也不影响同一服务器上其他类型的命令。
+    """
     _instance = None
     _lock = Lock()
-    
+    _lane_limits = {'long': 2, 'control': 4, 'query': 4}
+    _lane_timeout = 600  # 等待通道名额的最长时间（秒）
+    _hosts = {}  # 主机 -> {通道名: 通道状态}
+
     def __new__(cls):
         if cls._instance is None:
             with cls._lock:
                 if cls._instance is None:
                     cls._instance = super().__new__(cls)
         return cls._instance
-    
-    def execute_command(self, ssh, command):
-        """线程安全的Docker命令执行"""
+
+    @staticmethod
+    def classify(command):
+        """命令所属的通道：long、control或query"""
+        match = _DOCKER_SUBCOMMAND.match(command)
+        subcommand = match.group(1) if match else None
+        if subcommand in LONG_COMMANDS:
+            return 'long'
+        if subcommand in QUERY_COMMANDS:
+            return 'query'
+        return 'control'
+
+    @staticmethod
+    def host_of(server_info):
+        """服务器对应的主机（host:port，与SSH连接池的键相同）"""
+        return f"{server_info['host']}:{server_info['port']}"
+
+    def _get_lane(self, host, lane):
         with self._lock:
+            lanes = self._hosts.get(host)
+            if lanes is None:
+                lanes = self._hosts[host] = {
+                    name: {
+                        'cond': threading.Condition(), 'limit': limit, 'active': 0, 'waiting': 0,
+                        'acquisitions': 0, 'waits': 0, 'timeouts': 0, 'total_wait': 0.0, 'max_wait': 0.0
+                    }
+                    for name, limit in self._lane_limits.items()
+                }
+            return lanes[lane]
+
+    def acquire(self, host, command, timeout=None, lane_name=None):
+        """占用主机上命令所属通道（或指定的lane_name）的一个名额，等待超时抛出TimeoutError
+
+        返回的名额用完后交给 release 归还；通常使用 lane()。
+        """
+        lane_name = lane_name or self.classify(command)
+        state = self._get_lane(host, lane_name)
+        cond = state['cond']
+        timeout = self._lane_timeout if timeout is None else timeout
+        start_time = time.monotonic()
+        with cond:
+            if state['active'] >= state['limit']:
+                state['waiting'] += 1
+                try:
+                    while state['active'] >= state['limit']:
+                        remaining = start_time + timeout - time.monotonic()
+                        if remaining <= 0:
+                            state['timeouts'] += 1
+                            raise TimeoutError(f"等待 {host} 的Docker {lane_name} 通道超时（{timeout}秒）")
+                        cond.wait(remaining)
+                finally:
+                    state['waiting'] -= 1
+                wait_time = time.monotonic() - start_time
+                state['waits'] += 1
+                state['total_wait'] += wait_time
+                state['max_wait'] = max(state['max_wait'], wait_time)
+            state['active'] += 1
+            state['acquisitions'] += 1
+        return state
+
+    @staticmethod
+    def release(state):
+        with state['cond']:
+            state['active'] -= 1
+            state['cond'].notify()
+
+    @contextmanager
+    def lane(self, host, command, timeout=None, lane_name=None):
+        """以with语句占用主机上命令所属通道的一个名额"""
+        state = self.acquire(host, command, timeout, lane_name)
+        try:
+            yield
+        finally:
+            self.release(state)
+
+    def execute_command(self, ssh, server_info, command, timeout=None):
+        """执行Docker命令，只与同一服务器、同一通道的命令竞争并发名额"""
+        with self.lane(self.host_of(server_info), command, timeout):
             stdin, stdout, stderr = ssh.exec_command(command)
             output = stdout.read().decode()
             error = stderr.read().decode()
-            return output, error 
\ No newline at end of file
+            return output, error
+
+    def get_stats(self):
+        """每台服务器各通道的并发上限、使用中和排队数量、等待次数和时间（秒）"""
+        with self._lock:
+            hosts = {host: dict(lanes) for host, lanes in self._hosts.items()}
+        result = {}
+        for host, lanes in hosts.items():
+            result[host] = {}
+            for name, state in lanes.items():
+                with state['cond']:
+                    stats = {key: value for key, value in state.items() if key != 'cond'}
+                stats['avg_wait'] = stats['total_wait'] / stats['waits'] if stats['waits'] else 0.0
+                result[host][name] = stats
+        return result
@@ -1,48 +1,163 @@
-import os
 import fcntl
 import time
+import threading
 
 class FileLock:
-    def __init__(self, file_path):
+    """基于flock的进程间读写锁
+
+    - 共享锁（LOCK_SH）供读者使用，多个读者可同时持有
+    - 排它锁（LOCK_EX）供写者使用
+    - 锁状态按线程记录：同一线程可重入，不同线程各自使用独立的文件描述符，
+      因此同一进程内的线程之间也能正确互斥
+    - 带超时的等待以非阻塞方式重试，间隔逐步增加；不限时的等待直接阻塞在flock上
+    """
+
+    def __init__(self, file_path, shared=False):
         self.file_path = file_path
         self.lock_file = f"{file_path}.lock"
-        self.lock_fd = None
-        self.acquired = False
-        
-    def acquire(self, timeout=10, retry_interval=0.1):
-        """获取文件锁"""
-        if self.acquired:
+        self.shared = shared  # with语句使用的默认模式
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'acquisitions': 0,
+            'shared_acquisitions': 0,
+            'exclusive_acquisitions': 0,
+            'contended': 0,
+            'timeouts': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0,
+            'total_hold': 0.0,
+            'max_hold': 0.0
+        }
+
+    @property
+    def acquired(self):
+        """当前线程是否持有锁"""
+        return getattr(self._local, 'depth', 0) > 0
+
+    @property
+    def lock_fd(self):
+        """当前线程持有的锁文件对象"""
+        return getattr(self._local, 'fd', None)
+
+    def acquire(self, timeout=10, shared=None):
+        """获取文件锁
+
+        Args:
+            timeout: 最长等待秒数；None表示一直等待，0表示不等待
+            shared: True为共享锁，False为排它锁，None使用构造时的默认模式
+        Returns:
+            是否成功获取
+        Raises:
+            RuntimeError: 当前线程持有共享锁时请求排它锁
+        """
+        if shared is None:
+            shared = self.shared
+
+        local = self._local
+        if getattr(local, 'depth', 0):
+            # 已持有排它锁时可重入任意模式；持有共享锁时不支持升级为排它锁
+            if not shared and local.shared:
+                raise RuntimeError("不支持从共享锁升级")
+            local.depth += 1
+            return True
+
+        op = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        start_time = time.monotonic()
+        fd = open(self.lock_file, 'a')
+        contended = False
+        try:
+            fcntl.flock(fd.fileno(), op | fcntl.LOCK_NB)
+        except BlockingIOError:
+            contended = True
+            if not self._wait_for_lock(fd, op, timeout):
+                # 超时：fd已关闭
+                self._record_wait(time.monotonic() - start_time, contended, timed_out=True)
+                return False
+        except Exception:
+            fd.close()
+            raise
+
+        wait_time = time.monotonic() - start_time
+        local.fd = fd
+        local.shared = shared
+        local.depth = 1
+        local.acquired_at = time.monotonic()
+        self._record_wait(wait_time, contended, shared=shared)
+        return True
+
+    def _wait_for_lock(self, fd, op, timeout):
+        """等待锁，超过timeout返回False（超时时关闭fd）"""
+        if timeout is None:
+            fcntl.flock(fd.fileno(), op)
             return True
-            
-        start_time = time.time()
+
+        # flock本身不支持超时：非阻塞重试，间隔从1ms逐步增加到50ms
+        deadline = time.monotonic() + timeout
+        delay = 0.001
         while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                fd.close()
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
             try:
-                self.lock_fd = open(self.lock_file, 'w')
-                fcntl.flock(self.lock_fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                self.acquired = True
+                fcntl.flock(fd.fileno(), op | fcntl.LOCK_NB)
                 return True
-            except (IOError, OSError):
-                if time.time() - start_time > timeout:
-                    return False
-                time.sleep(retry_interval)
-                
+            except BlockingIOError:
+                continue
+            except Exception:
+                fd.close()
+                raise
+
+    def _record_wait(self, wait_time, contended, shared=False, timed_out=False):
+        with self._stats_lock:
+            stats = self._stats
+            stats['total_wait'] += wait_time
+            stats['max_wait'] = max(stats['max_wait'], wait_time)
+            if contended:
+                stats['contended'] += 1
+            if timed_out:
+                stats['timeouts'] += 1
+                return
+            stats['acquisitions'] += 1
+            stats['shared_acquisitions' if shared else 'exclusive_acquisitions'] += 1
+
     def release(self):
         """释放文件锁"""
-        if self.acquired and self.lock_fd:
-            try:
-                fcntl.flock(self.lock_fd.fileno(), fcntl.LOCK_UN)
-                self.lock_fd.close()
-                os.remove(self.lock_file)
-            except:
-                pass
-            finally:
-                self.acquired = False
-                self.lock_fd = None
-                
+        local = self._local
+        if not getattr(local, 'depth', 0):
+            return
+        local.depth -= 1
+        if local.depth:
+            return
+
+        hold_time = time.monotonic() - local.acquired_at
+        try:
+            fcntl.flock(local.fd.fileno(), fcntl.LOCK_UN)
+            local.fd.close()
+            # 不删除锁文件：删除后其他进程可能锁住不同的inode，导致两个进程同时持有锁
+        except:
+            pass
+        finally:
+            local.fd = None
+            with self._stats_lock:
+                self._stats['total_hold'] += hold_time
+                self._stats['max_hold'] = max(self._stats['max_hold'], hold_time)
+
+    def get_stats(self):
+        """获取等待时间和持有时间统计（秒）"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        attempts = stats['acquisitions'] + stats['timeouts']
+        stats['avg_wait'] = stats['total_wait'] / attempts if attempts else 0.0
+        stats['avg_hold'] = stats['total_hold'] / stats['acquisitions'] if stats['acquisitions'] else 0.0
+        return stats
+
     def __enter__(self):
         self.acquire()
         return self
-        
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.release() 
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
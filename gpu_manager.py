@@ -1,109 +1,140 @@
+from config_watcher import ConfigSubscriber
+from contextlib import contextmanager, ExitStack
+from file_lock import FileLock
+import os
+import re
 import threading
 
-class GPUManager:
+class GPUManager(ConfigSubscriber):
+    WATCHED_SECTIONS = ('servers',)
+
     def __init__(self, config):
         self.config = config
-        self._lock = threading.Lock()  # 保留线程锁用于内存操作
+        # 按服务器分片加锁：不同服务器上的分配互不阻塞，各自的数据库写入很短，
+        # 提交后写分配日志（fsync）时持有的只是本服务器的锁，多台服务器的记录可在同一次fsync中提交
+        self._locks_guard = threading.Lock()
+        self._server_locks = {}  # 服务器名 -> (线程锁, 文件锁)
         self.config_manager = None  # 将在set_config_manager中设置
-        
-        # 初始化时确保所有服务器都有gpu_usage记录
-        if 'gpu_usage' not in self.config:
-            self.config['gpu_usage'] = {}
-        for server in self.config['servers']:
-            if server not in self.config['gpu_usage']:
-                self.config['gpu_usage'][server] = {}
-
-    def set_config_manager(self, config_manager):
-        """设置配置管理器实例"""
-        self.config_manager = config_manager
+        self.config_watcher = None  # 将在set_config_watcher中设置
+        self.state_store = None  # 将在set_state_store中设置
+        self.index_manager = None  # 将在set_index_manager中设置
+
+    def set_state_store(self, state_store):
+        """设置状态存储实例（GPU分配和任务记录）"""
+        self.state_store = state_store
+
+    def set_index_manager(self, index_manager):
+        """设置索引管理器实例，GPU使用情况查询走内存索引"""
+        self.index_manager = index_manager
+
+    def _get_server_locks(self, server_name):
+        """获取服务器的线程锁和跨进程文件锁（首次使用时创建）"""
+        with self._locks_guard:
+            locks = self._server_locks.get(server_name)
+            if locks is None:
+                file_lock = None
+                if self.state_store:
+                    safe_name = re.sub(r'[^\w.-]', '_', server_name)
+                    file_lock = FileLock(f"{os.path.abspath(self.state_store.db_file)}.{safe_name}")
+                locks = (threading.Lock(), file_lock)
+                self._server_locks[server_name] = locks
+            return locks
+
+    @contextmanager
+    def server_lock(self, server_name, timeout=10):
+        """持有单台服务器的分配锁（进程内和进程间）"""
+        thread_lock, file_lock = self._get_server_locks(server_name)
+        if not thread_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"获取服务器 {server_name} 的分配锁超时")
+        try:
+            if file_lock and not file_lock.acquire(timeout=timeout):
+                raise TimeoutError(f"获取服务器 {server_name} 的分配锁超时")
+            try:
+                yield
+            finally:
+                if file_lock:
+                    file_lock.release()
+        finally:
+            thread_lock.release()
+
+    @contextmanager
+    def servers_lock(self, server_names, timeout=10):
+        """按名称顺序持有多台服务器的分配锁，避免死锁"""
+        with ExitStack() as stack:
+            for server_name in sorted(set(server_names)):
+                stack.enter_context(self.server_lock(server_name, timeout))
+            yield
 
     def get_gpu_usage(self, server_name):
         """获取服务器的GPU使用情况"""
-        if self.config_manager:
-            self.config = self.config_manager.load_config()
-        return self.config['gpu_usage'].get(server_name, {})
+        if self.index_manager:
+            return self.index_manager.get_gpu_usage(server_name)
+        return self.state_store.get_gpu_usage(server_name)
 
     def is_gpu_available(self, server_name, gpu_index):
         """检查指定的GPU是否可用"""
-        with self._lock:
-            if self.config_manager:
-                self.config = self.config_manager.load_config()
-            gpu_usage = self.get_gpu_usage(server_name)
-            return str(gpu_index) not in gpu_usage
+        gpu_usage = self.get_gpu_usage(server_name)
+        return str(gpu_index) not in gpu_usage
 
     def allocate_gpus(self, server_name, gpu_indices, username):
         """分配GPU给用户"""
-        with self._lock:  # 使用线程锁保护内存操作
-            try:
-                if self.config_manager:
-                    self.config = self.config_manager.load_config()
-                
+        try:
+            with self.server_lock(server_name):
+                self._refresh()
+
                 # 检查服务器是否存在
-                if server_name not in self.config['gpu_usage']:
+                if server_name not in self.config['servers']:
                     return False
-                    
-                # 再次检查GPU是否可用
-                for gpu_index in gpu_indices:
-                    if str(gpu_index) in self.config['gpu_usage'][server_name]:
-                        return False
-                
-                # 分配GPU
-                for gpu_index in gpu_indices:
-                    self.config['gpu_usage'][server_name][str(gpu_index)] = username
-                
-                # 保存配置
-                if self.config_manager:
-                    return self.config_manager.save_config(self.config)
-                return True
-                
-            except Exception as e:
-                print(f"分配GPU失败：{str(e)}")
-                return False
+
+                # 检查与写入在同一个数据库事务内完成
+                return self.state_store.allocate_gpus(server_name, gpu_indices, username)
+
+        except Exception as e:
+            print(f"分配GPU失败：{str(e)}")
+            return False
 
     def release_gpus(self, server_name, gpu_indices):
         """释放用户的GPU"""
-        with self._lock:
-            try:
-                if self.config_manager:
-                    self.config = self.config_manager.load_config()
-
-                if server_name in self.config['gpu_usage']:
-                    for gpu_index in gpu_indices:
-                        self.config['gpu_usage'][server_name].pop(str(gpu_index), None)
-                    
-                    if self.config_manager:
-                        return self.config_manager.save_config(self.config)
-                    return True
+        try:
+            with self.server_lock(server_name):
+                self.state_store.release_gpus(server_name, gpu_indices)
+            return True
+        except Exception as e:
+            print(f"释放GPU失败：{str(e)}")
+            return False
 
-            except Exception as e:
-                print(f"释放GPU失败：{str(e)}")
-                return False
+    def release_stopped_containers(self, stopped):
+        """容器已停止后释放GPU并删除任务记录（一个事务）；stopped格式见 StateStore.remove_stopped_tasks"""
+        try:
+            with self.servers_lock(entry[0] for entry in stopped):
+                self.state_store.remove_stopped_tasks(stopped)
+            return True
+        except Exception as e:
+            print(f"释放GPU失败：{str(e)}")
+            return False
 
     def sync_gpu_usage(self):
         """同步GPU使用情况"""
         try:
-            if self.config_manager:
-                self.config = self.config_manager.load_config()
-                
+            self._refresh()
+
             # 创建临时记录
             temp_usage = {server: {} for server in self.config['servers']}
-            
+
             # 从task_records重建GPU使用记录
-            if 'task_records' in self.config:
-                for username, tasks in self.config['task_records'].items():
-                    for task in tasks:
-                        server_name = task.get('server')
-                        gpu_indices = task.get('gpus', [])
-                        if server_name and gpu_indices:
-                            for gpu_index in gpu_indices:
-                                temp_usage[server_name][str(gpu_index)] = username
-            
-            # 更新配置
-            self.config['gpu_usage'] = temp_usage
-            if self.config_manager:
-                return self.config_manager.save_config(self.config)
+            for username, tasks in self.state_store.get_task_records().items():
+                for task in tasks:
+                    server_name = task.get('server')
+                    gpu_indices = task.get('gpus', [])
+                    if server_name in temp_usage and gpu_indices:
+                        for gpu_index in gpu_indices:
+                            temp_usage[server_name][str(gpu_index)] = username
+
+            # 更新分配表：持有所有服务器的锁
+            with self.servers_lock(temp_usage):
+                self.state_store.replace_gpu_usage(temp_usage)
             return True
-            
+
         except Exception as e:
             print(f"同步GPU使用情况失败：{str(e)}")
-            return False
\ No newline at end of file
+            return False
@@ -0,0 +1,196 @@
+import math
+import json
+import os
+import threading
+import time
+from file_lock import FileLock
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class HostUnavailableError(ConnectionError):
+    """主机的熔断器处于打开状态，未尝试连接"""
+
+    def __init__(self, key, retry_in, last_error=None):
+        self.key = key
+        self.retry_in = retry_in
+        self.last_error = last_error
+        message = f"{key} 暂时不可用（熔断中，{math.ceil(retry_in)}秒后重试）"
+        if last_error:
+            message += f"，上次错误：{last_error}"
+        super().__init__(message)
+
+
+class HealthManager:
+    """每台主机的熔断器（closed / open / half_open）
+
+    - closed：正常连接；连续失败达到 failure_threshold 次后打开
+    - open：直接失败，不再等待连接超时；退避时间从 base_backoff 开始每次打开翻倍，最长 max_backoff
+    - half_open：退避时间到后只放行一次试探连接，成功则关闭，失败则重新打开并加倍退避
+
+    状态保存在JSON文件中，main.py、check_container_time.py和SSH代理进程共享，
+    cron每次启动的检查脚本也能直接跳过已知不可达的主机。文件中同时保存每台
+    服务器最近一次获取成功的状态，主机不可用时用于显示。
+    """
+
+    def __init__(self, state_file, failure_threshold=2, base_backoff=30, max_backoff=900, trial_timeout=60):
+        self.state_file = state_file
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.trial_timeout = trial_timeout  # 试探连接的进程异常退出后，超过该时间允许再次试探
+        self._file_lock = FileLock(state_file)
+        self._lock = threading.Lock()
+        self._data = {'hosts': {}, 'snapshots': {}}
+        self._mtime = None
+
+    # ---- 文件读写 ----
+
+    def _load(self):
+        """文件有变化时重新读取（调用方持有self._lock）"""
+        try:
+            mtime = os.stat(self.state_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._data = {'hosts': data.get('hosts', {}), 'snapshots': data.get('snapshots', {})}
+        except (OSError, ValueError) as e:
+            print(f"读取主机健康状态失败：{str(e)}")
+        self._mtime = mtime
+
+    def _save(self):
+        """原子写入（调用方持有self._lock和文件锁）"""
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_file)
+        self._mtime = os.stat(self.state_file).st_mtime_ns
+
+    def _update(self, func):
+        """在文件锁内读取最新状态、修改并写回；func返回False时不写回"""
+        with self._lock:
+            if not self._file_lock.acquire(timeout=5):
+                # 拿不到文件锁时只更新内存中的状态，不影响调用方
+                print(f"更新主机健康状态失败：等待文件锁超时")
+                func(self._data)
+                return
+            try:
+                self._mtime = None
+                self._load()
+                if func(self._data) is not False:
+                    self._save()
+            except OSError as e:
+                print(f"保存主机健康状态失败：{str(e)}")
+            finally:
+                self._file_lock.release()
+
+    # ---- 熔断器 ----
+
+    @staticmethod
+    def _new_host():
+        return {
+            'state': CLOSED, 'failures': 0, 'opens': 0, 'retry_at': 0,
+            'trial_at': 0, 'last_error': None, 'last_failure': None, 'last_success': None
+        }
+
+    def allow(self, key):
+        """是否允许连接该主机；熔断中时抛出HostUnavailableError
+
+        open状态退避到期后转为half_open，只有一个调用方（跨进程）获得试探机会。
+        """
+        now = time.time()
+        with self._lock:
+            self._load()
+            host = self._data['hosts'].get(key)
+            if host is None or host['state'] == CLOSED:
+                return True
+            if host['state'] == OPEN and now < host['retry_at']:
+                raise HostUnavailableError(key, host['retry_at'] - now, host['last_error'])
+            if host['state'] == HALF_OPEN and now < host['trial_at'] + self.trial_timeout:
+                raise HostUnavailableError(key, host['trial_at'] + self.trial_timeout - now, host['last_error'])
+
+        granted = []
+
+        def begin_trial(data):
+            host = data['hosts'].get(key)
+            if host is None or host['state'] == CLOSED:
+                granted.append(True)
+                return False
+            if host['state'] == OPEN and now < host['retry_at']:
+                return False
+            if host['state'] == HALF_OPEN and now < host['trial_at'] + self.trial_timeout:
+                return False
+            host['state'] = HALF_OPEN
+            host['trial_at'] = now
+            granted.append(True)
+
+        self._update(begin_trial)
+        if not granted:
+            host = self._data['hosts'][key]
+            retry_at = host['retry_at'] if host['state'] == OPEN else host['trial_at'] + self.trial_timeout
+            raise HostUnavailableError(key, max(retry_at - now, 0), host['last_error'])
+        return True
+
+    def record_success(self, key):
+        with self._lock:
+            self._load()
+            host = self._data['hosts'].get(key)
+            if host is None or (host['state'] == CLOSED and host['failures'] == 0):
+                return  # 常见情况不写文件
+
+        def close(data):
+            host = data['hosts'].setdefault(key, self._new_host())
+            host.update(state=CLOSED, failures=0, opens=0, retry_at=0, trial_at=0, last_success=time.time())
+
+        self._update(close)
+
+    def record_failure(self, key, error=None):
+        now = time.time()
+
+        def fail(data):
+            host = data['hosts'].setdefault(key, self._new_host())
+            host['failures'] += 1
+            host['last_error'] = str(error) if error else None
+            host['last_failure'] = now
+            if host['state'] == HALF_OPEN or host['failures'] >= self.failure_threshold:
+                backoff = min(self.base_backoff * (2 ** host['opens']), self.max_backoff)
+                host['state'] = OPEN
+                host['opens'] += 1
+                host['retry_at'] = now + backoff
+
+        self._update(fail)
+
+    def get_state(self, key):
+        """返回主机的熔断状态字典，没有记录时为closed"""
+        with self._lock:
+            self._load()
+            return dict(self._data['hosts'].get(key) or self._new_host())
+
+    def get_all(self):
+        with self._lock:
+            self._load()
+            return {key: dict(host) for key, host in self._data['hosts'].items()}
+
+    # ---- 最近一次获取成功的状态 ----
+
+    def save_snapshots(self, snapshots):
+        """保存 {服务器名: 状态} ，状态中应包含 updated_at"""
+        if not snapshots:
+            return
+
+        def save(data):
+            data['snapshots'].update(snapshots)
+
+        self._update(save)
+
+    def get_snapshot(self, name):
+        with self._lock:
+            self._load()
+            snapshot = self._data['snapshots'].get(name)
+            return dict(snapshot) if snapshot else None
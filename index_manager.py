@@ -0,0 +1,176 @@
+import os
+import threading
+
+class IndexManager:
+    """配置和状态数据的内存二级索引
+
+    - container -> (用户名, 任务)
+    - 用户名 -> {container: 任务}
+    - 服务器 -> {gpu编号: 用户名}
+    - 用户组 -> {用户名}
+
+    状态索引由 StateStore 的修改通知增量维护；数据库文件发生变化（任何进程提交写事务）后，
+    下一次查询时比较一次版本号，与已应用的版本不一致（其他进程修改过）时整体重建。
+    文件未变化时查询只读内存，不访问数据库。
+    用户组索引在配置监视器通知users段变化时重建；没有配置监视器时按配置文件版本判断。
+    """
+
+    def __init__(self, config_manager, state_store):
+        self.config_manager = config_manager
+        self.state_store = state_store
+        self._lock = threading.RLock()
+
+        self._version = None  # 已应用的状态版本，None表示需要重建
+        self._state_key = None  # 上次确认版本时数据库文件的状态
+        self._task_by_container = {}
+        self._tasks_by_user = {}
+        self._gpus_by_server = {}
+
+        self.config_watcher = None  # 将在set_config_watcher中设置
+        self._config_key = None
+        self._groups_ready = False
+        self._users_by_group = {}
+
+        state_store.add_listener(self._on_state_change)
+
+    def set_config_watcher(self, config_watcher):
+        """设置配置监视器，users段变化时重建用户组索引"""
+        self.config_watcher = config_watcher
+        config_watcher.subscribe(self._on_config_change, ('users',))
+
+    def _on_config_change(self, changed, config):
+        self._build_groups(config)
+
+    # ---- 状态索引 ----
+
+    def _file_key(self):
+        """数据库文件和WAL文件的 (inode, 大小, 修改时间)，任何进程提交写事务后都会变化"""
+        key = []
+        for path in (self.state_store.db_file, f"{self.state_store.db_file}-wal"):
+            try:
+                stat = os.stat(path)
+                key.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                key.append(None)
+        return tuple(key)
+
+    def _ensure_state(self):
+        """数据库文件变化后确认版本，不一致时从数据库重建状态索引"""
+        # 先取文件状态再查询版本：两者之间的提交会使下一次查询再确认一次
+        key = self._file_key()
+        with self._lock:
+            if self._version is not None and key == self._state_key:
+                return
+        version = self.state_store.get_version()
+        with self._lock:
+            if version == self._version:
+                self._state_key = key
+                return
+        self._rebuild_state(key)
+
+    def _rebuild_state(self, key):
+        version, tasks, usage = self.state_store.snapshot()
+        with self._lock:
+            self._state_key = key
+            self._task_by_container = {}
+            self._tasks_by_user = {}
+            for username, task in tasks:
+                self._add_task(username, task)
+            self._gpus_by_server = usage
+            self._version = version
+
+    def _add_task(self, username, task):
+        self._task_by_container[task['container']] = (username, task)
+        self._tasks_by_user.setdefault(username, {})[task['container']] = task
+
+    def _remove_task(self, container):
+        username, task = self._task_by_container.pop(container, (None, None))
+        if username is not None:
+            user_tasks = self._tasks_by_user.get(username, {})
+            user_tasks.pop(container, None)
+            if not user_tasks:
+                self._tasks_by_user.pop(username, None)
+        return username, task
+
+    def _release(self, server_name, gpus, username=None):
+        usage = self._gpus_by_server.get(server_name, {})
+        for gpu in gpus:
+            if username is None or usage.get(gpu) == username:
+                usage.pop(gpu, None)
+
+    def _on_state_change(self, version, event, data):
+        """应用本进程提交的修改；版本不连续时标记为需要重建"""
+        with self._lock:
+            if self._version is None or version != self._version + 1 or event == 'reset':
+                self._version = None
+                return
+
+            if event == 'allocate':
+                usage = self._gpus_by_server.setdefault(data['server'], {})
+                for gpu in data['gpus']:
+                    usage[gpu] = data['username']
+            elif event == 'release':
+                self._release(data['server'], data['gpus'], data['username'])
+            elif event == 'add_task':
+                self._remove_task(data['task']['container'])
+                self._add_task(data['username'], data['task'])
+            elif event == 'remove_task':
+                task = data['task']
+                self._remove_task(task['container'])
+                self._release(task['server'], task['gpus'], data['username'])
+            else:
+                self._version = None
+                return
+            self._version = version
+
+    def get_task(self, container_name):
+        """按容器名查找任务，返回 (用户名, 任务) 或 (None, None)"""
+        self._ensure_state()
+        with self._lock:
+            return self._task_by_container.get(container_name, (None, None))
+
+    def get_user_tasks(self, username):
+        """获取用户的所有任务记录"""
+        self._ensure_state()
+        with self._lock:
+            return list(self._tasks_by_user.get(username, {}).values())
+
+    def get_gpu_usage(self, server_name):
+        """获取服务器的GPU使用情况 {gpu编号: 用户名}"""
+        self._ensure_state()
+        with self._lock:
+            return dict(self._gpus_by_server.get(server_name, {}))
+
+    # ---- 用户组索引 ----
+
+    def _build_groups(self, config, key=None):
+        users_by_group = {}
+        for username, user_info in (config.get('users') or {}).items():
+            # 没有指定用户组的用户属于default组（与main.py、GroupManager相同）
+            users_by_group.setdefault(user_info.get('group', 'default'), set()).add(username)
+        with self._lock:
+            self._users_by_group = users_by_group
+            self._config_key = key
+            self._groups_ready = True
+
+    def _ensure_groups(self):
+        """获取最新的用户组索引：有监视器时由变化通知重建，否则在配置文件变化后重建"""
+        if self.config_watcher:
+            self.config_watcher.check()
+            if self._groups_ready:
+                return
+            key = None
+        else:
+            key = self.config_manager.get_version()
+            with self._lock:
+                if key is not None and key == self._config_key:
+                    return
+        config = self.config_manager.load_config()
+        if config is not None:
+            self._build_groups(config, key)
+
+    def get_group_users(self, group_name):
+        """获取用户组内的所有用户名"""
+        self._ensure_groups()
+        with self._lock:
+            return set(self._users_by_group.get(group_name, ()))
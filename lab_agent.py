@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""GPU服务器上的常驻代理（由agent_client.py通过SSH上传并启动）
+
+标准输入每行一个JSON请求，标准输出每行一个JSON响应或事件：
+    请求  {"id": 1, "op": "gpus"}
+    响应  {"id": 1, "ok": true, "data": [...]}
+    事件  {"event": "container", "action": "die", ...}
+
+GPU信息通过NVML读取，容器、镜像通过Docker Engine API（/var/run/docker.sock）读取，
+监听端口读取/proc/net/tcp，查询时不再启动nvidia-smi、docker等进程。
+只使用标准库，标准输入关闭（SSH通道断开）时退出。
+"""
+import ctypes
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+DOCKER_SOCKET = '/var/run/docker.sock'
+GPU_POLL_INTERVAL = 5
+
+_write_lock = threading.Lock()
+
+
+def send(message):
+    line = json.dumps(message, ensure_ascii=False) + '\n'
+    with _write_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+class _DockerConnection(http.client.HTTPConnection):
+    """经由Unix socket的HTTP连接"""
+
+    def __init__(self, timeout=30):
+        super().__init__('localhost', timeout=timeout)
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(DOCKER_SOCKET)
+        self.sock = sock
+
+
+class DockerAPI:
+    """Docker Engine API客户端，保持一个keep-alive连接"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def get(self, path):
+        with self._lock:
+            for attempt in range(2):
+                if self._conn is None:
+                    self._conn = _DockerConnection()
+                try:
+                    self._conn.request('GET', path)
+                    response = self._conn.getresponse()
+                    body = response.read()
+                except (OSError, http.client.HTTPException):
+                    # 连接被dockerd关闭：重连后重试一次
+                    self._conn.close()
+                    self._conn = None
+                    if attempt:
+                        raise
+                    continue
+                if response.status >= 400:
+                    raise RuntimeError('Docker API %s 返回 %d：%s' % (path, response.status, body[:200]))
+                return json.loads(body.decode('utf-8'))
+
+    def events(self, filters):
+        """流式读取事件（独立连接），逐个产出事件字典"""
+        conn = _DockerConnection(timeout=None)
+        conn.request('GET', '/events?filters=' + _quote(json.dumps(filters)))
+        response = conn.getresponse()
+        try:
+            while True:
+                line = response.readline()
+                if not line:
+                    return
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            conn.close()
+
+
+def _quote(text):
+    from urllib.parse import quote
+    return quote(text, safe='')
+
+
+class _NvmlMemory(ctypes.Structure):
+    _fields_ = [('total', ctypes.c_ulonglong), ('free', ctypes.c_ulonglong), ('used', ctypes.c_ulonglong)]
+
+
+class _NvmlUtilization(ctypes.Structure):
+    _fields_ = [('gpu', ctypes.c_uint), ('memory', ctypes.c_uint)]
+
+
+class GPUReader:
+    """通过NVML读取GPU状态；没有NVML时退回nvidia-smi"""
+
+    def __init__(self):
+        self._nvml = None
+        try:
+            nvml = ctypes.CDLL('libnvidia-ml.so.1')
+            if nvml.nvmlInit_v2() == 0:
+                self._nvml = nvml
+        except OSError:
+            pass
+
+    @property
+    def backend(self):
+        return 'nvml' if self._nvml else 'nvidia-smi'
+
+    def read(self):
+        if self._nvml is None:
+            return self._read_smi()
+        nvml = self._nvml
+        count = ctypes.c_uint()
+        self._check(nvml.nvmlDeviceGetCount_v2(ctypes.byref(count)))
+        gpus = []
+        for index in range(count.value):
+            handle = ctypes.c_void_p()
+            self._check(nvml.nvmlDeviceGetHandleByIndex_v2(index, ctypes.byref(handle)))
+            name = ctypes.create_string_buffer(96)
+            self._check(nvml.nvmlDeviceGetName(handle, name, 96))
+            memory = _NvmlMemory()
+            self._check(nvml.nvmlDeviceGetMemoryInfo(handle, ctypes.byref(memory)))
+            util = _NvmlUtilization()
+            self._check(nvml.nvmlDeviceGetUtilizationRates(handle, ctypes.byref(util)))
+            mib = 1024 * 1024
+            gpus.append({
+                'index': index,
+                'name': name.value.decode('utf-8', 'replace'),
+                'total_memory': float(memory.total // mib),
+                'used_memory': float(memory.used // mib),
+                'free_memory': float(memory.free // mib),
+                'utilization': float(util.gpu)
+            })
+        return gpus
+
+    @staticmethod
+    def _check(ret):
+        if ret != 0:
+            raise RuntimeError('NVML调用失败，错误码 %d' % ret)
+
+    @staticmethod
+    def _read_smi():
+        output = subprocess.check_output([
+            'nvidia-smi',
+            '--query-gpu=index,name,memory.total,memory.used,memory.free,utilization.gpu',
+            '--format=csv,noheader,nounits'
+        ]).decode('utf-8')
+        gpus = []
+        for line in output.strip().split('\n'):
+            index, name, total_mem, used_mem, free_mem, util = line.split(', ')
+            gpus.append({
+                'index': int(index), 'name': name, 'total_memory': float(total_mem),
+                'used_memory': float(used_mem), 'free_memory': float(free_mem), 'utilization': float(util)
+            })
+        return gpus
+
+
+def _container(item):
+    return {
+        'container_id': item['Id'][:12],
+        'name': item['Names'][0].lstrip('/') if item.get('Names') else '',
+        'image': item.get('Image'),
+        'state': item.get('State'),
+        'status': item.get('Status'),
+        'created': item.get('Created'),
+        'labels': item.get('Labels') or {}
+    }
+
+
+def listening_ports():
+    """读取/proc/net/tcp和tcp6中处于LISTEN状态的端口"""
+    ports = set()
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == '0A':
+                        ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+        except OSError:
+            pass
+    return sorted(ports)
+
+
+class Agent:
+    def __init__(self):
+        self.docker = DockerAPI()
+        self.gpu = GPUReader()
+        self._subscribed = False
+
+    def handle(self, request):
+        op = request.get('op')
+        if op == 'hello':
+            return {'pid': os.getpid(), 'gpu_backend': self.gpu.backend, 'python': sys.version.split()[0]}
+        if op == 'gpus':
+            return self.gpu.read()
+        if op == 'containers':
+            path = '/containers/json?all=1' if request.get('all') else '/containers/json'
+            return [_container(item) for item in self.docker.get(path)]
+        if op == 'images':
+            return [
+                {'name': tag, 'size': item.get('Size', 0), 'created': item.get('Created')}
+                for item in self.docker.get('/images/json')
+                for tag in (item.get('RepoTags') or [])
+                if tag != '<none>:<none>'
+            ]
+        if op == 'ports':
+            return listening_ports()
+        if op == 'subscribe':
+            if not self._subscribed:
+                self._subscribed = True
+                threading.Thread(target=self._container_events, daemon=True).start()
+                threading.Thread(target=self._gpu_events, daemon=True).start()
+            return True
+        raise ValueError('未知操作：%s' % op)
+
+    def _container_events(self):
+        """转发容器启动、停止、删除事件"""
+        filters = {'type': ['container'], 'event': ['start', 'die', 'destroy', 'create']}
+        while True:
+            try:
+                for event in self.docker.events(filters):
+                    attributes = event.get('Actor', {}).get('Attributes', {})
+                    send({
+                        'event': 'container',
+                        'action': event.get('Action') or event.get('status'),
+                        'container_id': (event.get('id') or '')[:12],
+                        'name': attributes.get('name'),
+                        'time': event.get('time')
+                    })
+            except Exception as e:
+                send({'event': 'error', 'error': '读取Docker事件失败：%s' % e})
+            time.sleep(5)
+
+    def _gpu_events(self):
+        """GPU显存或利用率变化时推送"""
+        last = None
+        while True:
+            try:
+                gpus = self.gpu.read()
+                summary = [(g['index'], int(g['used_memory']) // 256, int(g['utilization']) // 10) for g in gpus]
+                if summary != last:
+                    last = summary
+                    send({'event': 'gpus', 'data': gpus})
+            except Exception as e:
+                send({'event': 'error', 'error': '读取GPU状态失败：%s' % e})
+            time.sleep(GPU_POLL_INTERVAL)
+
+
+def main():
+    agent = Agent()
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        request = {}
+        try:
+            request = json.loads(line)
+            send({'id': request.get('id'), 'ok': True, 'data': agent.handle(request)})
+        except Exception as e:
+            send({'id': request.get('id'), 'ok': False, 'error': str(e)})
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,66 @@
-import yaml
-import paramiko
 import getpass
 import time
 from user_manager import UserManager
 from config_manager import ConfigManager
 from ssh_manager import SSHManager
+from ssh_broker import SOCKET_FILE as SSH_BROKER_SOCKET
 from docker_manager import DockerManager
 from log_manager import LogManager
 from group_manager import GroupManager
 from gpu_manager import GPUManager
 from terminal_manager import TerminalManager
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from status_updater import StatusUpdater
 import os
 import sys
 import json
 from registry_manager import RegistryManager
+from batch_executor import run_batch
+from cluster_fanout import ClusterFanout
+from bulk_stop import BulkStopper
+from docker_api import DockerAPIManager, DockerAPIError
+from container_inventory import ContainerInventory
+from container_labels import (
+    PS_LABEL_FORMAT, api_owner_filters, build_labels, label_args, labels_from_fields, name_filter, owner_filter,
+    parse_labels
+)
+from command_metrics import CommandMetrics
+from agent_client import AgentManager, AgentError, format_size, running_for
+from health_manager import HealthManager
+from state_store import StateStore
+from index_manager import IndexManager
+from allocation_journal import AllocationJournal
+from config_watcher import ConfigWatcher, apply_sections
+
+GPU_QUERY_CMD = (
+    "nvidia-smi --query-gpu=index,gpu_name,memory.total,memory.used,memory.free,utilization.gpu "
+    "--format=csv,noheader,nounits"
+)
+METRICS_FILE = 'command_metrics.json'
+# 输出中包含创建容器时附加的标签（所属用户、GPU等），见container_labels.py
+DOCKER_PS_FORMAT = "{{.ID}}\t{{.Names}}\t{{.Status}}\t{{.RunningFor}}\t" + PS_LABEL_FORMAT
+DOCKER_PS_CMD = f"docker ps --format '{DOCKER_PS_FORMAT}'"
 
 class LabServer:
     def __init__(self):
+        self.started_at = time.perf_counter()
         self.config_manager = ConfigManager('config.yaml')
         self.log_manager = LogManager('server.log')
+        # 远程命令延迟统计，慢命令写入server.log
+        CommandMetrics().set_log_manager(self.log_manager)
         self.ssh_manager = SSHManager()
+        # 本地SSH代理（ssh_broker.py）在运行时复用它持有的连接，否则直连
+        self.ssh_manager.use_broker(SSH_BROKER_SOCKET)
+        # 主机熔断：不可达的主机在退避期内直接失败，状态与check_container_time.py、SSH代理共享
+        self.health_manager = HealthManager('host_health.json')
+        self.ssh_manager.set_health_manager(self.health_manager)
         self.docker_manager = DockerManager()
+        # GPU分配和任务记录保存在SQLite中，首次启动时从config.yaml迁移
+        self.state_store = StateStore('state.db')
+        self.state_store.migrate_from_config(self.config_manager)
+        # 状态修改追加写入分配日志，用于审计和回放
+        self.allocation_journal = AllocationJournal('allocations.journal')
+        self.allocation_journal.attach(self.state_store)
+        self.index_manager = IndexManager(self.config_manager, self.state_store)
         self.config = self.config_manager.load_config()
         self.current_user = None
         self.cached_server_status = None
@@ -30,11 +68,45 @@ class LabServer:
         self.user_manager.set_config_manager(self.config_manager)
         self.group_manager = GroupManager(self.config)
         self.group_manager.set_config_manager(self.config_manager)
+        self.group_manager.set_index_manager(self.index_manager)
         self.gpu_manager = GPUManager(self.config)
         self.gpu_manager.set_config_manager(self.config_manager)
+        self.gpu_manager.set_state_store(self.state_store)
+        self.gpu_manager.set_index_manager(self.index_manager)
+        # 配置变化通知：各管理器只在关心的配置段变化时刷新，而不是每次操作都重新加载
+        self.config_watcher = ConfigWatcher(self.config_manager)
+        self.config_watcher.subscribe(self._on_config_change)
+        self.user_manager.set_config_watcher(self.config_watcher)
+        self.group_manager.set_config_watcher(self.config_watcher)
+        self.gpu_manager.set_config_watcher(self.config_watcher)
+        self.index_manager.set_config_watcher(self.config_watcher)
+        self.config_watcher.start()
         self.last_status_update = 0
         self.status_update_interval = 300  # 5分钟更一次
         self.max_workers = 10  # 最大并行连接数
+        # 集群查询：所有服务器并发执行，status_deadline秒内未返回的服务器不再等待
+        # 各服务器上的命令与本进程的其他Docker操作共享按服务器、按类型划分的并发通道
+        self.fanout = ClusterFanout(self.ssh_manager, max_connect_workers=self.max_workers,
+                                    docker_manager=self.docker_manager)
+        # 批量停止容器：每台服务器一条 docker rm -f，各服务器并发，GPU在一个事务中释放
+        self.bulk_stopper = BulkStopper(self.fanout, self.gpu_manager)
+        # Docker Engine API（经SSH通道上的 docker system dial-stdio，keep-alive），返回结构化JSON
+        self.docker_api = DockerAPIManager(self.ssh_manager)
+        self.status_deadline = 8
+        # 容器清单：每台服务器建立一次快照后由docker events实时更新，任务列表直接读内存
+        self.container_inventory = ContainerInventory(self.ssh_manager)
+        self.container_inventory.subscribe(self._on_agent_event)
+        if self._inventory_enabled():
+            self.container_inventory.start_all(self.config['servers'])
+        self.unavailable_servers = []  # [(服务器名, 原因)]
+        self.warm_futures = {}  # 服务器名 -> 预热连接的Future
+        self.login_completed_at = None
+        # 可选：在各GPU服务器上运行常驻代理（lab_agent.py），以JSON返回GPU、容器、镜像、端口信息
+        self.agent_manager = None
+        if (self.config.get('agent_settings') or {}).get('enabled'):
+            self.agent_manager = AgentManager(self.ssh_manager)
+            self.agent_manager.subscribe(self._on_agent_event)
+            self.agent_manager.start_all(self.config['servers'])
         
         # 同步GPU使用情况
         # self.gpu_manager.sync_gpu_usage()
@@ -44,8 +116,7 @@ class LabServer:
         self.registry_manager = RegistryManager(self.config)
 
     def load_config(self):
-        with open('config.yaml', 'r', encoding='utf-8') as f:
-            return yaml.safe_load(f)
+        return self.config_manager.load_config()
 
     def login(self):
         while True:  # 添加循环，允许用户重试
@@ -57,6 +128,9 @@ class LabServer:
                     print(f"错误：用户 {username} 不存在")
                     continue  # 重新开始循环
 
+                # 用户输入密码的同时在后台建立SSH连接
+                self.warm_up_connections(username)
+
                 while True: 
                     password = getpass.getpass("请输入密码(输入0返回用户名输入): ")
                     if password == '0':  # 允许户输入0回用户名入
@@ -66,6 +140,7 @@ class LabServer:
                     user_info = self.config['users'][username]
                     if user_info['password'] == password:
                         self.current_user = username
+                        self.login_completed_at = time.perf_counter()
                         print(f"欢迎, {username}!")
                         print(f"用户角色: {user_info['role']}")
                         return True
@@ -77,6 +152,32 @@ class LabServer:
                 print(f"登录过程中出错：{str(e)}")
                 return False
 
+    def warm_up_connections(self, username):
+        """后台并行连接所有服务器，用户组允许使用的服务器优先
+
+        菜单中的操作取用尚未连接好的服务器时，只等待该服务器的握手完成。
+        """
+        user_group = self.config['users'][username].get('group', 'default')
+        allowed = (self.config['user_groups'].get(user_group) or {}).get('allowed_servers', [])
+        servers = self.config['servers']
+        ordered = {name: servers[name] for name in allowed if name in servers}
+        ordered.update((name, info) for name, info in servers.items() if name not in ordered)
+        self.warm_futures.update(self.ssh_manager.warm_up(ordered))
+
+    def _report_startup_time(self):
+        """记录从启动到第一次显示菜单的时间"""
+        now = time.perf_counter()
+        ready = [f for f in self.warm_futures.values() if f.done() and f.exception() is None]
+        handshakes = [f.result() for f in ready]
+        message = (
+            f"启动到首个菜单 {now - self.started_at:.2f}秒（含输入用户名密码的时间），"
+            f"登录后到首个菜单 {now - self.login_completed_at:.2f}秒；"
+            f"预热连接 {len(ready)}/{len(self.warm_futures)} 台已完成"
+        )
+        if handshakes:
+            message += f"，最长握手 {max(handshakes):.2f}秒"
+        self.log_manager.log_info(message)
+
     def check_gpu_status(self, server_name):
         """获取服务器GPU状态"""
         if server_name not in self.config['servers']:
@@ -84,27 +185,18 @@ class LabServer:
             return None
         
         server = self.config['servers'][server_name]
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         
         try:
             print(f"正在连接到服务器 {server_name} ({server['host']})...")
-            ssh.connect(
-                hostname=server['host'],
-                port=server['port'],
-                username=server['username'],
-                password=server['password'],
-                timeout=10
-            )
-            
-            # 获取GPU详细信息
-            cmd = (
-                "nvidia-smi --query-gpu=index,gpu_name,memory.total,memory.used,memory.free,utilization.gpu "
-                "--format=csv,noheader,nounits"
-            )
-            stdin, stdout, stderr = ssh.exec_command(cmd)
-            output = stdout.read().decode()
-            error = stderr.read().decode()
+            with self.ssh_manager.connection(server, 'check_gpu_status') as ssh:
+                # 获取GPU详细信息
+                cmd = (
+                    "nvidia-smi --query-gpu=index,gpu_name,memory.total,memory.used,memory.free,utilization.gpu "
+                    "--format=csv,noheader,nounits"
+                )
+                stdin, stdout, stderr = ssh.exec_command(cmd)
+                output = stdout.read().decode()
+                error = stderr.read().decode()
             
             if error:
                 print(f"获取GPU状态时出错：{error}")
@@ -127,11 +219,28 @@ class LabServer:
         except Exception as e:
             print(f"连接服务器失败：{str(e)}")
             return None
-        finally:
-            ssh.close()
 
-    def get_server_docker_images(self, ssh):
+    def get_server_docker_images(self, ssh, server_name=None):
         """获取服务器上的Docker镜像列表"""
+        if server_name:
+            server_info = self.config['servers'][server_name]
+            images = None
+            if self.agent_manager:
+                try:
+                    images = self.agent_manager.query(server_name, server_info, 'images')
+                except AgentError as e:
+                    print(f"通过代理获取镜像列表失败：{str(e)}")
+            if images is None and self.docker_api.available(server_name):
+                try:
+                    images = self.docker_api.list_images(server_name, server_info)
+                except DockerAPIError as e:
+                    print(f"通过Docker API获取镜像列表失败，改为直接执行命令：{str(e)}")
+            if images is not None:
+                return [
+                    {'name': image['name'], 'size': format_size(image['size']), 'size_bytes': image['size'],
+                     'source': '本地镜像'}
+                    for image in images
+                ]
         try:
             stdin, stdout, stderr = ssh.exec_command('docker images --format "{{.Repository}}:{{.Tag}}\t{{.Size}}"')
             error = stderr.read().decode()
@@ -155,10 +264,10 @@ class LabServer:
             print(f"获取Docker镜像列表出错：{str(e)}")
             return []
 
-    def get_available_images(self, ssh):
+    def get_available_images(self, ssh, server_name=None):
         """获取所有可用的镜像（包括本地和仓库）"""
         # 获取本地镜像
-        local_images = self.get_server_docker_images(ssh)
+        local_images = self.get_server_docker_images(ssh, server_name)
         
         # 获取仓库镜像
         registry_images = self.get_registry_images(ssh)
@@ -186,7 +295,7 @@ class LabServer:
         
         return all_images
 
-    def pull_docker_image(self, ssh, image_name, registry_info):
+    def pull_docker_image(self, ssh, image_name, registry_info, server_info):
         """从指定仓库拉取Docker镜像"""
         try:
             print(f"正在从 {registry_info['name']} 拉取镜像 {image_name}...")
@@ -231,16 +340,18 @@ class LabServer:
             print(f"开始在远程服务器上拉取镜像：{full_image_name}")
             print(f"执行命令：{pull_cmd}")
             
-            stdin, stdout, stderr = ssh.exec_command(pull_cmd)
-            
-            # 实时显示拉取进度
-            while True:
-                line = stdout.readline()
-                if not line:
-                    break
-                print(line.strip())
-            
-            error = stderr.read().decode()
+            # 拉取占用该服务器的long通道，不阻塞其他服务器和查询命令
+            with self.docker_manager.lane(self.docker_manager.host_of(server_info), pull_cmd):
+                stdin, stdout, stderr = ssh.exec_command(pull_cmd)
+                
+                # 实时显示拉取进度
+                while True:
+                    line = stdout.readline()
+                    if not line:
+                        break
+                    print(line.strip())
+                
+                error = stderr.read().decode()
             if error:
                 if "Error" in error:
                     if "Client.Timeout exceeded" in error:
@@ -289,76 +400,89 @@ class LabServer:
         """在数据服务器上创建用户的数据目录"""
         try:
             # 连接到数据服务器
-            data_ssh = paramiko.SSHClient()
-            data_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            
             data_server = self.config['data_server']
-            data_ssh.connect(
-                hostname=data_server['host'],
-                port=data_server['port'],
-                username=data_server['username'],
-                password=data_server['password']
-            )
-
-            # 创建用户目录
-            user_dir = f"{data_server['data_root']}/{username}"
+            with self.ssh_manager.connection(data_server, 'create_user_data_dir') as data_ssh:
+                # 创建用户目录
+                user_dir = f"{data_server['data_root']}/{username}"
             
-            # 检查目录是否存在
-            check_cmd = f"[ -d {user_dir} ] && echo 'exists' || echo 'not exists'"
-            stdin, stdout, stderr = data_ssh.exec_command(check_cmd)
-            if stdout.read().decode().strip() == 'exists':
-                print(f"用户目录已存在：{user_dir}")
-            else:
-                # 创建目录并设置权限
-                cmd = f"sudo mkdir -p {user_dir} && sudo chmod 755 {user_dir}"
-                print(f"正在创建用户数据目录：{user_dir}")
-                stdin, stdout, stderr = data_ssh.exec_command(cmd)
-                error = stderr.read().decode()
+                # 检查目录是否存在
+                check_cmd = f"[ -d {user_dir} ] && echo 'exists' || echo 'not exists'"
+                stdin, stdout, stderr = data_ssh.exec_command(check_cmd)
+                if stdout.read().decode().strip() == 'exists':
+                    print(f"用户目录已存在：{user_dir}")
+                else:
+                    # 创建目录并设置权限
+                    cmd = f"sudo mkdir -p {user_dir} && sudo chmod 755 {user_dir}"
+                    print(f"正在创建用户数据目录：{user_dir}")
+                    stdin, stdout, stderr = data_ssh.exec_command(cmd)
+                    error = stderr.read().decode()
                 
-                if error:
-                    print(f"创建用户数据目录失败：{error}")
-                    return None
+                    if error:
+                        print(f"创建用户数据目录失败：{error}")
+                        return None
         except Exception as e:
             print(f"创建用户数据目录时出错：{str(e)}")
             return None
 
-    def _save_config(self):
-        """保存置到文件"""
-        with open('config.yaml', 'w', encoding='utf-8') as f:
-            yaml.dump(self.config, f, allow_unicode=True)
+    def _inventory_enabled(self):
+        """容器清单需在配置中启用（inventory_settings: {enabled: true}）
 
-    def get_server_status(self, server_item):
-        """获取单个服务器状态的方法"""
-        idx, (server_name, server_info) = server_item
-        try:
-            print(f"正在连接服务器 {server_name} ({server_info['host']})...")
-            ssh = self.ssh_manager.get_connection(server_info)
-            if ssh:
-                print(f"连接成功，正在获取GPU信息...")
-                gpu_info = self.check_gpu_status_with_ssh(ssh, server_name)
-                if gpu_info is not None:
-                    gpu_usage = self.gpu_manager.get_gpu_usage(server_name)
-                    allocated_gpus = len(gpu_usage)
-                    total_gpus = len(gpu_info)
-                    gpu_model = gpu_info[0]['name'] if gpu_info else "未知"
-                    avg_util = sum(gpu['utilization'] for gpu in gpu_info) / total_gpus
-                    
-                    return str(idx), {
-                        'name': server_name,
-                        'host': server_info['host'],
-                        'gpu_info': gpu_info,
-                        'used_gpus': allocated_gpus,
-                        'total_gpus': total_gpus,
-                        'gpu_model': gpu_model,
-                        'avg_util': avg_util
-                    }
-            return None
-        except Exception as e:
-            print(f"连接或获取信息失败：{str(e)}")
-            return None
+        每台服务器占用一个直连的长期SSH通道并在启动时 docker inspect 所有容器，只适合常驻进程；
+        启用了本地SSH代理时不建立，避免每个进程各自与所有服务器握手。
+        """
+        if not (self.config.get('inventory_settings') or {}).get('enabled'):
+            return False
+        return self.ssh_manager.get_broker() is None
+
+    def _on_config_change(self, changed, config):
+        """配置文件变化时原地更新发生变化的段，各管理器共享同一个配置字典"""
+        apply_sections(self.config, changed, config)
+        if 'servers' in changed and self._inventory_enabled():
+            # 新增的服务器也建立容器清单
+            self.container_inventory.start_all(self.config['servers'])
+
+    def _on_agent_event(self, server_name, event):
+        """代理或容器清单推送的变化：容器变化使状态缓存失效，GPU变化直接更新缓存"""
+        if event['event'] == 'container':
+            self.last_status_update = 0
+        elif event['event'] == 'gpus' and self.cached_server_status:
+            for idx, status in list(self.cached_server_status.items()):
+                if status['name'] == server_name and not status.get('stale'):
+                    self.cached_server_status[idx] = self._build_server_status(
+                        server_name, self.config['servers'][server_name], event['data'], status['tasks']
+                    )
+
+    def _reload_config(self):
+        """事务提交后刷新内存中的配置"""
+        self.config_watcher.check()
+
+    def _build_server_status(self, server_name, server_info, gpu_info, tasks):
+        """由一台服务器的GPU信息和容器列表生成状态信息"""
+        gpu_usage = self.gpu_manager.get_gpu_usage(server_name)
+        allocated_gpus = len(gpu_usage)
+        total_gpus = len(gpu_info)
+        gpu_model = gpu_info[0]['name'] if gpu_info else "未知"
+        avg_util = sum(gpu['utilization'] for gpu in gpu_info) / total_gpus if total_gpus else 0
+        return {
+            'name': server_name,
+            'host': server_info['host'],
+            'gpu_info': gpu_info,
+            'used_gpus': allocated_gpus,
+            'total_gpus': total_gpus,
+            'gpu_model': gpu_model,
+            'avg_util': avg_util,
+            'tasks': tasks,
+            'updated_at': time.time(),
+            'stale': False
+        }
 
     def get_all_servers_status(self):
-        """获取所有服的状态息（并行处）"""
+        """获取所有服的状态息（并行处）
+
+        所有服务器同时查询，整体不超过 status_deadline 秒；超时或出错的服务器
+        显示上一次获取到的状态（标记为过期，跨进程保存在host_health.json中），
+        从未获取成功的列入 unavailable_servers。
+        """
         current_time = time.time()
         
         # 如果缓存的状态信息仍然有且不是强制刷新，直接返回
@@ -367,24 +491,64 @@ class LabServer:
             self.last_status_update != 0):  # 添加这个条件
             return self.cached_server_status
         
+        servers = self.config['servers']
+        order = {name: str(idx) for idx, name in enumerate(servers, 1)}
         server_gpu_status = {}
+        fresh = {}
+        unavailable = []
+
+        def record(name, status, reason):
+            if status is not None:
+                fresh[name] = status
+            else:
+                snapshot = self.health_manager.get_snapshot(name)
+                if snapshot is not None:
+                    status = dict(snapshot, stale=True, stale_reason=reason)
+            if status is not None:
+                server_gpu_status[order[name]] = status
+            else:
+                unavailable.append((name, reason))
+
+        def on_result(result):
+            name = result['server']
+            status = None
+            reason = result['error']
+            if result['status'] == 'ok':
+                gpu_result, ps_result = result['results']
+                reason = "无法获取GPU信息"
+                if gpu_result['stderr']:
+                    print(f"获取GPU状态时出错：{gpu_result['stderr']}")
+                else:
+                    gpu_info = self._parse_gpu_info(gpu_result['stdout'])
+                    tasks = self._parse_task_list(ps_result['stdout'], name)
+                    status = self._build_server_status(name, servers[name], gpu_info, tasks)
+            else:
+                print(f"获取服务器 {name} 状态失败：{reason}")
+            record(name, status, reason)
+
+        # 有常驻代理的服务器直接查询代理（结构化数据，不启动远程进程），其余服务器执行命令
+        remaining = servers
+        if self.agent_manager:
+            agent_results = self.agent_manager.query_all(
+                servers, ['gpus', 'containers'], timeout=self.status_deadline
+            )
+            for name, data in agent_results.items():
+                tasks = self._container_task_list(data['containers'], name)
+                record(name, self._build_server_status(name, servers[name], data['gpus'], tasks), None)
+            remaining = {name: info for name, info in servers.items() if name not in agent_results}
+            self.agent_manager.start_all(remaining)
+
+        if remaining:
+            self.fanout.run_batch(
+                remaining, [GPU_QUERY_CMD, DOCKER_PS_CMD], deadline=self.status_deadline,
+                operation='get_all_servers_status', on_result=on_result, lane='query'
+            )
         
-        # 使用线程池并行处理连接
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # 提交所有任务
-            futures = []
-            for idx, (name, info) in enumerate(self.config['servers'].items(), 1):
-                futures.append(executor.submit(self.get_server_status, (idx, (name, info))))
-            
-            # 收集结果
-            for future in as_completed(futures):
-                result = future.result()
-                if result:
-                    idx, status = result
-                    server_gpu_status[idx] = status
-        
+        self.health_manager.save_snapshots(fresh)
+
         # 更新缓存和时间戳
         self.cached_server_status = server_gpu_status
+        self.unavailable_servers = sorted(unavailable)
         self.last_status_update = current_time
         
         return server_gpu_status
@@ -392,11 +556,7 @@ class LabServer:
     def check_gpu_status_with_ssh(self, ssh, server_name):
         """用已有的SSH连接获取GPU状态"""
         try:
-            cmd = (
-                "nvidia-smi --query-gpu=index,gpu_name,memory.total,memory.used,memory.free,utilization.gpu "
-                "--format=csv,noheader,nounits"
-            )
-            stdin, stdout, stderr = ssh.exec_command(cmd)
+            stdin, stdout, stderr = ssh.exec_command(GPU_QUERY_CMD)
             output = stdout.read().decode()
             error = stderr.read().decode()
             
@@ -404,24 +564,74 @@ class LabServer:
                 print(f"获取GPU状态时出错：{error}")
                 return None
             
-            gpu_info = []
-            for line in output.strip().split('\n'):
-                index, name, total_mem, used_mem, free_mem, util = line.split(', ')
-                gpu_info.append({
-                    'index': int(index),
-                    'name': name,
-                    'total_memory': float(total_mem),
-                    'used_memory': float(used_mem),
-                    'free_memory': float(free_mem),
-                    'utilization': float(util)
-                })
-            
-            return gpu_info
+            return self._parse_gpu_info(output)
             
         except Exception as e:
             print(f"获取GPU状态失败：{str(e)}")
             return None
 
+    def _parse_gpu_info(self, output):
+        """解析nvidia-smi的CSV输出"""
+        gpu_info = []
+        for line in output.strip().split('\n'):
+            index, name, total_mem, used_mem, free_mem, util = line.split(', ')
+            gpu_info.append({
+                'index': int(index),
+                'name': name,
+                'total_memory': float(total_mem),
+                'used_memory': float(used_mem),
+                'free_memory': float(free_mem),
+                'utilization': float(util)
+            })
+        return gpu_info
+
+    def _task_entry(self, server_name, container_id, name, status, running_time, labels):
+        """任务列表中的一项；所属用户和GPU取自容器标签，没有标签的旧容器查任务记录"""
+        info = parse_labels(labels)
+        if info is not None:
+            owner, gpus = info['owner'], info['gpus']
+        else:
+            owner, task = self.index_manager.get_task(name)
+            gpus = task['gpus'] if task else []
+        return {
+            'server': server_name,
+            'container_id': container_id,
+            'name': name,
+            'status': status,
+            'running_time': running_time,
+            'owner': owner,
+            'gpus': gpus
+        }
+
+    def _parse_task_list(self, output, server_name, username=None):
+        """解析docker ps（DOCKER_PS_FORMAT）的输出；指定username时只保留属于该用户的容器"""
+        tasks = []
+        seen = set()
+        for line in output.strip().split('\n'):
+            if not line:
+                continue
+            fields = line.split('\t')
+            container_id, name, status, running_time = fields[:4]
+            if container_id in seen:
+                continue
+            seen.add(container_id)
+            task = self._task_entry(server_name, container_id, name, status, running_time,
+                                    labels_from_fields(fields[4:]))
+            if not username or task['owner'] == username:
+                tasks.append(task)
+        return tasks
+
+    def _container_task_list(self, containers, server_name, username=None):
+        """把容器清单、代理或Docker API返回的容器列表转换为与 _parse_task_list 相同的格式"""
+        tasks = []
+        for container in containers:
+            task = self._task_entry(server_name, container['container_id'], container['name'],
+                                    container['status'], running_for(container['created']),
+                                    container.get('labels'))
+            if not username or task['owner'] == username:
+                tasks.append(task)
+        return tasks
+
     def display_server_status(self, server_status):
         """显示服务器状态信息"""
         print("\n{:<5} {:<10} {:<15} {:<30} {:<10} {:<15} {:<20}".format(
@@ -447,32 +657,31 @@ class LabServer:
                 f"{info['used_gpus']}/{info['total_gpus']}",
                 allocated_info
             ))
+            if info.get('stale'):
+                age = int(time.time() - info['updated_at'])
+                print(f"      （{info['name']} 本次未响应，显示的是 {self._format_age(age)}前的状态：{info.get('stale_reason')}）")
+        for name, reason in self.unavailable_servers:
+            print(f"服务器 {name} 暂时无法获取状态：{reason}")
+
+    @staticmethod
+    def _format_age(seconds):
+        if seconds < 60:
+            return f"{seconds}秒"
+        if seconds < 3600:
+            return f"{seconds // 60}分钟"
+        return f"{seconds // 3600}小时{seconds % 3600 // 60}分钟"
 
     def create_dl_task(self):
-        ssh_connections = {}
         try:
             # 在创建任务前检查用户数据目录
             user_data_dir = self.config['users'][self.current_user].get('data_dir')
             if not user_data_dir:
                 print("正在为用户创建数据目录...")
-                data_ssh = None
-                try:
-                    data_ssh = paramiko.SSHClient()
-                    data_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    data_server = self.config['data_server']
-                    data_ssh.connect(
-                        hostname=data_server['host'],
-                        port=data_server['port'],
-                        username=data_server['username'],
-                        password=data_server['password']
-                    )
+                with self.ssh_manager.connection(self.config['data_server'], 'create_dl_task') as data_ssh:
                     user_data_dir = self.create_user_data_dir(data_ssh, self.current_user)
                     if not user_data_dir:
                         print("无法创建用户数据目录，请联系管理员")
                         return False
-                finally:
-                    if data_ssh:
-                        data_ssh.close()
 
             if not self.current_user:
                 print("请先登录")
@@ -511,6 +720,9 @@ class LabServer:
 
                     # 服务器选择成功，建立SSH连接
                     server_info = self.cached_server_status[server_choice]
+                    if server_info.get('stale'):
+                        print(f"服务器 {server_info['name']} 当前无法连接，请选择其他服务器")
+                        continue
                     server_name = server_info['name']
                     server = self.config['servers'][server_name]
 
@@ -527,68 +739,58 @@ class LabServer:
                         print(f"您已达到容器数量限制（最大{group_info['max_containers']}个）")
                         return False
                     
-                    # 创建SSH连接
-                    ssh = paramiko.SSHClient()
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(
-                        hostname=server['host'],
-                        port=server['port'],
-                        username=server['username'],
-                        password=server['password'],
-                        timeout=10
-                    )
-                    ssh_connections[server_name] = ssh
-
-                    # 获取可用的Docker镜像
-                    print("\n正在获取可用的Docker镜像...")
-                    available_images = self.get_available_images(ssh)
+                    # 占用一个SSH通道（复用刷新服务器状态时建立的连接）
+                    with self.ssh_manager.connection(server, 'create_dl_task') as ssh:
+                        # 获取可用的Docker镜像
+                        print("\n正在获取可用的Docker镜像...")
+                        available_images = self.get_available_images(ssh, server_name)
                     
-                    if not available_images:
-                        print("未找到可用的Docker镜像")
-                        return False
+                        if not available_images:
+                            print("未找到可用的Docker镜像")
+                            return False
                     
-                    # 显示镜像列表
-                    print("\n可用的Docker镜像：")
-                    print("\n{:<5} {:<50} {:<15} {:<10}".format("序号", "镜像名称", "大小", "来源"))
-                    print("-" * 80)
-                    for idx, img in enumerate(available_images, 1):
-                        print("{:<5} {:<50} {:<15} {:<10}".format(
-                            idx,
-                            img['name'],
-                            img['size'],
-                            img['source']
-                        ))
+                        # 显示镜像列表
+                        print("\n可用的Docker镜像：")
+                        print("\n{:<5} {:<50} {:<15} {:<10}".format("序号", "镜像名称", "大小", "来源"))
+                        print("-" * 80)
+                        for idx, img in enumerate(available_images, 1):
+                            print("{:<5} {:<50} {:<15} {:<10}".format(
+                                idx,
+                                img['name'],
+                                img['size'],
+                                img['source']
+                            ))
                     
-                    # 让用户选择镜像
-                    while True:
-                        image_choice = input("\n请选择镜像序号（b返回）: ").strip()
-                        if image_choice == 'b':
-                            break  # 跳出镜像选择循环，返回到服务器选择循环
+                        # 让用户选择镜像
+                        while True:
+                            image_choice = input("\n请选择镜像序号（b返回）: ").strip()
+                            if image_choice == 'b':
+                                break  # 跳出镜像选择循环，返回到服务器选择循环
                         
-                        try:
-                            idx = int(image_choice) - 1
-                            if 0 <= idx < len(available_images):
-                                image_name = available_images[idx]['name']
-                                image_source = available_images[idx]['source']
+                            try:
+                                idx = int(image_choice) - 1
+                                if 0 <= idx < len(available_images):
+                                    image_name = available_images[idx]['name']
+                                    image_source = available_images[idx]['source']
                                 
-                                # 如果是仓库镜像，需要先拉取
-                                if image_source == '仓库镜像':
-                                    print(f"\n选择的是仓库镜像，需要先拉取...")
-                                    registry_info = self.config['docker_registries'][0]  # 使用第一个仓库配置
-                                    if not self.pull_docker_image(ssh, image_name, registry_info):
-                                        print("镜像拉取失败")
-                                        continue
+                                    # 如果是仓库镜像，需要先拉取
+                                    if image_source == '仓库镜像':
+                                        print(f"\n选择的是仓库镜像，需要先拉取...")
+                                        registry_info = self.config['docker_registries'][0]  # 使用第一个仓库配置
+                                        if not self.pull_docker_image(ssh, image_name, registry_info, server):
+                                            print("镜像拉取失败")
+                                            continue
                                 
-                                # 创建容器
-                                return self.create_container(ssh, server_name, image_name)
-                            else:
-                                print("无效的序号，请重试")
-                        except ValueError:
-                            print("请输入有效的数字")
+                                    # 创建容器
+                                    return self.create_container(ssh, server_name, image_name)
+                                else:
+                                    print("无效的序号，请重试")
+                            except ValueError:
+                                print("请输入有效的数字")
                     
-                    if image_choice != 'b':
-                        # 继续处理...
-                        return self.create_container(ssh, server_name, image_name)
+                        if image_choice != 'b':
+                            # 继续处理...
+                            return self.create_container(ssh, server_name, image_name)
 
                 except Exception as e:
                     print(f"操作失败：{str(e)}")
@@ -598,13 +800,20 @@ class LabServer:
             print(f"创建任务失败：{str(e)}")
             return False
 
-        finally:
-            # 确保所有SSH连接都被关闭
-            for ssh in ssh_connections.values():
-                try:
-                    ssh.close()
-                except:
-                    pass
+    def _check_port_and_name(self, ssh, server_name, host_port, container_name):
+        """返回 (端口是否被监听, 是否存在同名容器)；有常驻代理时查询代理，否则一次往返执行两条命令"""
+        if self.agent_manager:
+            server_info = self.config['servers'][server_name]
+            try:
+                ports = self.agent_manager.query(server_name, server_info, 'ports')
+                containers = self.agent_manager.query(server_name, server_info, 'containers', all=True)
+                return host_port in ports, any(c['name'] == container_name for c in containers)
+            except AgentError as e:
+                print(f"通过代理检查端口失败，改为直接执行命令：{str(e)}")
+        port_cmd = f"netstat -tln | grep ':{host_port}'"
+        check_cmd = f"docker ps -a --filter name={container_name} --format '{{{{.Names}}}}'"
+        port_result, name_result = run_batch(ssh, [port_cmd, check_cmd])
+        return bool(port_result['stdout']), bool(name_result['stdout'])
 
     def create_container(self, ssh, server_name, image_name):
         """创建容器的具体流程"""
@@ -710,21 +919,19 @@ class LabServer:
                         print("请输有效的端口号")
                         return False
                     
-                    # 检查口是否已被使用
-                    cmd = f"netstat -tln | grep ':{host_port}'"
-                    stdin, stdout, stderr = ssh.exec_command(cmd)
-                    if stdout.read():
+                    # 构建容器名称
+                    created_at = int(time.time())
+                    container_name = f"{self.current_user}-{server_name}-{created_at}"
+                    
+                    # 检查端口是否已被使用，并检查同名容器
+                    port_in_use, name_exists = self._check_port_and_name(ssh, server_name, host_port, container_name)
+                    if port_in_use:
                         print(f"端口 {host_port} 已被占用")
                         return False
                     
-                    # 构建容器名称
-                    container_name = f"{self.current_user}-{server_name}-{int(time.time())}"
-                    
                     # 检查并处理同名容器
                     print(f"\n检查是否存在同名容器...")
-                    check_cmd = f"docker ps -a --filter name={container_name} --format '{{{{.Names}}}}'"
-                    stdin, stdout, stderr = ssh.exec_command(check_cmd)
-                    if stdout.read():
+                    if name_exists:
                         print(f"发现同名容器存在")
                         print("选项：")
                         print("1. 删除已有容器继续创建")
@@ -761,11 +968,15 @@ class LabServer:
                     gpu_args = f"--gpus '\"device={device_list}\"'"
                     volume_mount = f"-v {user_data_dir}:/workspace"
                     port_mapping = f"-p {host_port}:{container_port}"
+                    # 所属用户、用户组、GPU、创建时间和时间限制写入容器标签，查询时不再依赖任务记录
+                    labels = label_args(build_labels(
+                        self.current_user, user_group, selected_gpus, created_at, group_info['time_limit']
+                    ))
                     
                     # 如果是本地镜像，直接使用镜像名称
                     if not is_registry_image:
                         docker_cmd = (
-                            f"docker run -d --name {container_name} "
+                            f"docker run -d --name {container_name} {labels} "
                             f"{gpu_args} {volume_mount} {port_mapping} "
                             f"{image_name} "
                             f"tail -f /dev/null"
@@ -774,7 +985,7 @@ class LabServer:
                         # 如果是仓库镜像，添加仓库地址前缀
                         full_image_name = f"{registry_url}/{image_name}" if not image_name.startswith(registry_url) else image_name
                         docker_cmd = (
-                            f"docker run -d --name {container_name} "
+                            f"docker run -d --name {container_name} {labels} "
                             f"{gpu_args} {volume_mount} {port_mapping} "
                             f"{full_image_name} "
                             f"tail -f /dev/null"
@@ -786,8 +997,10 @@ class LabServer:
                     if input().lower() != 'y':
                         return False
 
-                    # 只有使用仓库镜像时才需要登录
+                    # 登录仓库、创建容器和验证容器状态在一次往返中完成，某一步失败后不再执行后续命令
+                    batch = []
                     if is_registry_image:
+                        # 只有使用仓库镜像时才需要登录
                         print("\n正在登录远程仓库...")
                         registry_info = self.config['docker_registries'][0]  # 使用第一个仓库配置
                         login_cmd = (
@@ -796,17 +1009,25 @@ class LabServer:
                             f"--username {registry_info['username']} "
                             f"--password-stdin"
                         )
-                        stdin, stdout, stderr = ssh.exec_command(login_cmd)
-                        error = stderr.read().decode()
-                        if error and "Error" in error:
+                        batch.append(login_cmd)
+                    verify_cmd = f"docker ps --filter name={container_name} --format '{{{{.Status}}}}'"
+                    batch.extend([docker_cmd, verify_cmd])
+
+                    print("\n正在创建容器...")
+                    host = self.docker_manager.host_of(self.config['servers'][server_name])
+                    with self.docker_manager.lane(host, docker_cmd):
+                        results = run_batch(ssh, batch, stop_on_error=True)
+                    if is_registry_image:
+                        login_result = results.pop(0)
+                        error = login_result['stderr']
+                        if login_result['exit_status'] != 0 or (error and "Error" in error):
                             print(f"登录仓库失败：{error}")
                             return False
 
-                    # 执行docker run命令
-                    print("\n正在创建容器...")
-                    stdin, stdout, stderr = ssh.exec_command(docker_cmd)
-                    output = stdout.read().decode().strip()
-                    error = stderr.read().decode().strip()
+                    # docker run的结果
+                    run_result, verify_result = results
+                    output = run_result['stdout'].strip()
+                    error = run_result['stderr'].strip()
 
                     if error:
                         # 如果出现GPU相关错误，尝试使用替代语法
@@ -816,7 +1037,7 @@ class LabServer:
                             device_list = ','.join(selected_gpus)
                             gpu_args = f"--gpus '\"device={device_list}\"'"
                             docker_cmd = (
-                                f"docker run -d --name {container_name} "
+                                f"docker run -d --name {container_name} {labels} "
                                 f"{gpu_args} {volume_mount} {port_mapping} "
                                 f"{image_name} "
                                 f"tail -f /dev/null"
@@ -826,6 +1047,7 @@ class LabServer:
                             stdin, stdout, stderr = ssh.exec_command(docker_cmd)
                             output = stdout.read().decode()
                             error = stderr.read().decode()
+                            verify_result = None  # 重试后需要重新验证
                         
                         if error and "Error" in error:
                             print(f"创器失败：{error}")
@@ -833,10 +1055,10 @@ class LabServer:
                     
                     # 验证容器是否成功创建和运行
                     success = False  # 添加成功标志
-                    verify_cmd = f"docker ps --filter name={container_name} --format '{{{{.Status}}}}'"
-                    stdin, stdout, stderr = ssh.exec_command(verify_cmd)
-                    status = stdout.read().decode().strip()
-                    error = stderr.read().decode().strip()
+                    if verify_result is None or verify_result['exit_status'] is None:
+                        verify_result, = run_batch(ssh, [verify_cmd])
+                    status = verify_result['stdout'].strip()
+                    error = verify_result['stderr'].strip()
                     
                     if error:
                         print(f"验证容器状态时出错：{error}")
@@ -895,41 +1117,56 @@ class LabServer:
             print(f"创建容器失败：{str(e)}")
             return False
 
+    def _list_containers(self, servers, username=None):
+        """通过容器清单、常驻代理或Docker API获取运行中的容器，返回 {服务器名: 容器列表}，只包含获取成功的服务器
+
+        指定username时Docker API在守护进程端按 lab.owner 标签过滤，另按任务记录中的容器名列出没有标签的旧容器；
+        容器清单和代理的结果由调用方过滤。
+        """
+        containers = self.container_inventory.list_containers(servers)
+        servers = {name: info for name, info in servers.items() if name not in containers}
+        if self.agent_manager and servers:
+            for name, data in self.agent_manager.query_all(servers, ['containers'], timeout=self.status_deadline).items():
+                containers[name] = data['containers']
+        remaining = {name: info for name, info in servers.items() if name not in containers}
+        if remaining:
+            filters = api_owner_filters(username, self._record_containers(username)) if username else None
+            containers.update(self.docker_api.query_all(
+                remaining, 'list_containers', deadline=self.status_deadline, filters=filters
+            ))
+        return containers
+
+    def _record_containers(self, username):
+        """用户任务记录中的容器名（没有标签的旧容器只能按名字找到）"""
+        return sorted(task['container'] for task in self.index_manager.get_user_tasks(username))
+
     def get_user_tasks(self, username=None):
         """获取用户任务信息"""
         try:
             tasks = []
-            for server_name, server_info in self.config['servers'].items():
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(
-                    hostname=server_info['host'],
-                    port=server_info['port'],
-                    username=server_info['username'],
-                    password=server_info['password']
-                )
-                
-                # 获取所运行中的容器
-                if username:
-                    cmd = f"docker ps --format '{{{{.ID}}}}\t{{{{.Names}}}}\t{{{{.Status}}}}\t{{{{.RunningFor}}}}' | grep {username}"
-                else:
-                    cmd = "docker ps --format '{{.ID}}\t{{.Names}}\t{{.Status}}\t{{.RunningFor}}'"
-                
-                stdin, stdout, stderr = ssh.exec_command(cmd)
-                output = stdout.read().decode()
-                
-                for line in output.strip().split('\n'):
-                    if line:
-                        container_id, name, status, running_time = line.split('\t')
-                        tasks.append({
-                            'server': server_name,
-                            'container_id': container_id,
-                            'name': name,
-                            'status': status,
-                            'running_time': running_time
-                        })
-                
-                ssh.close()
+            servers = self.config['servers']
+            containers = self._list_containers(servers, username)
+            # 其余服务器执行docker ps（所有服务器并发查询），按所属用户的标签在守护进程端过滤，
+            # 没有标签的旧容器按任务记录中的容器名列出
+            remaining = {name: info for name, info in servers.items() if name not in containers}
+            cmd = DOCKER_PS_CMD
+            if username:
+                cmd = f"docker ps {owner_filter(username)} --format '{DOCKER_PS_FORMAT}'"
+                names = self._record_containers(username)
+                if names:
+                    cmd += f" && docker ps {name_filter(names)} --format '{DOCKER_PS_FORMAT}'"
+            results = self.fanout.run(
+                remaining, cmd, deadline=self.status_deadline, operation='get_user_tasks'
+            ) if remaining else {}
+            for server_name in servers:
+                if server_name in containers:
+                    tasks.extend(self._container_task_list(containers[server_name], server_name, username))
+                    continue
+                result = results[server_name]
+                if result['status'] != 'ok':
+                    print(f"警告：服务器 {server_name} 未响应，其上的任务未列出（{result['error']}）")
+                    continue
+                tasks.extend(self._parse_task_list(result['stdout'], server_name, username))
             return tasks
         except Exception as e:
             print(f"获取任务信息失败{str(e)}")
@@ -1011,18 +1248,7 @@ class LabServer:
                     
                     # 获取服务器连接
                     server = self.config['servers'][server_name]
-                    ssh = paramiko.SSHClient()
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    
-                    try:
-                        ssh.connect(
-                            hostname=server['host'],
-                            port=server['port'],
-                            username=server['username'],
-                            password=server['password'],
-                            timeout=10
-                        )
-                        
+                    with self.ssh_manager.connection(server, 'enter_container') as ssh:
                         print(f"\n正在连接到容器 {container_name}...")
                         print("提示：")
                         print("1. 按 Ctrl+C 退出终端")
@@ -1031,9 +1257,6 @@ class LabServer:
                         # 创建终端管理器并启动会话
                         terminal = TerminalManager(ssh)
                         terminal.start_terminal_session(container_name)
-                        
-                    finally:
-                        ssh.close()
                     return
                     
                 else:
@@ -1057,8 +1280,13 @@ class LabServer:
             print("两次输入的密码不一致")
             return
         
-        self.config['users'][self.current_user]['password'] = new_password
-        self._save_config()
+        try:
+            with self.config_manager.transaction() as config:
+                config['users'][self.current_user]['password'] = new_password
+        except Exception as e:
+            print(f"保存配置失败：{str(e)}")
+            return
+        self._reload_config()
         print("密码修改成功！")
 
     def show_all_tasks(self):
@@ -1128,7 +1356,7 @@ class LabServer:
                     max_containers, max_gpus, time_limit
                 ):
                     print("用户组创建成功！")
-                    self._save_config()
+                    self._reload_config()
 
             elif choice == '3':
                 group_name = input("请输入要修改的用户组名称: ")
@@ -1156,13 +1384,13 @@ class LabServer:
                         int(time_limit) if time_limit else None
                     ):
                         print("用户组修改成功！")
-                        self._save_config()
+                        self._reload_config()
 
             elif choice == '4':
                 group_name = input("请输入要删除的用户组名称: ")
                 if self.group_manager.delete_group(group_name):
                     print("用户组删除成功！")
-                    self._save_config()
+                    self._reload_config()
 
             elif choice == '5':
                 break
@@ -1191,6 +1419,7 @@ class LabServer:
             
             # 启动后台更新
             self.status_updater.start()
+            self._report_startup_time()
 
             while True:
                 print("\n=== 实验室服务器管理系统 ===")
@@ -1208,6 +1437,7 @@ class LabServer:
                     print("9. 用户组管理")
                     print("10. 服务管理")
                     print("11. 仓库管理")
+                    print("12. 性能统计")
 
                 choice = input("\n请选择操作: ")
                 print()  # 添加空行增加可读性
@@ -1235,60 +1465,96 @@ class LabServer:
                     self.manage_servers()
                 elif choice == '11' and self.user_manager.is_admin(self.current_user):
                     self.manage_registry()
+                elif choice == '12' and self.user_manager.is_admin(self.current_user):
+                    self.show_command_metrics()
                 else:
                     print("无效的选择，请重试")
 
         finally:
             if self.status_updater:
                 self.status_updater.stop()
+            stats = self.config_manager.get_cache_stats()
+            self.log_manager.log_info(
+                f"配置缓存统计：命中 {stats['hits']} 次，解析 {stats['misses']} 次，"
+                f"命中率 {stats['hit_rate']:.1%}"
+            )
+            lock_stats = self.config_manager.get_lock_stats()
+            self.log_manager.log_info(
+                f"配置锁统计：获取 {lock_stats['acquisitions']} 次（共享 {lock_stats['shared_acquisitions']}），"
+                f"竞争 {lock_stats['contended']} 次，超时 {lock_stats['timeouts']} 次，"
+                f"平均等待 {lock_stats['avg_wait'] * 1000:.2f}ms，最长等待 {lock_stats['max_wait'] * 1000:.2f}ms，"
+                f"平均持有 {lock_stats['avg_hold'] * 1000:.2f}ms"
+            )
+            self.config_watcher.close()
+            self.fanout.close()
+            self.docker_api.close_all()
+            for name, inventory_stats in self.container_inventory.get_stats().items():
+                self.log_manager.log_info(
+                    f"容器清单 {name}：{'就绪' if inventory_stats['ready'] else '未就绪'}，"
+                    f"建立快照 {inventory_stats['bootstraps']} 次，处理事件 {inventory_stats['events']} 个"
+                    + (f"，上次错误：{inventory_stats['last_error']}" if inventory_stats['last_error'] else '')
+                )
+            self.container_inventory.close_all()
+            try:
+                CommandMetrics().dump(METRICS_FILE)
+            except OSError as e:
+                self.log_manager.log_error(f"导出性能统计失败：{str(e)}")
+            if self.agent_manager:
+                self.agent_manager.close_all()
+            for host, ssh_stats in self.ssh_manager.get_stats().items():
+                self.log_manager.log_info(
+                    f"SSH连接统计 {host}：取用 {ssh_stats['checkouts']} 次，复用 {ssh_stats['reused']} 次，"
+                    f"探测 {ssh_stats['probes']} 次，新建 {ssh_stats['connects']} 次，"
+                    f"平均取用延迟 {ssh_stats['avg_latency'] * 1000:.2f}ms，最长 {ssh_stats['max_latency'] * 1000:.2f}ms，"
+                    f"排队 {ssh_stats['waits']} 次（超时 {ssh_stats['timeouts']} 次），"
+                    f"平均等待 {ssh_stats['avg_wait'] * 1000:.2f}ms，最长等待 {ssh_stats['max_wait'] * 1000:.2f}ms，"
+                    f"当前transport {ssh_stats['transports']} 个，使用中通道 {ssh_stats['active_channels']} 个"
+                )
+            for operation, op_stats in self.ssh_manager.get_operation_stats().items():
+                self.log_manager.log_info(
+                    f"SSH连接复用 {operation}：取用 {op_stats['checkouts']} 次，避免握手 {op_stats['handshakes_avoided']} 次"
+                )
+            for host, lanes in self.docker_manager.get_stats().items():
+                for name, lane in lanes.items():
+                    if lane['acquisitions']:
+                        self.log_manager.log_info(
+                            f"Docker命令并发 {host} {name}：执行 {lane['acquisitions']} 次，排队 {lane['waits']} 次"
+                            f"（超时 {lane['timeouts']} 次），平均等待 {lane['avg_wait']:.2f}秒，最长 {lane['max_wait']:.2f}秒"
+                        )
+            for host, health in self.health_manager.get_all().items():
+                if health['state'] != 'closed':
+                    self.log_manager.log_info(
+                        f"主机熔断 {host}：{health['state']}，连续失败 {health['failures']} 次，"
+                        f"上次错误：{health['last_error']}"
+                    )
+            self.log_manager.log_info(
+                f"配置变化通知（{self.config_watcher.mode}）：{self.config_watcher.events_published} 次"
+            )
 
     def _record_task(self, server_name, container_name, gpu_indices):
         """记录用户任务信息"""
-        if 'task_records' not in self.config:
-            self.config['task_records'] = {}
-        
-        if self.current_user not in self.config['task_records']:
-            self.config['task_records'][self.current_user] = []
-        
-        task_info = {
-            'server': server_name,
-            'container': container_name,
-            'gpus': gpu_indices,
-            'timestamp': int(time.time())
-        }
-        
-        self.config['task_records'][self.current_user].append(task_info)
-        self._save_config()
-
-    def stop_container(self, ssh, server_name, container_name):
-        """停止指定的容器"""
         try:
-            # 获取容器使用的GPU
-            task_records = self.config['task_records'].get(self.current_user, [])
-            for task in task_records:
-                if task['container'] == container_name:
-                    # 放GPU
-                    self.gpu_manager.release_gpus(server_name, task['gpus'])
-                    break
+            self.state_store.add_task_record(
+                self.current_user, server_name, container_name, gpu_indices, int(time.time())
+            )
+        except Exception as e:
+            print(f"记录任务信息失败：{str(e)}")
 
-            print(f"\n正在停止容器 {container_name}...")
-            stop_cmd = f"docker stop {container_name}"
-            stdin, stdout, stderr = ssh.exec_command(stop_cmd)
-            error = stderr.read().decode()
-            if error:
-                print(f"停止容器失败：{error}")
-                return False
-            
-            print("正在删除容器...")
-            rm_cmd = f"docker rm {container_name}"
-            stdin, stdout, stderr = ssh.exec_command(rm_cmd)
-            error = stderr.read().decode()
-            if error:
-                print(f"删除容器失败：{error}")
-                return False
-            
-            print("容器成功停止并删除")
-            
+    def stop_tasks(self, tasks, operation='stop_tasks'):
+        """停止并删除任务列表中的容器（各服务器并发，每台服务器一条命令），逐个显示结果，返回成功数"""
+        print(f"\n正在停止 {len(tasks)} 个容器...")
+
+        def report(outcome):
+            if outcome['ok']:
+                print(f"成功停止容器：{outcome['name']}")
+            else:
+                print(f"停止容器失败：{outcome['name']}（{outcome['error']}）")
+
+        results = self.bulk_stopper.stop(self.config['servers'], tasks, operation, on_result=report)
+        stopped = [outcome for outcome in results if outcome['ok']]
+        for outcome in stopped:
+            self.container_inventory.discard(outcome['server'], outcome['name'])
+        if stopped:
             # 立即更新服务器状态缓存
             self.cached_server_status = None  # 清除缓存
             self.last_status_update = 0  # 重置更新时间戳
@@ -1300,11 +1566,7 @@ class LabServer:
             finally:
                 sys.stdout.close()
                 sys.stdout = original_stdout
-            
-            return True
-        except Exception as e:
-            print(f"操作失败：{str(e)}")
-            return False
+        return len(stopped)
 
     def stop_user_task(self):
         """停止用户的任务"""
@@ -1372,38 +1634,8 @@ class LabServer:
                     print("操作已取消")
                     continue
                 
-                # 按服务器分组任务，减少SSH连接次数
-                server_tasks = {}
-                for idx in selected_indices:
-                    task = tasks[idx]
-                    if task['server'] not in server_tasks:
-                        server_tasks[task['server']] = []
-                    server_tasks[task['server']].append(task)
-                
-                # 处理每个服务器上的任务
-                for server_name, server_tasks_list in server_tasks.items():
-                    try:
-                        # 连接到服务器
-                        server = self.config['servers'][server_name]
-                        ssh = paramiko.SSHClient()
-                        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                        ssh.connect(
-                            hostname=server['host'],
-                            port=server['port'],
-                            username=server['username'],
-                            password=server['password']
-                        )
-                        
-                        # 停止该服务器上的所有选中容器
-                        for task in server_tasks_list:
-                            if self.stop_container(ssh, server_name, task['name']):
-                                print(f"成功停止容器：{task['name']}")
-                            else:
-                                print(f"停止容器失败：{task['name']}")
-                        
-                        ssh.close()
-                    except Exception as e:
-                        print(f"连接服务器 {server_name} 失败：{str(e)}")
+                # 所有选中的容器一起停止：每台服务器一条命令，各服务器并发执行
+                self.stop_tasks([tasks[idx] for idx in selected_indices], 'stop_user_task')
                 
                 # 更新任务列表
                 tasks = self.get_user_tasks(self.current_user)
@@ -1488,38 +1720,8 @@ class LabServer:
                     print("操作已取消")
                     continue
                 
-                # 按服务器分组任务，减少SSH连接次数
-                server_tasks = {}
-                for idx in selected_indices:
-                    task = tasks[idx]
-                    if task['server'] not in server_tasks:
-                        server_tasks[task['server']] = []
-                    server_tasks[task['server']].append(task)
-                
-                # 处理每个服务器上的任务
-                for server_name, server_tasks_list in server_tasks.items():
-                    try:
-                        # 连接到服务器
-                        server = self.config['servers'][server_name]
-                        ssh = paramiko.SSHClient()
-                        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                        ssh.connect(
-                            hostname=server['host'],
-                            port=server['port'],
-                            username=server['username'],
-                            password=server['password']
-                        )
-                        
-                        # 停止该服务器上的所有选中容器
-                        for task in server_tasks_list:
-                            if self.stop_container(ssh, server_name, task['name']):
-                                print(f"成功停止容器：{task['name']}")
-                            else:
-                                print(f"停止容器失败：{task['name']}")
-                        
-                        ssh.close()
-                    except Exception as e:
-                        print(f"连接服务器 {server_name} 失败：{str(e)}")
+                # 所有选中的容器一起停止：每台服务器一条命令，各服务器并发执行
+                self.stop_tasks([tasks[idx] for idx in selected_indices], 'stop_any_task')
                 
                 # 更新任务列表
                 tasks = self.get_user_tasks()
@@ -1552,18 +1754,7 @@ class LabServer:
                     
                     # 获取服务器连接
                     server = self.config['servers'][server_name]
-                    ssh = paramiko.SSHClient()
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    
-                    try:
-                        ssh.connect(
-                            hostname=server['host'],
-                            port=server['port'],
-                            username=server['username'],
-                            password=server['password'],
-                            timeout=10
-                        )
-                        
+                    with self.ssh_manager.connection(server, 'pack_container') as ssh:
                         print(f"\n正在打包容器 {container_name}...")
                         
                         # 让用户输入镜像名称和标签
@@ -1630,9 +1821,6 @@ class LabServer:
                                 ssh.exec_command(f"docker rmi {full_image_name}")
                         
                         print(f"\n本地镜像：{local_image}")
-                        
-                    finally:
-                        ssh.close()
                     return
                 
                 else:
@@ -1676,24 +1864,22 @@ class LabServer:
                 
                 # 测试连接
                 try:
-                    ssh = paramiko.SSHClient()
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(
-                        hostname=host,
-                        port=int(port),
-                        username=username,
-                        password=password,
-                        timeout=10
-                    )
-                    ssh.close()
-                    
-                    self.config['servers'][name] = {
+                    # 用新的凭据重新握手；成功后该连接留在连接池中供后续使用
+                    self.ssh_manager.test_connection({
                         'host': host,
                         'port': int(port),
                         'username': username,
                         'password': password
-                    }
-                    self._save_config()
+                    }, 'manage_servers')
+                    
+                    with self.config_manager.transaction() as config:
+                        config['servers'][name] = {
+                            'host': host,
+                            'port': int(port),
+                            'username': username,
+                            'password': password
+                        }
+                    self._reload_config()
                     print("服务器添加成！")
                     
                 except Exception as e:
@@ -1721,24 +1907,22 @@ class LabServer:
                 
                 # 测试新配置
                 try:
-                    ssh = paramiko.SSHClient()
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(
-                        hostname=host,
-                        port=int(port),
-                        username=username,
-                        password=password,
-                        timeout=10
-                    )
-                    ssh.close()
-                    
-                    self.config['servers'][name] = {
+                    # 用新的凭据重新握手；成功后该连接留在连接池中供后续使用
+                    self.ssh_manager.test_connection({
                         'host': host,
                         'port': int(port),
                         'username': username,
                         'password': password
-                    }
-                    self._save_config()
+                    }, 'manage_servers')
+                    
+                    with self.config_manager.transaction() as config:
+                        config['servers'][name] = {
+                            'host': host,
+                            'port': int(port),
+                            'username': username,
+                            'password': password
+                        }
+                    self._reload_config()
                     print("服务器配置已更新！")
                     
                 except Exception as e:
@@ -1752,8 +1936,13 @@ class LabServer:
                     
                 confirm = input(f"确定要删除服务器 {name} 吗？(y/n): ")
                 if confirm.lower() == 'y':
-                    del self.config['servers'][name]
-                    self._save_config()
+                    try:
+                        with self.config_manager.transaction() as config:
+                            config['servers'].pop(name, None)
+                    except Exception as e:
+                        print(f"保存配置失败：{str(e)}")
+                        continue
+                    self._reload_config()
                     print("服务器已删除")
                     
             elif choice == '5':
@@ -1765,27 +1954,17 @@ class LabServer:
                 info = self.config['servers'][name]
                 try:
                     print(f"正在测试连接 {name} ({info['host']})...")
-                    ssh = paramiko.SSHClient()
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(
-                        hostname=info['host'],
-                        port=info['port'],
-                        username=info['username'],
-                        password=info['password'],
-                        timeout=10
-                    )
-                    
-                    # 测试GPU可用性
-                    print("正在检查GPU...")
-                    gpu_info = self.check_gpu_status_with_ssh(ssh, name)
-                    if gpu_info:
-                        print(f"发现 {len(gpu_info)} 个GPU:")
-                        for gpu in gpu_info:
-                            print(f"- {gpu['name']}")
-                    else:
-                        print("未检测到GPU")
+                    with self.ssh_manager.connection(info, 'manage_servers') as ssh:
+                        # 测试GPU可用性
+                        print("正在检查GPU...")
+                        gpu_info = self.check_gpu_status_with_ssh(ssh, name)
+                        if gpu_info:
+                            print(f"发现 {len(gpu_info)} 个GPU:")
+                            for gpu in gpu_info:
+                                print(f"- {gpu['name']}")
+                        else:
+                            print("未检测到GPU")
                     
-                    ssh.close()
                     print("连接测试成功！")
                     
                 except Exception as e:
@@ -1794,6 +1973,52 @@ class LabServer:
             elif choice == '0':
                 break
 
+    def show_command_metrics(self):
+        """显示远程命令的延迟统计（按主机和命令类型）和最近的慢命令"""
+        metrics = CommandMetrics()
+        while True:
+            snapshot = metrics.snapshot()
+            print("\n=== 性能统计 ===")
+            print(f"统计开始：{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['since']))}，"
+                  f"慢命令阈值：{snapshot['slow_threshold']}秒")
+            print("\n{:<22} {:<36} {:>6} {:>5} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+                "主机", "命令类型", "次数", "失败", "平均ms", "p50ms", "p95ms", "p99ms", "最长ms"
+            ))
+            print("-" * 130)
+            for item in snapshot['histograms']:
+                print("{:<22} {:<36} {:>6} {:>5} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                    item['host'], item['type'], item['count'], item['errors'], item['avg_ms'],
+                    item['p50_ms'], item['p95_ms'], item['p99_ms'], item['max_ms']
+                ))
+            if snapshot['slow_commands']:
+                print("\n最近的慢命令：")
+                for entry in snapshot['slow_commands'][-10:]:
+                    print(f"{time.strftime('%H:%M:%S', time.localtime(entry['time']))} {entry['host']} "
+                          f"{entry['seconds']:.2f}秒{'' if entry['ok'] else '（失败）'} {entry['command']}")
+
+            docker_stats = self.docker_manager.get_stats()
+            if docker_stats:
+                print("\nDocker命令并发（使用中/上限，排队，等待次数，平均/最长等待）：")
+                for host, lanes in sorted(docker_stats.items()):
+                    print(f"{host}：" + "，".join(
+                        f"{name} {lane['active']}/{lane['limit']} 排队{lane['waiting']} 等待{lane['waits']}次 "
+                        f"{lane['avg_wait']:.2f}/{lane['max_wait']:.2f}秒"
+                        for name, lane in lanes.items()
+                    ))
+
+            print("\n1. 刷新")
+            print(f"2. 导出为JSON（{METRICS_FILE}）")
+            print("0. 返回")
+            choice = input("\n请选择操作: ").strip()
+            if choice == '0':
+                return
+            elif choice == '2':
+                try:
+                    metrics.dump(METRICS_FILE)
+                    print(f"已导出到 {os.path.abspath(METRICS_FILE)}")
+                except OSError as e:
+                    print(f"导出失败：{str(e)}")
+
     def manage_registry(self):
         """管理仓库配置"""
         while True:
@@ -1827,19 +2052,27 @@ class LabServer:
                 nfs_host = input("请输入新的NFS主机（直接回车保持不变）: ") or registry['nfs_host']
                 nfs_path = input("请输入新的NFS路径（直接回车保持不变）: ") or registry['nfs_path']
                 
-                # 测试连接
-                self.config['registry_server'].update({
+                new_settings = {
                     'host': host,
                     'registry_port': int(registry_port),
                     'nfs_host': nfs_host,
                     'nfs_path': nfs_path
-                })
+                }
                 
-                # 重新初始化registry manager
-                self.registry_manager = RegistryManager(self.config)
+                # 先用新配置测试连接，成功后再写入配置文件
+                test_config = dict(self.config)
+                test_config['registry_server'] = dict(registry, **new_settings)
+                registry_manager = RegistryManager(test_config)
                 
-                if self.registry_manager.test_connection():
-                    self._save_config()
+                if registry_manager.test_connection():
+                    try:
+                        with self.config_manager.transaction() as config:
+                            config['registry_server'].update(new_settings)
+                    except Exception as e:
+                        print(f"保存配置失败：{str(e)}")
+                        continue
+                    self._reload_config()
+                    self.registry_manager = registry_manager
                     print("仓库配置已更新！")
                 else:
                     print("仓库连接测试失败，配置未保存")
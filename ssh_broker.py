@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import base64
+import hmac
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+import paramiko
+from config_manager import ConfigManager
+from config_watcher import ConfigWatcher
+from ssh_manager import SSHManager
+from health_manager import HealthManager
+from command_metrics import CommandMetrics
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SOCKET_FILE = os.path.join(SCRIPT_DIR, 'ssh_broker.sock')
+
+
+class BrokerRejected(ConnectionError):
+    """代理拒绝了请求（服务器不在代理的配置中或凭据不符），调用方改用直连"""
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    """每个客户端连接处理一个请求：一行JSON请求，一行JSON响应"""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            response = self.server.broker.handle_request(request)
+        except Exception as e:
+            response = {'ok': False, 'error': str(e)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class _BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class SSHBroker:
+    """本地SSH代理进程（类似ControlMaster）
+
+    常驻进程持有到所有服务器的已认证连接，短生命周期的进程（cron运行的
+    check_container_time.py、web_terminal.py启动的main.py）通过Unix socket
+    请求执行命令，省去每个进程各自握手和认证。
+    """
+
+    def __init__(self, config_file, socket_path=SOCKET_FILE, warm_interval=60):
+        self.config_manager = ConfigManager(config_file)
+        self.config = self.config_manager.load_config()
+        self.socket_path = socket_path
+        self.warm_interval = warm_interval
+        self.ssh_manager = SSHManager()
+        self.ssh_manager.set_health_manager(
+            HealthManager(os.path.join(os.path.dirname(os.path.abspath(config_file)), 'host_health.json'))
+        )
+        self.config_watcher = ConfigWatcher(self.config_manager)
+        self.config_watcher.subscribe(self._on_config_change, ('servers', 'data_server'))
+        self._stop_event = threading.Event()
+        self.requests_served = 0
+        self.server = None
+
+    def _on_config_change(self, changed, config):
+        self.config = config
+        threading.Thread(target=self.warm_up, daemon=True).start()
+
+    def _hosts(self):
+        hosts = list((self.config.get('servers') or {}).items())
+        if self.config.get('data_server'):
+            hosts.append(('data_server', self.config['data_server']))
+        return hosts
+
+    def _find_server(self, server_info):
+        """在代理自己的配置中查找请求的服务器，主机、端口和凭据都一致时返回配置中的服务器信息"""
+        for _, info in self._hosts():
+            if (info.get('host') == server_info.get('host')
+                    and int(info.get('port', 22)) == int(server_info.get('port', 22))
+                    and info.get('username') == server_info.get('username')
+                    and hmac.compare_digest(str(info.get('password', '')), str(server_info.get('password', '')))):
+                return info
+        return None
+
+    def warm_up(self):
+        """与所有服务器建立（或检查）连接"""
+        for name, server_info in self._hosts():
+            if self.ssh_manager.get_connection(server_info, 'broker_warm_up') is None:
+                print(f"预热连接 {name} 失败")
+
+    def _warm_loop(self):
+        while not self._stop_event.wait(self.warm_interval):
+            try:
+                self.config_watcher.check()
+                self.warm_up()
+            except Exception as e:
+                print(f"预热连接出错：{str(e)}")
+
+    def handle_request(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {'ok': True, 'pid': os.getpid()}
+        if op == 'stats':
+            return {
+                'ok': True, 'stats': self.ssh_manager.get_stats(), 'requests': self.requests_served,
+                'metrics': CommandMetrics().snapshot()
+            }
+        if op != 'exec':
+            return {'ok': False, 'error': f"未知操作：{op}"}
+
+        # 连接池按host:port复用已认证的transport，不能直接使用请求中的服务器信息：
+        # 只为代理配置中存在且凭据一致的服务器执行命令（配置刚修改时先重新加载一次）
+        server_info = self._find_server(request.get('server') or {})
+        if server_info is None:
+            self.config_watcher.check()
+            server_info = self._find_server(request.get('server') or {})
+        if server_info is None:
+            return {'ok': False, 'rejected': True, 'error': "服务器不在SSH代理的配置中或凭据不符"}
+        with self.ssh_manager.connection(server_info, request.get('operation')) as ssh:
+            stdin, stdout, stderr = ssh.exec_command(request['command'], timeout=request.get('timeout'))
+            out = stdout.read()
+            err = stderr.read()
+            exit_status = stdout.channel.recv_exit_status()
+        self.requests_served += 1
+        return {
+            'ok': True,
+            'stdout': base64.b64encode(out).decode('ascii'),
+            'stderr': base64.b64encode(err).decode('ascii'),
+            'exit_status': exit_status
+        }
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            if BrokerClient(self.socket_path).ping():
+                raise RuntimeError(f"SSH代理已在运行：{self.socket_path}")
+            os.remove(self.socket_path)
+
+        # socket只允许当前用户访问：请求中包含服务器凭据
+        old_umask = os.umask(0o077)
+        try:
+            self.server = _BrokerServer(self.socket_path, _BrokerHandler)
+        finally:
+            os.umask(old_umask)
+        self.server.broker = self
+
+        self.warm_up()
+        threading.Thread(target=self._warm_loop, daemon=True).start()
+        print(f"SSH代理已启动：{self.socket_path}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self._stop_event.set()
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.config_watcher.close()
+            self.ssh_manager.close_all()
+
+    def shutdown(self):
+        if self.server:
+            threading.Thread(target=self.server.shutdown).start()
+
+
+class BrokerClient:
+    """SSH代理的客户端：每个请求使用一个新的Unix socket连接，可在多线程中使用"""
+
+    def __init__(self, socket_path=SOCKET_FILE, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _request(self, request, timeout=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout if timeout is not None else self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError as e:
+                raise ConnectionError(f"SSH代理不可用：{str(e)}")
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            data = sock.makefile('rb').readline()
+        finally:
+            sock.close()
+        if not data:
+            raise ConnectionError("SSH代理关闭了连接")
+        return self._check(json.loads(data))
+
+    @staticmethod
+    def _check(response):
+        """代理无法处理的请求抛出ConnectionError（BrokerRejected），调用方改用直连；
+        在目标服务器上执行失败抛出paramiko.SSHException，与直连时一样不再重试"""
+        if not response.get('ok'):
+            if response.get('rejected'):
+                raise BrokerRejected(response.get('error', '请求被拒绝'))
+            raise paramiko.SSHException(response.get('error', '未知错误'))
+        return response
+
+    def ping(self):
+        """检查代理是否在运行"""
+        try:
+            self._request({'op': 'ping'}, timeout=1)
+            return True
+        except Exception:
+            return False
+
+    def stats(self):
+        return self._request({'op': 'stats'})
+
+    @staticmethod
+    def _exec_request(server_info, command, timeout, operation):
+        return {
+            'op': 'exec',
+            'server': server_info,
+            'command': command,
+            'timeout': timeout,
+            'operation': operation
+        }
+
+    @classmethod
+    def _exec_result(cls, response):
+        cls._check(response)
+        return (
+            base64.b64decode(response['stdout']),
+            base64.b64decode(response['stderr']),
+            response['exit_status']
+        )
+
+    def exec_command(self, server_info, command, timeout=None, operation=None):
+        """通过代理执行命令，返回 (stdout字节, stderr字节, 退出码)"""
+        return self._exec_result(self._request(self._exec_request(server_info, command, timeout, operation)))
+
+    async def exec_command_async(self, server_info, command, timeout=None, operation=None):
+        """exec_command的asyncio版本，不占用线程"""
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=64 * 1024 * 1024)
+        except OSError as e:
+            raise ConnectionError(f"SSH代理不可用：{str(e)}")
+        try:
+            request = self._exec_request(server_info, command, timeout, operation)
+            writer.write(json.dumps(request).encode('utf-8') + b'\n')
+            await writer.drain()
+            data = await reader.readline()
+        finally:
+            writer.close()
+        if not data:
+            raise ConnectionError("SSH代理关闭了连接")
+        return self._exec_result(json.loads(data))
+
+
+class _BrokerChannel:
+    def __init__(self, exit_status):
+        self.exit_status = exit_status
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def exit_status_ready(self):
+        return True
+
+
+class _BrokerStream:
+    """模拟paramiko ChannelFile的只读接口"""
+
+    def __init__(self, data, exit_status):
+        self._lines = data.splitlines(keepends=True)
+        self._data = data
+        self._pos = 0
+        self.channel = _BrokerChannel(exit_status)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._data[self._pos:]
+            self._pos = len(self._data)
+        else:
+            data = self._data[self._pos:self._pos + size]
+            self._pos += len(data)
+        return data
+
+    def readline(self):
+        end = self._data.find(b'\n', self._pos)
+        end = len(self._data) if end < 0 else end + 1
+        line = self._data[self._pos:end].decode('utf-8', errors='replace')
+        self._pos = end
+        return line
+
+    def readlines(self):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def __iter__(self):
+        return iter(self.readlines())
+
+    def close(self):
+        pass
+
+
+class _BrokerStdin:
+    """经由代理执行的命令没有标准输入：命令在 exec_command 返回前已经执行完毕"""
+
+    def write(self, data):
+        raise paramiko.SSHException("经由SSH代理执行的命令不支持标准输入")
+
+    def close(self):
+        pass
+
+
+class BrokerConnection:
+    """与paramiko.SSHClient接口兼容的代理连接
+
+    exec_command 经由代理执行（输出在命令结束后一次返回，没有标准输入）；其他方法
+    （invoke_shell等交互式操作）交给直连的连接。
+    代理不可用或拒绝请求（ConnectionError）时改用直连；命令在目标服务器上执行失败时
+    抛出paramiko.SSHException，与直连时相同。
+    """
+
+    def __init__(self, client, server_info, fallback, operation=None):
+        self._client = client
+        self._server_info = server_info
+        self._fallback = fallback
+        self._operation = operation
+
+    def exec_command(self, command, timeout=None, **kwargs):
+        if kwargs:
+            return self._fallback().exec_command(command, timeout=timeout, **kwargs)
+        try:
+            out, err, exit_status = self._client.exec_command(
+                self._server_info, command, timeout=timeout, operation=self._operation
+            )
+        except ConnectionError:
+            return self._fallback().exec_command(command, timeout=timeout)
+        return _BrokerStdin(), _BrokerStream(out, exit_status), _BrokerStream(err, exit_status)
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._fallback(), name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地SSH代理：为其他进程复用到各服务器的已认证连接")
+    parser.add_argument('--config', default=os.path.join(SCRIPT_DIR, 'config.yaml'))
+    parser.add_argument('--socket', default=SOCKET_FILE)
+    parser.add_argument('--stats', action='store_true', help="显示正在运行的代理的连接统计")
+    args = parser.parse_args()
+
+    if args.stats:
+        start = time.perf_counter()
+        response = BrokerClient(args.socket).stats()
+        print(f"请求耗时：{(time.perf_counter() - start) * 1000:.2f}ms，已处理请求：{response['requests']}")
+        for host, stats in response['stats'].items():
+            print(f"{host}：transport {stats['transports']} 个，使用中通道 {stats['active_channels']} 个，"
+                  f"取用 {stats['checkouts']} 次，新建 {stats['connects']} 次")
+        return
+
+    broker = SSHBroker(args.config, args.socket)
+    signal.signal(signal.SIGTERM, lambda signum, frame: broker.shutdown())
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
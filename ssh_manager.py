@@ -1,118 +1,473 @@
 import paramiko
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from command_metrics import CommandMetrics, InstrumentedConnection
+from contextlib import contextmanager
 import time
 import threading
+import weakref
 
 class SSHManager:
+    """SSH连接池
+
+    每台主机（host:port）维护若干个transport，每个transport上最多同时使用
+    _max_channels 个通道（不超过服务端的MaxSessions）。所有transport都饱和时
+    新建transport，达到 _max_transports 后调用方排队等待，队列长度和等待时间都有上限。
+    """
     _instance = None
     _lock = Lock()
-    _connections = {}
-    _locks = {}
-    _last_used = {}  # 记录连接最后使用时间
+    _pools = {}  # host:port -> 主机连接池
     _max_idle_time = 300  # 空闲连接超时时间（秒）
     _cleanup_interval = 60
     _cleanup_thread = None
     _stop_cleanup = False
-    
+    _keepalive_interval = 30  # transport层keepalive间隔（秒）
+    _probe_idle_time = 60  # 空闲超过该时间后，取用前做一次真实探测
+    _max_channels = 4  # 每个transport上同时使用的通道数上限
+    _max_transports = 3  # 每台主机的transport数上限
+    _max_waiters = 16  # 每台主机排队等待的调用方上限
+    _wait_timeout = 30  # 排队等待的最长时间（秒）
+    _stats = {}  # 每台主机的取用统计
+    _operation_stats = {}  # 每种操作的取用次数和避免的握手次数
+    _broker = None  # 本地SSH代理客户端（见ssh_broker.py），为None时直连
+    _health = None  # 主机熔断器（见health_manager.py），为None时不启用
+    _warm_executor = None  # 预热连接的线程池
+    _max_warm_workers = 8
+
     def __new__(cls):
         if cls._instance is None:
             with cls._lock:
                 if cls._instance is None:
                     cls._instance = super().__new__(cls)
         return cls._instance
-    
-    def get_connection(self, server_info):
-        """获取SSH连接"""
-        key = f"{server_info['host']}:{server_info['port']}"
-        
-        # 创建服务器专用锁
-        if key not in self._locks:
-            self._locks[key] = threading.Lock()
-            
-        with self._locks[key]:
-            try:
-                # 检查现有连接
-                if key in self._connections:
-                    ssh = self._connections[key]
+
+    @staticmethod
+    def _key(server_info):
+        return f"{server_info['host']}:{server_info['port']}"
+
+    def _get_pool(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = {
+                    'cond': threading.Condition(),
+                    'transports': [],  # [{'ssh', 'active', 'holders', 'last_used', 'suspect', 'retired'}]
+                    'connecting': 0,
+                    'waiting': 0
+                }
+                self._pools[key] = pool
+            return pool
+
+    def _checkout(self, server_info, operation=None, lease=True, timeout=None):
+        """从主机连接池取出一个transport
+
+        lease为True时占用一个通道名额，用完必须调用 _checkin 归还；
+        为False时只返回负载最低的transport，不计入通道使用（兼容直接持有连接的调用方，
+        这类调用方通过 _lend 登记，见 _in_use）。
+        """
+        key = self._key(server_info)
+        pool = self._get_pool(key)
+        cond = pool['cond']
+        timeout = self._wait_timeout if timeout is None else timeout
+        start_time = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        waited = False
+
+        while True:
+            with cond:
+                while True:
+                    candidates = [
+                        t for t in pool['transports']
+                        if not t['retired'] and (not lease or t['active'] < self._max_channels)
+                    ]
+                    if candidates:
+                        entry = min(candidates, key=lambda t: t['active'])
+                        if lease:
+                            entry['active'] += 1
+                        break
+                    # 该主机的第一个连接正在建立（例如后台预热）时等待它完成，而不是重复握手
+                    first_connecting = pool['connecting'] and not any(not t['retired'] for t in pool['transports'])
+                    if not first_connecting and len(pool['transports']) + pool['connecting'] < self._max_transports:
+                        entry = None
+                        pool['connecting'] += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if pool['waiting'] >= self._max_waiters:
+                        self._record_wait(key, time.perf_counter() - start_time, timed_out=True)
+                        raise TimeoutError(f"{key} 的SSH通道排队已满（{self._max_waiters}个等待者）")
+                    if remaining <= 0:
+                        self._record_wait(key, time.perf_counter() - start_time, timed_out=True)
+                        raise TimeoutError(f"等待 {key} 的SSH通道超时（{timeout}秒）")
+                    pool['waiting'] += 1
+                    waited = True
                     try:
-                        ssh.exec_command('echo 1', timeout=5)
-                        self._last_used[key] = time.time()
-                        return ssh
-                    except:
-                        # 连接已断开，删除并重新创建
-                        self._remove_connection(key)
-                
-                # 创建新连接
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(
-                    hostname=server_info['host'],
-                    port=server_info['port'],
-                    username=server_info['username'],
-                    password=server_info['password'],
-                    timeout=10
-                )
-                
-                self._connections[key] = ssh
-                self._last_used[key] = time.time()
-                
-                # 启动清理线程
+                        cond.wait(remaining)
+                    finally:
+                        pool['waiting'] -= 1
+
+            if waited:
+                self._record_wait(key, time.perf_counter() - start_time)
+                waited = False
+
+            if entry is None:
+                # 在锁外握手，其他调用方仍可使用已有的transport
+                try:
+                    ssh = self._open_checked(key, server_info)
+                except Exception:
+                    with cond:
+                        pool['connecting'] -= 1
+                        cond.notify_all()
+                    raise
+                with cond:
+                    pool['connecting'] -= 1
+                    entry = {
+                        'ssh': ssh, 'active': 1 if lease else 0, 'holders': weakref.WeakSet(),
+                        'last_used': time.time(), 'suspect': False, 'retired': False
+                    }
+                    pool['transports'].append(entry)
+                    cond.notify_all()
+                self._record_checkout(key, start_time, connected=True, operation=operation)
                 self._start_cleanup_thread()
-                
-                return ssh
-                
-            except Exception as e:
-                print(f"创建SSH连接失败：{str(e)}")
-                return None
-    
+                return entry
+
+            # 存活判断优先使用 transport.is_active()（不产生网络往返），
+            # 只有在空闲超过 _probe_idle_time 或调用方报告失败后才做真实探测
+            ssh = entry['ssh']
+            alive = self._is_active(ssh)
+            probed = False
+            if alive and (entry['suspect'] or time.time() - entry['last_used'] > self._probe_idle_time):
+                alive = self._probe(ssh)
+                probed = True
+            with cond:
+                entry['suspect'] = False
+                if alive:
+                    entry['last_used'] = time.time()
+                    self._record_checkout(key, start_time, probed=probed, operation=operation)
+                    return entry
+                # 连接已断开，移除后重新选择
+                if lease:
+                    entry['active'] -= 1
+                self._discard(pool, entry)
+                cond.notify_all()
+
+    def _checkin(self, server_info, entry):
+        """归还通道名额"""
+        pool = self._get_pool(self._key(server_info))
+        with pool['cond']:
+            entry['active'] -= 1
+            entry['last_used'] = time.time()
+            if entry['retired'] and not self._in_use(entry):
+                self._discard(pool, entry)
+            pool['cond'].notify()
+
+    def _lend(self, server_info, operation, holder):
+        """取出负载最低的transport交给不归还通道名额的调用方长期持有
+
+        holder为交给调用方的对象；只要它还被引用，该transport就不会被空闲清理或替换时关闭。
+        """
+        entry = self._checkout(server_info, operation, lease=False)
+        with self._get_pool(self._key(server_info))['cond']:
+            entry['holders'].add(holder)
+        return entry['ssh']
+
+    @staticmethod
+    def _in_use(entry):
+        """transport上有通道名额被占用，或仍被 _lend 交出的对象引用"""
+        return entry['active'] > 0 or len(entry['holders']) > 0
+
+    def acquire_channel(self, server_info, operation=None, timeout=None):
+        """占用一个通道名额并返回租约（租约['ssh']为连接），用完调用 release_channel 归还"""
+        return self._checkout(server_info, operation, timeout=timeout)
+
+    def release_channel(self, server_info, lease):
+        self._checkin(server_info, lease)
+
+    def get_broker(self):
+        """本地SSH代理客户端，未启用时为None"""
+        return self._broker
+
+    @staticmethod
+    def _discard(pool, entry):
+        """从连接池移除并关闭一个transport（调用方持有pool['cond']）"""
+        if entry in pool['transports']:
+            pool['transports'].remove(entry)
+        try:
+            entry['ssh'].close()
+        except:
+            pass
+
+    def use_broker(self, socket_path):
+        """本地SSH代理在运行时，通过它执行命令，复用代理进程中已认证的连接
+
+        返回是否启用了代理；代理未运行时继续直连。
+        """
+        from ssh_broker import BrokerClient
+        client = BrokerClient(socket_path)
+        if client.ping():
+            SSHManager._broker = client
+            return True
+        return False
+
+    def _broker_connection(self, server_info, operation):
+        from ssh_broker import BrokerConnection
+        # 直连的transport登记在返回的连接对象上，调用方持有该对象期间不会被关闭
+        wrapper = None
+        fallback = lambda: self._lend(server_info, operation, wrapper)
+        connection = BrokerConnection(self._broker, server_info, fallback, operation)
+        wrapper = InstrumentedConnection(connection, self._key(server_info))
+        return wrapper
+
+    def warm_up(self, servers, operation='warm_up'):
+        """在后台并行建立到各服务器的连接，返回 {服务器名: Future}
+
+        已有连接或正在连接的服务器不重复连接；其他调用方取用正在预热的服务器时
+        只等待该服务器的握手完成。启用了本地SSH代理时由代理负责预热，直接返回空字典。
+        """
+        if self._broker:
+            return {}
+        with self._lock:
+            if SSHManager._warm_executor is None:
+                SSHManager._warm_executor = ThreadPoolExecutor(
+                    max_workers=self._max_warm_workers, thread_name_prefix='ssh-warm'
+                )
+            executor = SSHManager._warm_executor
+        futures = {}
+        for name, server_info in servers.items():
+            pool = self._get_pool(self._key(server_info))
+            with pool['cond']:
+                if pool['transports'] or pool['connecting']:
+                    continue
+            futures[name] = executor.submit(self._warm_one, server_info, operation)
+        return futures
+
+    def _warm_one(self, server_info, operation):
+        start_time = time.perf_counter()
+        self._checkout(server_info, operation, lease=False)
+        return time.perf_counter() - start_time
+
+    def get_connection(self, server_info, operation=None):
+        """获取SSH连接（连接归连接池所有，调用方不要关闭）
+
+        返回负载最低的transport，不占用通道名额；需要受并发上限约束时使用 connection()。
+        调用方持有返回的连接期间，该transport不会被空闲清理关闭。
+        启用了本地SSH代理时返回经由代理执行命令的兼容连接。
+        """
+        if self._broker:
+            return self._broker_connection(server_info, operation)
+        try:
+            wrapper = InstrumentedConnection(None, self._key(server_info))
+            wrapper._ssh = self._lend(server_info, operation, wrapper)
+            return wrapper
+        except Exception as e:
+            print(f"创建SSH连接失败：{str(e)}")
+            return None
+
+    @contextmanager
+    def connection(self, server_info, operation=None, timeout=None):
+        """以with语句占用池中的一个通道名额
+
+        连接失败时抛出ConnectionError，排队超时抛出TimeoutError，SSH错误时标记连接待探测。
+        启用了本地SSH代理时由代理进程负责通道并发控制。
+        """
+        if self._broker:
+            yield self._broker_connection(server_info, operation)
+            return
+        try:
+            entry = self._checkout(server_info, operation, timeout=timeout)
+        except (TimeoutError, ConnectionError):
+            raise
+        except Exception as e:
+            raise ConnectionError(f"无法连接到 {self._key(server_info)}：{str(e)}")
+        try:
+            yield InstrumentedConnection(entry['ssh'], self._key(server_info))
+        except (paramiko.SSHException, EOFError, OSError):
+            entry['suspect'] = True
+            raise
+        finally:
+            self._checkin(server_info, entry)
+
+    def set_health_manager(self, health_manager):
+        """启用主机熔断：熔断中的主机直接抛出HostUnavailableError，不再等待连接超时"""
+        SSHManager._health = health_manager
+
+    def _open_checked(self, key, server_info):
+        """经过熔断器建立新连接，并记录连接结果"""
+        if self._health:
+            self._health.allow(key)
+        try:
+            ssh = self._open(server_info)
+        except Exception as e:
+            if self._health:
+                self._health.record_failure(key, e)
+            raise
+        if self._health:
+            self._health.record_success(key)
+        return ssh
+
+    def _open(self, server_info):
+        """建立新的SSH连接（完整握手和认证）"""
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(
+            hostname=server_info['host'],
+            port=server_info['port'],
+            username=server_info['username'],
+            password=server_info['password'],
+            timeout=10
+        )
+        # keepalive让服务端和中间设备不会因空闲断开连接，断开时is_active()也能及时变为False
+        ssh.get_transport().set_keepalive(self._keepalive_interval)
+        return ssh
+
+    def test_connection(self, server_info, operation=None):
+        """用给定的凭据重新握手以验证配置，失败时抛出异常
+
+        成功后新连接替换池中该主机的旧连接，修改服务器凭据后不会继续使用旧连接；
+        正在使用的旧连接在归还（或不再被持有）后关闭。
+        """
+        key = self._key(server_info)
+        start_time = time.perf_counter()
+        try:
+            ssh = self._open(server_info)
+        except Exception as e:
+            if self._health:
+                self._health.record_failure(key, e)
+            raise
+        if self._health:
+            # 管理员显式测试不受熔断限制，成功后立即恢复该主机
+            self._health.record_success(key)
+        pool = self._get_pool(key)
+        with pool['cond']:
+            for entry in list(pool['transports']):
+                entry['retired'] = True
+                if not self._in_use(entry):
+                    self._discard(pool, entry)
+            pool['transports'].append({
+                'ssh': ssh, 'active': 0, 'holders': weakref.WeakSet(), 'last_used': time.time(),
+                'suspect': False, 'retired': False
+            })
+            pool['cond'].notify_all()
+        self._record_checkout(key, start_time, connected=True, operation=operation)
+        self._start_cleanup_thread()
+        return True
+
+    @staticmethod
+    def _is_active(ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    @staticmethod
+    def _probe(ssh):
+        """真实探测：打开并关闭一个会话通道，不启动远程shell"""
+        try:
+            channel = ssh.get_transport().open_session(timeout=5)
+            channel.close()
+            return True
+        except Exception:
+            return False
+
+    def report_failure(self, server_info):
+        """调用方在连接上执行命令失败时调用，下次取用前会先探测该主机的连接"""
+        pool = self._get_pool(self._key(server_info))
+        with pool['cond']:
+            for entry in pool['transports']:
+                entry['suspect'] = True
+
+    def _host_stats(self, key):
+        return self._stats.setdefault(key, {
+            'checkouts': 0, 'reused': 0, 'probes': 0, 'connects': 0,
+            'total_latency': 0.0, 'max_latency': 0.0,
+            'waits': 0, 'timeouts': 0, 'total_wait': 0.0, 'max_wait': 0.0
+        })
+
+    def _record_checkout(self, key, start_time, probed=False, connected=False, operation=None):
+        latency = time.perf_counter() - start_time
+        CommandMetrics().record(key, 'ssh connect' if connected else 'ssh checkout', latency)
+        with self._lock:
+            if operation:
+                op_stats = self._operation_stats.setdefault(operation, {'checkouts': 0, 'handshakes_avoided': 0})
+                op_stats['checkouts'] += 1
+                if not connected:
+                    op_stats['handshakes_avoided'] += 1
+            stats = self._host_stats(key)
+            stats['checkouts'] += 1
+            if connected:
+                stats['connects'] += 1
+            else:
+                stats['reused'] += 1
+            if probed:
+                stats['probes'] += 1
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+
+    def _record_wait(self, key, wait_time, timed_out=False):
+        with self._lock:
+            stats = self._host_stats(key)
+            stats['waits'] += 1
+            if timed_out:
+                stats['timeouts'] += 1
+            stats['total_wait'] += wait_time
+            stats['max_wait'] = max(stats['max_wait'], wait_time)
+
+    def get_stats(self):
+        """获取每台主机的连接池统计（时间单位：秒）
+
+        包括取用次数、复用/探测/新建次数、取用延迟、排队等待次数和时间，
+        以及当前打开的transport数、使用中的通道数和排队的调用方数。
+        """
+        with self._lock:
+            pools = dict(self._pools)
+            result = {key: dict(stats) for key, stats in self._stats.items()}
+        for key, pool in pools.items():
+            with pool['cond']:
+                gauges = {
+                    'transports': len(pool['transports']),
+                    'active_channels': sum(t['active'] for t in pool['transports']),
+                    'waiting': pool['waiting']
+                }
+            result.setdefault(key, dict(self._host_stats(key))).update(gauges)
+        for stats in result.values():
+            stats['avg_latency'] = stats['total_latency'] / stats['checkouts'] if stats['checkouts'] else 0.0
+            stats['avg_wait'] = stats['total_wait'] / stats['waits'] if stats['waits'] else 0.0
+        return result
+
+    def get_operation_stats(self):
+        """获取每种操作的连接取用次数和复用连接避免的握手次数"""
+        with self._lock:
+            return {operation: dict(stats) for operation, stats in self._operation_stats.items()}
+
     def _start_cleanup_thread(self):
         """启动清理线程"""
         if not self._cleanup_thread:
             self._cleanup_thread = threading.Thread(target=self._cleanup_loop)
             self._cleanup_thread.daemon = True
             self._cleanup_thread.start()
-    
+
     def _cleanup_loop(self):
         """定期清理空闲连接"""
         while not self._stop_cleanup:
             time.sleep(self._cleanup_interval)
             self.cleanup_idle_connections()
-    
+
     def cleanup_idle_connections(self):
-        """清理空闲连接"""
+        """清理空闲连接（有通道在使用或仍被调用方持有的transport不会被关闭）"""
         current_time = time.time()
         with self._lock:
-            for key in list(self._connections.keys()):
-                if current_time - self._last_used[key] > self._max_idle_time:
-                    try:
-                        self._connections[key].close()
-                    except:
-                        pass
-                    del self._connections[key]
-                    del self._last_used[key]
-    
+            pools = list(self._pools.values())
+        for pool in pools:
+            with pool['cond']:
+                for entry in list(pool['transports']):
+                    if self._in_use(entry):
+                        continue
+                    if entry['retired'] or current_time - entry['last_used'] > self._max_idle_time:
+                        self._discard(pool, entry)
+
     def close_all(self):
         """关闭所有连接"""
         with self._lock:
-            for ssh in self._connections.values():
-                try:
-                    ssh.close()
-                except:
-                    pass
-            self._connections.clear()
-            self._last_used.clear()
-    
-    def _remove_connection(self, key):
-        """移除指定的SSH连接"""
-        try:
-            if key in self._connections:
-                connection = self._connections[key]
-                if connection:
-                    try:
-                        connection.close()  # 尝试关闭连接
-                    except:
-                        pass  # 忽略关闭时的错误
-                del self._connections[key]  # 从连接池中删除
-        except Exception as e:
-            print(f"移除SSH连接失败: {str(e)}")
-    
\ No newline at end of file
+            pools = list(self._pools.values())
+        for pool in pools:
+            with pool['cond']:
+                for entry in list(pool['transports']):
+                    self._discard(pool, entry)
+                pool['cond'].notify_all()
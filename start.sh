@@ -32,6 +32,12 @@ fi
 # 设置执行权限
 chmod +x main.py
 
+# 启动本地SSH代理（已在运行时跳过），复用到各服务器的连接
+if ! $PYTHON_PATH ssh_broker.py --stats > /dev/null 2>&1; then
+    echo -e "${YELLOW}正在启动SSH代理...${NC}"
+    nohup $PYTHON_PATH ssh_broker.py >> log_backup/ssh_broker.log 2>&1 &
+fi
+
 # 启动程序
 echo -e "${GREEN}正在启动系统...${NC}"
 $PYTHON_PATH main.py 
\ No newline at end of file
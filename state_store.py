@@ -0,0 +1,382 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+class StateStore:
+    """GPU分配和任务记录的存储（SQLite，WAL模式）
+
+    config.yaml 只保存静态配置（服务器、用户、用户组），频繁变化的
+    gpu_usage 和 task_records 存放在这里，按行更新而不是整文件重写。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS gpu_allocations (
+            server TEXT NOT NULL,
+            gpu TEXT NOT NULL,
+            username TEXT NOT NULL,
+            allocated_at REAL NOT NULL,
+            PRIMARY KEY (server, gpu)
+        );
+        CREATE TABLE IF NOT EXISTS task_records (
+            container TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            server TEXT NOT NULL,
+            gpus TEXT NOT NULL,
+            timestamp INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_task_records_username ON task_records(username);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()  # sqlite3连接不能跨线程共享，每个线程一个连接
+        # 本进程的写事务在这里排队：SQLite的忙等待按退避间隔sleep，线程锁释放后立即唤醒下一个
+        self._write_lock = threading.Lock()
+        self._listeners = []
+        self._connect().executescript(self.SCHEMA)
+
+    def _connect(self):
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None：由本类显式控制事务边界
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=10000')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """写事务：BEGIN IMMEDIATE 立即获取写锁，保证检查和写入之间不被其他进程插入
+
+        只有数据库写入在写锁内，提交后的监听通知（如分配日志的fsync）在锁外执行。
+        """
+        conn = self._connect()
+        with self._write_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            self._local.changes = []
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                self._local.changes = []
+                raise
+            conn.execute('COMMIT')
+        changes, self._local.changes = self._local.changes, []
+        for version, event, data in changes:
+            self._notify(version, event, data)
+
+    def _record_change(self, conn, event, data):
+        """在写事务内递增数据版本，提交后通知监听者"""
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', '0')")
+        conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+        version = self._read_version(conn)
+        self._local.changes.append((version, event, data))
+
+    @staticmethod
+    def _read_version(conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return int(row['value']) if row else 0
+
+    def get_version(self):
+        """获取数据版本号，任何进程的每次修改都会使其递增"""
+        return self._read_version(self._connect())
+
+    def add_listener(self, callback):
+        """注册修改监听：callback(version, event, data)，在本进程的写事务提交后调用"""
+        self._listeners.append(callback)
+
+    def _notify(self, version, event, data):
+        for callback in list(self._listeners):
+            try:
+                callback(version, event, data)
+            except Exception as e:
+                print(f"状态监听处理失败：{str(e)}")
+
+    def snapshot(self):
+        """在同一个读事务中获取 (版本号, 任务记录列表[(用户名, 任务)], GPU使用情况)"""
+        conn = self._connect()
+        conn.execute('BEGIN')
+        try:
+            version = self._read_version(conn)
+            tasks = [
+                (row['username'], self._task_from_row(row))
+                for row in conn.execute('SELECT * FROM task_records ORDER BY timestamp')
+            ]
+            usage = {}
+            for row in conn.execute('SELECT server, gpu, username FROM gpu_allocations'):
+                usage.setdefault(row['server'], {})[row['gpu']] = row['username']
+        finally:
+            conn.execute('COMMIT')
+        return version, tasks, usage
+
+    def close(self):
+        """关闭当前线程的数据库连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @staticmethod
+    def _task_from_row(row):
+        return {
+            'server': row['server'],
+            'container': row['container'],
+            'gpus': json.loads(row['gpus']),
+            'timestamp': row['timestamp']
+        }
+
+    # ---- GPU分配 ----
+
+    def get_gpu_usage(self, server_name):
+        """获取服务器的GPU使用情况 {gpu编号: 用户名}"""
+        rows = self._connect().execute(
+            'SELECT gpu, username FROM gpu_allocations WHERE server = ?', (server_name,)
+        ).fetchall()
+        return {row['gpu']: row['username'] for row in rows}
+
+    def get_all_gpu_usage(self):
+        """获取所有服务器的GPU使用情况 {服务器: {gpu编号: 用户名}}"""
+        usage = {}
+        for row in self._connect().execute('SELECT server, gpu, username FROM gpu_allocations'):
+            usage.setdefault(row['server'], {})[row['gpu']] = row['username']
+        return usage
+
+    def allocate_gpus(self, server_name, gpu_indices, username):
+        """原子地分配GPU，任一GPU已被占用时不做任何修改并返回False"""
+        gpus = [str(g) for g in gpu_indices]
+        now = time.time()
+        with self._transaction() as conn:
+            placeholders = ','.join('?' * len(gpus))
+            taken = conn.execute(
+                f'SELECT 1 FROM gpu_allocations WHERE server = ? AND gpu IN ({placeholders}) LIMIT 1',
+                [server_name] + gpus
+            ).fetchone()
+            if taken:
+                return False
+            conn.executemany(
+                'INSERT INTO gpu_allocations (server, gpu, username, allocated_at) VALUES (?, ?, ?, ?)',
+                [(server_name, gpu, username, now) for gpu in gpus]
+            )
+            self._record_change(conn, 'allocate', {'server': server_name, 'gpus': gpus, 'username': username})
+        return True
+
+    def release_gpus(self, server_name, gpu_indices, username=None):
+        """释放GPU；指定username时只释放该用户持有的GPU"""
+        gpus = [(server_name, str(g)) for g in gpu_indices]
+        with self._transaction() as conn:
+            if username is None:
+                conn.executemany('DELETE FROM gpu_allocations WHERE server = ? AND gpu = ?', gpus)
+            else:
+                conn.executemany(
+                    'DELETE FROM gpu_allocations WHERE server = ? AND gpu = ? AND username = ?',
+                    [g + (username,) for g in gpus]
+                )
+            self._record_change(conn, 'release', {
+                'server': server_name, 'gpus': [gpu for _, gpu in gpus], 'username': username
+            })
+
+    def replace_gpu_usage(self, usage):
+        """用给定的 {服务器: {gpu编号: 用户名}} 整体替换GPU分配表"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM gpu_allocations')
+            conn.executemany(
+                'INSERT OR REPLACE INTO gpu_allocations (server, gpu, username, allocated_at) VALUES (?, ?, ?, ?)',
+                [(server, str(gpu), user, now)
+                 for server, gpus in usage.items() for gpu, user in (gpus or {}).items()]
+            )
+            self._record_change(conn, 'reset', None)
+
+    def load_state(self, usage, tasks):
+        """用给定的GPU使用情况和任务记录列表[(用户名, 任务)]整体替换状态（从分配日志恢复时使用）"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM gpu_allocations')
+            conn.execute('DELETE FROM task_records')
+            conn.executemany(
+                'INSERT INTO gpu_allocations (server, gpu, username, allocated_at) VALUES (?, ?, ?, ?)',
+                [(server, str(gpu), user, now)
+                 for server, gpus in usage.items() for gpu, user in (gpus or {}).items()]
+            )
+            conn.executemany(
+                'INSERT INTO task_records (container, username, server, gpus, timestamp) VALUES (?, ?, ?, ?, ?)',
+                [(task['container'], username, task['server'],
+                  json.dumps([str(g) for g in task['gpus']]), task['timestamp'])
+                 for username, task in tasks]
+            )
+            self._record_change(conn, 'reset', None)
+
+    # ---- 任务记录 ----
+
+    def add_task_record(self, username, server_name, container_name, gpu_indices, timestamp=None):
+        """记录用户任务"""
+        if timestamp is None:
+            timestamp = int(time.time())
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO task_records (container, username, server, gpus, timestamp) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (container_name, username, server_name,
+                 json.dumps([str(g) for g in gpu_indices]), timestamp)
+            )
+            self._record_change(conn, 'add_task', {
+                'username': username,
+                'task': {
+                    'server': server_name,
+                    'container': container_name,
+                    'gpus': [str(g) for g in gpu_indices],
+                    'timestamp': timestamp
+                }
+            })
+
+    def get_task(self, container_name):
+        """按容器名查找任务记录，返回 (用户名, 任务) 或 (None, None)"""
+        row = self._connect().execute(
+            'SELECT * FROM task_records WHERE container = ?', (container_name,)
+        ).fetchone()
+        if row is None:
+            return None, None
+        return row['username'], self._task_from_row(row)
+
+    def get_user_tasks(self, username):
+        """获取用户的所有任务记录"""
+        rows = self._connect().execute(
+            'SELECT * FROM task_records WHERE username = ? ORDER BY timestamp', (username,)
+        ).fetchall()
+        return [self._task_from_row(row) for row in rows]
+
+    def get_task_records(self):
+        """获取所有任务记录 {用户名: [任务, ...]}"""
+        records = {}
+        for row in self._connect().execute('SELECT * FROM task_records ORDER BY timestamp'):
+            records.setdefault(row['username'], []).append(self._task_from_row(row))
+        return records
+
+    def remove_task_record(self, container_name):
+        """删除任务记录并释放该任务仍持有的GPU，返回被删除的任务（不存在时返回None）"""
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT * FROM task_records WHERE container = ?', (container_name,)
+            ).fetchone()
+            if row is None:
+                return None
+            task = self._task_from_row(row)
+            conn.execute('DELETE FROM task_records WHERE container = ?', (container_name,))
+            conn.executemany(
+                'DELETE FROM gpu_allocations WHERE server = ? AND gpu = ? AND username = ?',
+                [(task['server'], gpu, row['username']) for gpu in task['gpus']]
+            )
+            self._record_change(conn, 'remove_task', {'username': row['username'], 'task': task})
+        return task
+
+    def remove_stopped_tasks(self, stopped):
+        """在一个事务中删除已停止容器的任务记录并释放GPU
+
+        stopped为 [(服务器, 容器名, 用户名, GPU列表)]，用户名和GPU来自容器标签（可为None/空）；
+        有任务记录的按记录释放，标签中另有的GPU只释放仍属于该用户的。返回删除的任务记录数。
+        """
+        removed = 0
+        with self._transaction() as conn:
+            for server_name, container_name, username, gpus in stopped:
+                gpus = [str(g) for g in gpus or []]
+                row = conn.execute(
+                    'SELECT * FROM task_records WHERE container = ?', (container_name,)
+                ).fetchone()
+                if row is not None:
+                    task = self._task_from_row(row)
+                    conn.execute('DELETE FROM task_records WHERE container = ?', (container_name,))
+                    conn.executemany(
+                        'DELETE FROM gpu_allocations WHERE server = ? AND gpu = ? AND username = ?',
+                        [(task['server'], gpu, row['username']) for gpu in task['gpus']]
+                    )
+                    self._record_change(conn, 'remove_task', {'username': row['username'], 'task': task})
+                    removed += 1
+                    gpus = [gpu for gpu in gpus if gpu not in task['gpus']]
+                    username = username or row['username']
+                if gpus and username:
+                    conn.executemany(
+                        'DELETE FROM gpu_allocations WHERE server = ? AND gpu = ? AND username = ?',
+                        [(server_name, gpu, username) for gpu in gpus]
+                    )
+                    self._record_change(conn, 'release', {
+                        'server': server_name, 'gpus': gpus, 'username': username
+                    })
+        return removed
+
+    def retain_task_records(self, running_by_server):
+        """只保留容器仍在运行的任务记录，返回被删除的记录数
+
+        running_by_server为 {服务器名: 运行中的容器名集合}，只包含成功查询的服务器；
+        其他服务器上的记录保持不变。删除的记录与 remove_task_record 一样释放任务持有的GPU。
+        """
+        removed = 0
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT * FROM task_records').fetchall()
+            for row in rows:
+                running = running_by_server.get(row['server'])
+                if running is None or row['container'] in running:
+                    continue
+                task = self._task_from_row(row)
+                conn.execute('DELETE FROM task_records WHERE container = ?', (row['container'],))
+                conn.executemany(
+                    'DELETE FROM gpu_allocations WHERE server = ? AND gpu = ? AND username = ?',
+                    [(task['server'], gpu, row['username']) for gpu in task['gpus']]
+                )
+                self._record_change(conn, 'remove_task', {'username': row['username'], 'task': task})
+                removed += 1
+        return removed
+
+    # ---- 迁移 ----
+
+    def migrate_from_config(self, config_manager):
+        """一次性将 config.yaml 中的 gpu_usage/task_records 迁移到数据库
+
+        在配置事务内执行：先导入数据库，再从配置文件中删除这两个段。
+        导入使用 INSERT OR IGNORE，中途失败后重新执行是安全的。
+        """
+        try:
+            with config_manager.transaction() as config:
+                if config is None or ('gpu_usage' not in config and 'task_records' not in config):
+                    return False
+
+                now = time.time()
+                with self._transaction() as conn:
+                    for server, gpus in (config.get('gpu_usage') or {}).items():
+                        for gpu, user in (gpus or {}).items():
+                            conn.execute(
+                                'INSERT OR IGNORE INTO gpu_allocations (server, gpu, username, allocated_at) '
+                                'VALUES (?, ?, ?, ?)',
+                                (server, str(gpu), user, now)
+                            )
+                    for username, tasks in (config.get('task_records') or {}).items():
+                        for task in tasks or []:
+                            conn.execute(
+                                'INSERT OR IGNORE INTO task_records (container, username, server, gpus, timestamp) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (task['container'], username, task['server'],
+                                 json.dumps([str(g) for g in task.get('gpus', [])]),
+                                 task.get('timestamp', int(now)))
+                            )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES ('yaml_migrated_at', ?)",
+                        (str(int(now)),)
+                    )
+                    self._record_change(conn, 'reset', None)
+
+                config.pop('gpu_usage', None)
+                config.pop('task_records', None)
+            print("已将GPU分配和任务记录迁移到状态数据库")
+            return True
+        except Exception as e:
+            print(f"迁移状态数据失败：{str(e)}")
+            return False
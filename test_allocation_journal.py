@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from allocation_journal import AllocationJournal
+from state_store import StateStore
+
+DB_FILE = "test_journal_state.db"
+JOURNAL_FILE = "test_allocations.journal"
+THREADS = 8
+TASKS_PER_THREAD = 100
+
+def cleanup():
+    for path in (DB_FILE, f"{DB_FILE}-wal", f"{DB_FILE}-shm",
+                 JOURNAL_FILE, f"{JOURNAL_FILE}.lock", f"{JOURNAL_FILE}.snapshot"):
+        if os.path.exists(path):
+            os.remove(path)
+
+def worker(store, thread_id):
+    """模拟用户创建并删除容器：分配GPU、记录任务，每隔一个任务删除一次"""
+    server = f"server{thread_id}"
+    for i in range(TASKS_PER_THREAD):
+        gpu = str(i % 8)
+        container = f"user{thread_id}_task{i}"
+        if store.allocate_gpus(server, [gpu], f"user{thread_id}"):
+            store.add_task_record(f"user{thread_id}", server, container, [gpu])
+            if i % 2 == 0:
+                store.remove_task_record(container)
+
+def check_two_stores():
+    """两个进程（各自的StateStore和日志实例）提交顺序与写入日志的顺序不同时，回放仍与数据库一致"""
+    cleanup()
+    store_a, store_b = StateStore(DB_FILE), StateStore(DB_FILE)
+    journal_a = AllocationJournal(JOURNAL_FILE)
+    journal_b = AllocationJournal(JOURNAL_FILE)
+    journal_a.attach(store_a)
+    journal_b.attach(store_b)
+    store_a.allocate_gpus('srv', ['0'], 'alice')
+
+    # A提交释放后，它的日志记录延迟到B的分配记录之后才写入
+    release_logged = threading.Event()
+    original_append = journal_a.append
+
+    def delayed_append(event, data, version=None):
+        release_logged.wait(5)
+        original_append(event, data, version)
+
+    journal_a.append = delayed_append
+    t = threading.Thread(target=store_a.release_gpus, args=('srv', ['0']))
+    t.start()
+    while store_b.get_gpu_usage('srv'):
+        time.sleep(0.01)
+    store_b.allocate_gpus('srv', ['0'], 'bob')
+    # 在A的记录写入之前压缩：B的记录之前有版本缺口，应留在日志中
+    journal_b.compact()
+    release_logged.set()
+    t.join()
+
+    _, _, usage = store_a.snapshot()
+    state = journal_a.replay()
+    print(f"两个状态库并发提交：数据库 {usage}，回放 {state['gpu_usage']}，"
+          f"一致：{state['gpu_usage'] == usage}")
+    journal_a.compact()
+    print(f"再次压缩后回放一致：{journal_a.replay()['gpu_usage'] == usage}")
+    for item in (journal_a, journal_b, store_a, store_b):
+        item.close()
+    cleanup()
+
+def main():
+    check_two_stores()
+    cleanup()
+    store = StateStore(DB_FILE)
+    # 压缩阈值设小，测试过程中触发多次压缩
+    journal = AllocationJournal(JOURNAL_FILE, compact_bytes=32 * 1024)
+    journal.attach(store)
+
+    start_time = time.time()
+    threads = [threading.Thread(target=worker, args=(store, i)) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start_time
+
+    stats = journal.stats
+    print(f"线程数：{THREADS}，日志记录：{stats['entries']} 条，fsync：{stats['fsyncs']} 次，"
+          f"压缩：{stats['compactions']} 次")
+    print(f"每次fsync平均提交 {stats['entries'] / max(stats['fsyncs'], 1):.2f} 条，"
+          f"吞吐：{stats['entries'] / elapsed:.1f} 条/秒")
+
+    # 回放结果应与数据库一致
+    _, tasks, usage = store.snapshot()
+    state = journal.replay()
+    replay_tasks = {c: {k: v for k, v in t.items() if k != 'username'} for c, t in state['tasks'].items()}
+    db_tasks = {task['container']: task for _, task in tasks}
+    replay_usage = {s: g for s, g in state['gpu_usage'].items() if g}
+    print(f"回放任务记录一致：{replay_tasks == db_tasks}，GPU分配一致：{replay_usage == usage}")
+
+    # 模拟数据库丢失：新的空数据库从日志恢复
+    journal.close()
+    store.close()
+    for path in (DB_FILE, f"{DB_FILE}-wal", f"{DB_FILE}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    store = StateStore(DB_FILE)
+    journal = AllocationJournal(JOURNAL_FILE)
+    journal.attach(store)
+    _, restored_tasks, restored_usage = store.snapshot()
+    restored = {task['container']: task for _, task in restored_tasks}
+    print(f"从日志恢复后任务记录一致：{restored == db_tasks}，GPU分配一致：{restored_usage == usage}")
+
+    journal.close()
+    store.close()
+    cleanup()
+
+if __name__ == "__main__":
+    main()
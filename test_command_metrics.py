@@ -0,0 +1,35 @@
+from batch_executor import batch_command
+from command_metrics import classify, describe
+
+PASSWORD = "S3cretPw"
+
+def main():
+    # main.py中登录仓库的两种命令：拉取镜像时单独执行，创建容器时放在批量脚本中
+    registry_info = {'url': '10.0.0.1:5000', 'username': 'admin', 'password': PASSWORD}
+    pull_login = (
+        f"echo {registry_info['password']} | "
+        f"docker login --insecure-registry {registry_info['url']} "
+        f"--username {registry_info['username']} "
+        f"--password-stdin"
+    )
+    create_login = (
+        f"echo {registry_info['password']} | "
+        f"docker login {registry_info['url']} "
+        f"--username {registry_info['username']} "
+        f"--password-stdin"
+    )
+    _, batch = batch_command([
+        create_login,
+        "docker run -d --name user1-s1-1700000000 img tail -f /dev/null",
+        "docker ps --filter name=user1-s1-1700000000 --format '{{.Status}}'"
+    ])
+
+    for command in (pull_login, batch, "docker login -p S3cretPw 10.0.0.1:5000"):
+        text = describe(command)
+        print(f"{classify(command)}：{text}")
+        print(f"  密码已隐藏：{PASSWORD not in text}")
+
+    print(f"docker ps | grep 的类型：{classify('docker ps | grep user1')}（应为docker ps）")
+
+if __name__ == "__main__":
+    main()
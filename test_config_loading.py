@@ -0,0 +1,68 @@
+import os
+import time
+import yaml
+from config_manager import ConfigManager
+
+CONFIG_FILE = "test_loading.yaml"
+TASK_RECORDS = 10000
+ROUNDS = 5
+
+def build_config():
+    """构造一个包含大量任务记录的配置"""
+    with open("config.yaml", "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    config['task_records'] = {}
+    for i in range(TASK_RECORDS):
+        username = f"user{i % 50}"
+        config['task_records'].setdefault(username, []).append({
+            'server': f"server-{i % 6}",
+            'container': f"{username}-server-{i % 6}-{1700000000 + i}",
+            'gpus': [str(i % 8)],
+            'timestamp': 1700000000 + i
+        })
+    return config
+
+def timed(func):
+    """执行ROUNDS次，返回平均耗时（毫秒）"""
+    start_time = time.perf_counter()
+    for _ in range(ROUNDS):
+        func()
+    return (time.perf_counter() - start_time) / ROUNDS * 1000
+
+def main():
+    config = build_config()
+    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
+        yaml.dump(config, f, Dumper=yaml.SafeDumper, allow_unicode=True)
+    with open(CONFIG_FILE, "rb") as f:
+        data = f.read()
+    
+    print(f"任务记录数：{TASK_RECORDS}，配置文件大小：{len(data) / 1024:.1f}KB")
+    print(f"libyaml可用：{yaml.__with_libyaml__}")
+    
+    results = {
+        '纯Python safe_load': timed(lambda: yaml.load(data, Loader=yaml.SafeLoader)),
+        '纯Python dump': timed(lambda: yaml.dump(config, Dumper=yaml.SafeDumper, allow_unicode=True)),
+    }
+    if yaml.__with_libyaml__:
+        results['libyaml CSafeLoader'] = timed(lambda: yaml.load(data, Loader=yaml.CSafeLoader))
+        results['libyaml CSafeDumper'] = timed(lambda: yaml.dump(config, Dumper=yaml.CSafeDumper, allow_unicode=True))
+    
+    # 冷进程加载：每次新建ConfigManager，第一次会生成快照，之后直接读取快照
+    ConfigManager(CONFIG_FILE).load_config()
+    results['冷启动 load_config（快照）'] = timed(lambda: ConfigManager(CONFIG_FILE).load_config())
+    
+    # 热进程加载：文件未变化时命中内存快照
+    config_manager = ConfigManager(CONFIG_FILE)
+    config_manager.load_config()
+    results['热进程 load_config（内存快照）'] = timed(config_manager.load_config)
+    
+    print()
+    for name, elapsed in results.items():
+        print(f"{name:<30} {elapsed:10.2f} ms")
+    
+    for path in (CONFIG_FILE, f"{CONFIG_FILE}.lock", f"{CONFIG_FILE}.snapshot"):
+        if os.path.exists(path):
+            os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+import time
+import yaml
+from config_manager import ConfigManager
+
+CONFIG_FILE = "test_transaction.yaml"
+WORKERS = 8
+UPDATES_PER_WORKER = 200
+
+def cleanup():
+    """删除测试配置及其锁文件、历史版本（.bak1 ...）和快照"""
+    directory = os.path.dirname(os.path.abspath(CONFIG_FILE))
+    for name in os.listdir(directory):
+        if name.startswith(CONFIG_FILE):
+            os.remove(os.path.join(directory, name))
+
+def worker(worker_id):
+    """模拟并发写入的CLI进程：每次事务给计数器加1并记录一条写入"""
+    config_manager = ConfigManager(CONFIG_FILE)
+    for i in range(UPDATES_PER_WORKER):
+        with config_manager.transaction() as config:
+            config['counter'] += 1
+            config['writers'].setdefault(f"worker-{worker_id}", 0)
+            config['writers'][f"worker-{worker_id}"] += 1
+
+def main():
+    # 创建测试配置
+    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
+        yaml.dump({'counter': 0, 'writers': {}}, f)
+    
+    start_time = time.time()
+    processes = []
+    for i in range(WORKERS):
+        p = multiprocessing.Process(target=worker, args=(i,))
+        processes.append(p)
+        p.start()
+    
+    for p in processes:
+        p.join()
+    elapsed = time.time() - start_time
+    
+    # 检查是否有更新丢失
+    config = ConfigManager(CONFIG_FILE).load_config()
+    expected = WORKERS * UPDATES_PER_WORKER
+    lost = expected - config['counter']
+    
+    print(f"进程数：{WORKERS}，每个进程更新次数：{UPDATES_PER_WORKER}")
+    print(f"期望计数：{expected}，实际计数：{config['counter']}，丢失更新：{lost}")
+    print(f"各进程提交次数：{config['writers']}")
+    print(f"耗时：{elapsed:.2f}秒，吞吐：{expected / elapsed:.1f} 次提交/秒")
+    
+    cleanup()
+
+if __name__ == "__main__":
+    main()
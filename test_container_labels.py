@@ -0,0 +1,39 @@
+from container_labels import (
+    PS_LABEL_FORMAT, api_owner_filters, build_labels, label_args, labels_from_fields, name_filter, owner_filter,
+    parse_labels
+)
+
+def ps_line(container_id, name, labels):
+    """模拟 docker ps --format 输出的一行（标签按PS_LABEL_FORMAT的顺序，缺少的标签为空）"""
+    values = [labels.get(key, '') for key in
+              [part.split('"')[1] for part in PS_LABEL_FORMAT.split('\t')]]
+    return '\t'.join([container_id, name, 'Up 2 hours', '2 hours ago'] + values)
+
+def main():
+    labels = build_labels('user1', 'default', ['0', '1'], 1700000000, 24)
+    print(f"docker run参数：{label_args(labels)}")
+    print(f"docker ps过滤：{owner_filter('user1')}")
+    # 没有标签的旧容器按任务记录中的容器名列出
+    old_names = ['user1-s1.lab-1600000000']
+    print(f"旧容器过滤：{name_filter(old_names)}")
+    print(f"API过滤：{api_owner_filters('user1', old_names)}")
+
+    # 服务器名中包含'-'，容器名无法按'-'拆分出所属用户
+    lines = [
+        ps_line('a1', 'user1-219-216-99-133-1700000000', labels),
+        ps_line('a2', 'user10-219-216-99-133-1700000100',
+                build_labels('user10', 'default', ['2'], 1700000100, 24)),
+        ps_line('a3', 'registry', {}),
+    ]
+    owners = []
+    for line in lines:
+        info = parse_labels(labels_from_fields(line.split('\t')[4:]))
+        owners.append(info['owner'] if info else None)
+    print(f"所属用户：{owners}（应为['user1', 'user10', None]）")
+    print(f"user1的容器：{[o for o in owners if o == 'user1']}（user10的容器不应出现）")
+
+    info = parse_labels(labels)
+    print(f"GPU：{info['gpus']}，创建时间：{info['created_at']}，时间限制：{info['time_limit']}小时")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 import time
 from file_lock import FileLock
 
@@ -39,5 +40,9 @@ def main():
     with open("test.txt", "r") as f:
         print(f.read())
 
+    # 锁文件在释放后保留，测试结束时清理
+    if os.path.exists("test.txt.lock"):
+        os.remove("test.txt.lock")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,99 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from allocation_journal import AllocationJournal
+from gpu_manager import GPUManager
+from state_store import StateStore
+
+DB_FILE = "test_gpu_allocation.db"
+JOURNAL_FILE = "test_gpu_allocation.journal"
+SERVERS = 6
+GPUS_PER_SERVER = 8
+USERS = 24
+ALLOCATIONS_PER_USER = 50
+FSYNC_LATENCY = 0.002  # 模拟磁盘一次fsync的耗时（秒）；带写缓存的虚拟磁盘上fsync几乎不耗时
+
+class DiskJournal(AllocationJournal):
+    """每批记录的写入额外耗时 FSYNC_LATENCY，模拟没有写缓存的磁盘"""
+
+    def _write_batch(self, batch):
+        time.sleep(FSYNC_LATENCY)
+        super()._write_batch(batch)
+
+class GlobalLockGPUManager(GPUManager):
+    """对照组：所有服务器共用一把锁（分片前的行为）"""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._global_lock = threading.Lock()
+
+    @contextmanager
+    def server_lock(self, server_name, timeout=10):
+        with self._global_lock:
+            yield
+
+def cleanup():
+    directory = os.path.dirname(os.path.abspath(DB_FILE))
+    for name in os.listdir(directory):
+        if name.startswith(DB_FILE) or name.startswith(JOURNAL_FILE):
+            os.remove(os.path.join(directory, name))
+
+def user_worker(gpu_manager, user_id, results):
+    """模拟用户反复在随机服务器上申请并释放一块GPU"""
+    rng = random.Random(user_id)
+    username = f"user{user_id}"
+    latencies = []
+    for _ in range(ALLOCATIONS_PER_USER):
+        server_name = f"server{rng.randrange(SERVERS)}"
+        gpu = str(rng.randrange(GPUS_PER_SERVER))
+        start = time.perf_counter()
+        if gpu_manager.allocate_gpus(server_name, [gpu], username):
+            latencies.append(time.perf_counter() - start)
+            gpu_manager.release_gpus(server_name, [gpu])
+    results[user_id] = latencies
+
+def run(manager_class):
+    cleanup()
+    config = {'servers': {f"server{i}": {} for i in range(SERVERS)}}
+    store = StateStore(DB_FILE)
+    journal = DiskJournal(JOURNAL_FILE)
+    journal.attach(store)
+    gpu_manager = manager_class(config)
+    gpu_manager.set_state_store(store)
+
+    results = {}
+    start_time = time.time()
+    threads = [threading.Thread(target=user_worker, args=(gpu_manager, i, results)) for i in range(USERS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start_time
+
+    latencies = sorted(l for user_latencies in results.values() for l in user_latencies)
+    leaked = sum(len(gpus) for gpus in store.get_all_gpu_usage().values())
+    entries_per_fsync = journal.stats['entries'] / journal.stats['fsyncs'] if journal.stats['fsyncs'] else 0
+    journal.close()
+    store.close()
+    cleanup()
+    return len(latencies), elapsed, latencies, leaked, entries_per_fsync
+
+def main():
+    print(f"服务器：{SERVERS}，模拟用户：{USERS}，每个用户申请次数：{ALLOCATIONS_PER_USER}，"
+          f"模拟fsync耗时：{FSYNC_LATENCY * 1000:.1f}ms")
+    throughput = {}
+    for label, manager_class in (("全局锁", GlobalLockGPUManager), ("按服务器分片", GPUManager)):
+        count, elapsed, latencies, leaked, entries_per_fsync = run(manager_class)
+        throughput[label] = count / elapsed
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+        print(f"{label}：成功分配 {count} 次，耗时 {elapsed:.2f}秒，吞吐 {throughput[label]:.1f} 次/秒，"
+              f"分配延迟 p50 {p50:.2f}ms p99 {p99:.2f}ms，每次fsync提交 {entries_per_fsync:.2f} 条，未释放GPU {leaked} 块")
+    ratio = throughput['按服务器分片'] / throughput['全局锁']
+    print(f"吞吐提升：{ratio:.2f}倍")
+    assert ratio > 1, "按服务器分片的吞吐没有超过全局锁"
+
+if __name__ == "__main__":
+    main()
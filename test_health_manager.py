@@ -0,0 +1,54 @@
+import os
+import time
+from health_manager import HealthManager, HostUnavailableError
+
+STATE_FILE = "test_host_health.json"
+HOST = "10.0.0.1:22"
+
+def cleanup():
+    for path in (STATE_FILE, f"{STATE_FILE}.lock", f"{STATE_FILE}.tmp"):
+        if os.path.exists(path):
+            os.remove(path)
+
+def check_fast_fail(health):
+    start = time.perf_counter()
+    try:
+        health.allow(HOST)
+    except HostUnavailableError as e:
+        return (time.perf_counter() - start) * 1000, str(e)
+    return None, None
+
+def main():
+    cleanup()
+    health = HealthManager(STATE_FILE, failure_threshold=2, base_backoff=0.2, max_backoff=1, trial_timeout=0.5)
+    # 另一个实例模拟cron运行的检查脚本
+    other = HealthManager(STATE_FILE, failure_threshold=2, base_backoff=0.2, max_backoff=1, trial_timeout=0.5)
+
+    health.record_failure(HOST, "timed out")
+    print(f"失败1次后：{health.get_state(HOST)['state']}（应为closed）")
+    health.record_failure(HOST, "timed out")
+    print(f"失败2次后：{health.get_state(HOST)['state']}（应为open）")
+
+    elapsed, message = check_fast_fail(other)
+    print(f"另一进程快速失败：{message}，耗时 {elapsed:.3f}ms")
+
+    time.sleep(0.25)
+    print(f"退避到期后放行试探：{health.allow(HOST)}，状态 {health.get_state(HOST)['state']}（应为half_open）")
+    elapsed, _ = check_fast_fail(other)
+    print(f"试探期间其他调用方被拒绝：{elapsed is not None}")
+
+    health.record_failure(HOST, "timed out")
+    state = health.get_state(HOST)
+    print(f"试探失败后重新打开，退避 {state['retry_at'] - state['last_failure']:.2f}秒（应为0.40）")
+
+    time.sleep(0.45)
+    other.allow(HOST)
+    other.record_success(HOST)
+    print(f"试探成功后：{health.get_state(HOST)['state']}（应为closed）")
+
+    health.save_snapshots({'server1': {'name': 'server1', 'updated_at': time.time()}})
+    print(f"另一进程读取最近状态：{other.get_snapshot('server1') is not None}")
+    cleanup()
+
+if __name__ == "__main__":
+    main()
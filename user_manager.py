@@ -1,6 +1,9 @@
+from config_watcher import ConfigSubscriber
 import getpass
 
-class UserManager:
+class UserManager(ConfigSubscriber):
+    WATCHED_SECTIONS = ('users', 'registry_server')
+
     def __init__(self, config):
         """
         初始化用户管理器
@@ -9,17 +12,13 @@ class UserManager:
         """
         self.config = config
         self.config_manager = None  # 将在set_config_manager中设置
-
-    def set_config_manager(self, config_manager):
-        """设置配置管理器实例"""
-        self.config_manager = config_manager
+        self.config_watcher = None  # 将在set_config_watcher中设置
 
     def verify_user(self, username, password):
         """验证用户登录"""
         try:
             # 重新加载配置以获取最新状态
-            if self.config_manager:
-                self.config = self.config_manager.load_config()
+            self._refresh()
                 
             users = self.config['users']
             if username not in users:
@@ -38,62 +37,56 @@ class UserManager:
     def is_admin(self, username):
         """检查用户是否是管理员"""
         # 重新加载配置以获取最新状态
-        if self.config_manager:
-            self.config = self.config_manager.load_config()
+        self._refresh()
             
         return (username in self.config['users'] and 
                 self.config['users'][username]['role'] == 'admin')
 
     def add_user(self, username, password, role='user'):
         """添加新用户"""
-        # 重新加载配置以获取最新状态
-        if self.config_manager:
-            self.config = self.config_manager.load_config()
-            
-        if not self.config['users'].get(username):
-            # 创建用户目录路径（仅用于显示）
-            user_dir = f"{self.config['registry_server']['nfs_path']}/{username}"
-            
-            self.config['users'][username] = {
-                'username': username,
-                'password': password,
-                'role': role,
-                'data_dir': user_dir
-            }
-            
-            # 保存配置
-            if self.config_manager:
-                if self.config_manager.save_config(self.config):
-                    print(f"用户 {username} 添加成功")
-                    print(f"FTP目录：{user_dir}")
-                else:
-                    print("保存配置失败")
-        else:
-            print("用户已存在")
+        try:
+            with self._transaction() as config:
+                if config['users'].get(username):
+                    print("用户已存在")
+                    return
+
+                # 创建用户目录路径（仅用于显示）
+                user_dir = f"{config['registry_server']['nfs_path']}/{username}"
+                
+                config['users'][username] = {
+                    'username': username,
+                    'password': password,
+                    'role': role,
+                    'data_dir': user_dir
+                }
+        except Exception as e:
+            print(f"保存配置失败：{str(e)}")
+            return
+
+        self._reload()
+        print(f"用户 {username} 添加成功")
+        print(f"FTP目录：{user_dir}")
 
     def delete_user(self, username):
         """删除用户"""
-        # 重新加载配置以获取最新状态
-        if self.config_manager:
-            self.config = self.config_manager.load_config()
-            
-        if username in self.config['users']:
-            del self.config['users'][username]
-            # 保存配置
-            if self.config_manager:
-                if self.config_manager.save_config(self.config):
-                    print(f"用户 {username} 删除成功")
-                else:
-                    print("保存配置失败")
-        else:
-            print("用户不存在")
+        try:
+            with self._transaction() as config:
+                if username not in config['users']:
+                    print("用户不存在")
+                    return
+                del config['users'][username]
+        except Exception as e:
+            print(f"保存配置失败：{str(e)}")
+            return
+
+        self._reload()
+        print(f"用户 {username} 删除成功")
 
     def manage_users(self):
         """用户管理界面"""
         while True:
             # 重新加载配置以获取最新状态
-            if self.config_manager:
-                self.config = self.config_manager.load_config()
+            self._refresh()
                 
             print("\n=== 用户管理 ===")
             print("1. 添加用户")
@@ -113,8 +106,7 @@ class UserManager:
                 self.delete_user(username)
             elif choice == '3':
                 # 重新加载配置以显示最新用户列表
-                if self.config_manager:
-                    self.config = self.config_manager.load_config()
+                self._refresh()
                 print("\n当前用户列表：")
                 for username, user_info in self.config['users'].items():
                     print(f"用户名: {username}, 角色: {user_info['role']}")